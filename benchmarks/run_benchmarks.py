@@ -0,0 +1,449 @@
+"""
+Billing benchmark suite.
+
+Times the start-up imports, the tariff loading, the concurrent OpenEI requests (on a local stand-in server),
+compute_bill(), the demand charges, compute_bill_batch() and get_electricity_price() on seeded synthetic load profiles
+and the bundled revised OpenEI tariffs. The results are written to a JSON file and
+compared to a stored baseline:
+
+    python -m benchmarks.run_benchmarks                      # run the default suite, compare to baseline.json
+    python -m benchmarks.run_benchmarks --profile quick      # a smoke run
+    python -m benchmarks.run_benchmarks --save-baseline      # store the results as the new baseline
+
+The exit code is 1 if a case is slower than the baseline by more than the tolerance, or if it exceeds its memory
+ceiling.
+"""
+
+__author__ = 'Olivier Van Cutsem'
+
+import argparse
+from datetime import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from electricitycostcalculator.cost_calculator.meter_data import save_meter_data, bill_meter_data
+from electricitycostcalculator.cost_calculator.rate_structure import ChargeType
+from electricitycostcalculator.cost_calculator.tariff_structure import TariffElemPeriod, DemandWindowMode
+from electricitycostcalculator.openei_tariff.openei_tariff_analyzer import OpenEI_tariff
+from electricitycostcalculator.openei_tariff.openei_client import OpenEIClient
+from electricitycostcalculator.openei_tariff.fake_openei_server import FakeOpenEIServer
+
+from benchmarks.synthetic import OPENEI_TARIFFS, load_openei_tariff, load_compiled_openei_tariff, generate_load_profiles, \
+    generate_tariff
+
+THIS_PATH = os.path.dirname(os.path.abspath(__file__))
+ROOT_PATH = os.path.dirname(THIS_PATH)
+DEFAULT_OUTPUT = os.path.join(THIS_PATH, 'results.json')
+DEFAULT_BASELINE = os.path.join(THIS_PATH, 'baseline.json')
+
+# --------------- Benchmark cases --------------- #
+
+
+class BenchmarkCase(object):
+    """
+    A benchmarked function: 'setup' builds its inputs once (not timed), 'run' is timed on them and the optional
+    'teardown' releases them. If 'memory_ceiling' is set (in bytes), the peak memory allocated by 'run' is also
+    measured, and the case fails above the ceiling.
+    """
+
+    def __init__(self, name, group, params, setup, run, teardown=None, memory_ceiling=None):
+        self.name = name
+        self.group = group
+        self.params = params
+        self.setup = setup
+        self.run = run
+        self.teardown = teardown
+        self.memory_ceiling = memory_ceiling
+
+
+def case_load_tariff(name):
+    return BenchmarkCase('load_tariff[{0}]'.format(name), 'load_tariff', {'tariff': name},
+                         lambda: None,
+                         lambda _: load_openei_tariff(name))
+
+
+def case_load_compiled_tariff(name):
+
+    def setup():
+        compiled_path = tempfile.mkdtemp() + '/'
+        load_compiled_openei_tariff(name, compiled_path)  # compile the tariff
+        return compiled_path
+
+    return BenchmarkCase('load_compiled_tariff[{0}]'.format(name), 'load_tariff', {'tariff': name, 'compiled': True},
+                         setup,
+                         lambda compiled_path: load_compiled_openei_tariff(name, compiled_path),
+                         lambda compiled_path: shutil.rmtree(compiled_path, ignore_errors=True))
+
+
+def case_compute_bill(name, resolution, nb_years):
+    first_year = OPENEI_TARIFFS[name][1]
+
+    def setup():
+        return load_openei_tariff(name), generate_load_profiles(datetime(first_year, 1, 1), nb_years, resolution).iloc[:, 0]
+
+    return BenchmarkCase('compute_bill[{0},{1}min,{2}y]'.format(name, resolution, nb_years), 'compute_bill',
+                         {'tariff': name, 'resolution': resolution, 'years': nb_years},
+                         setup,
+                         lambda args: args[0].compute_bill(args[1], monthly_detailed=True))
+
+
+def case_demand(name, resolution, nb_years, demand_window=None, demand_window_mode=DemandWindowMode.BLOCK):
+    first_year = OPENEI_TARIFFS[name][1]
+
+    def setup():
+        bill_calculator = load_openei_tariff(name, demand_window, demand_window_mode)
+        data = generate_load_profiles(datetime(first_year, 1, 1), nb_years, resolution).iloc[:, 0]
+        blocks = [tariff_block for label, tariff_type in list(bill_calculator.type_tariffs_map.items())
+                  if tariff_type == ChargeType.DEMAND
+                  for tariff_block in bill_calculator.get_tariff_struct(label, (data.index[0], data.index[-1]))]
+        return blocks, data
+
+    def run(args):
+        for tariff_block in args[0]:
+            tariff_block.compute_bill(args[1])
+
+    window_name = ''
+    params = {'tariff': name, 'resolution': resolution, 'years': nb_years}
+    if demand_window is not None:
+        window_name = ',{0}min-{1}'.format(demand_window, demand_window_mode.value)
+        params.update({'demand_window': demand_window, 'demand_window_mode': demand_window_mode.value})
+
+    return BenchmarkCase('demand[{0},{1}min,{2}y{3}]'.format(name, resolution, nb_years, window_name), 'demand', params,
+                         setup, run)
+
+
+def case_compute_bill_batch(name, resolution, nb_years, nb_meters):
+    first_year = OPENEI_TARIFFS[name][1]
+
+    def setup():
+        return load_openei_tariff(name), generate_load_profiles(datetime(first_year, 1, 1), nb_years, resolution, nb_meters)
+
+    return BenchmarkCase('compute_bill_batch[{0},{1}min,{2}y,{3}m]'.format(name, resolution, nb_years, nb_meters),
+                         'compute_bill_batch',
+                         {'tariff': name, 'resolution': resolution, 'years': nb_years, 'meters': nb_meters},
+                         setup,
+                         lambda args: args[0].compute_bill_batch(args[1]))
+
+
+def case_scenarios(name, resolution, nb_years, nb_scenarios):
+    """
+    Bill scaled and shifted variants of a load profile, sharing its index
+    """
+
+    first_year = OPENEI_TARIFFS[name][1]
+
+    def setup():
+        data = generate_load_profiles(datetime(first_year, 1, 1), nb_years, resolution).iloc[:, 0]
+        scales = np.linspace(0.5, 1.5, nb_scenarios)
+        scenarios = np.array([np.roll(data.values, s_i) * scale for s_i, scale in enumerate(scales)])
+        return load_openei_tariff(name), scenarios, data.index
+
+    return BenchmarkCase('compute_bill_scenarios[{0},{1}min,{2}y,{3}s]'.format(name, resolution, nb_years, nb_scenarios),
+                         'compute_bill_scenarios',
+                         {'tariff': name, 'resolution': resolution, 'years': nb_years, 'scenarios': nb_scenarios},
+                         setup,
+                         lambda args: args[0].compute_bill_scenarios(args[1], args[2]))
+
+
+def case_low_memory(name, resolution, nb_years):
+    """
+    Bill years of high-resolution data in low memory mode: the peak memory must stay under LOW_MEMORY_CEILING whatever
+    the length of the data
+    """
+
+    first_year = OPENEI_TARIFFS[name][1]
+
+    def setup():
+        return load_openei_tariff(name), generate_load_profiles(datetime(first_year, 1, 1), nb_years, resolution).iloc[:, 0]
+
+    return BenchmarkCase('compute_bill_low_memory[{0},{1}min,{2}y]'.format(name, resolution, nb_years), 'compute_bill',
+                         {'tariff': name, 'resolution': resolution, 'years': nb_years, 'low_memory': True},
+                         setup,
+                         lambda args: args[0].compute_bill(args[1], monthly_detailed=True, low_memory=True),
+                         memory_ceiling=LOW_MEMORY_CEILING)
+
+
+# The peak memory allocated by compute_bill() in low memory mode, on top of the data: about one month of intermediate
+# arrays for 1-min data
+LOW_MEMORY_CEILING = 16 * 2 ** 20
+
+
+def case_meter_data(name, extension, nb_years, nb_meters, nb_billed):
+    """
+    Bill 'nb_billed' meters of a columnar file of 'nb_meters' meters of 15-min data, over its last month: only the
+    billed meters and month are read
+    """
+
+    first_year = OPENEI_TARIFFS[name][1]
+    range_date = (datetime(first_year + nb_years - 1, 12, 1), datetime(first_year + nb_years - 1, 12, 31, 23, 45))
+
+    def setup():
+        data_path = tempfile.mkdtemp()
+        filename = os.path.join(data_path, 'meters' + extension)
+        data_meters = generate_load_profiles(datetime(first_year, 1, 1), nb_years, 15, nb_meters)
+        save_meter_data(data_meters, filename, row_group_size=31 * 96)
+        return load_openei_tariff(name), data_path, filename, list(data_meters.columns[:nb_billed])
+
+    return BenchmarkCase('meter_data[{0},{1},{2}y,{3}/{4}m]'.format(name, extension[1:], nb_years, nb_billed, nb_meters),
+                         'meter_data',
+                         {'tariff': name, 'format': extension[1:], 'years': nb_years, 'meters': nb_meters,
+                          'billed': nb_billed},
+                         setup,
+                         lambda args: bill_meter_data(args[0], args[2], args[3], range_date),
+                         lambda args: shutil.rmtree(args[1], ignore_errors=True))
+
+
+def case_openei_client(nb_copies, max_concurrency, delay=0.1):
+    """
+    Request the OpenEI tariffs 'nb_copies' times from a local FakeOpenEIServer answering with a latency of 'delay'
+    seconds, with at most 'max_concurrency' requests in flight
+    """
+
+    def setup():
+        return FakeOpenEIServer(delay=delay).start()
+
+    def run(server):
+        openei_tariffs = [OpenEI_tariff(**OPENEI_TARIFFS[name][0]) for name in OPENEI_TARIFFS] * nb_copies
+        return OpenEIClient(url=server.url, max_concurrency=max_concurrency).fetch_tariffs(openei_tariffs)
+
+    return BenchmarkCase('openei_client[{0}x{1},{2}conc]'.format(len(OPENEI_TARIFFS), nb_copies, max_concurrency), 'openei_client',
+                         {'tariffs': len(OPENEI_TARIFFS) * nb_copies, 'max_concurrency': max_concurrency, 'delay': delay},
+                         setup,
+                         run,
+                         lambda server: server.stop())
+
+
+def case_synthetic_tariff(nb_years, blocks_per_year, tiered=False):
+
+    def setup():
+        return generate_tariff(2015, nb_years, blocks_per_year, 96, tiered=tiered), generate_load_profiles(datetime(2015, 1, 1), nb_years, 15).iloc[:, 0]
+
+    return BenchmarkCase('synthetic_tariff[{0}y,{1}blocks/y{2}]'.format(nb_years, blocks_per_year, ',tiered' if tiered else ''), 'compute_bill',
+                         {'years': nb_years, 'blocks_per_year': blocks_per_year, 'tiered': tiered},
+                         setup,
+                         lambda args: args[0].compute_bill(args[1], monthly_detailed=True))
+
+
+def case_price(name, nb_days, cached):
+    first_year = OPENEI_TARIFFS[name][1]
+    range_date = (datetime(first_year, 1, 1), datetime(first_year, 1, 1) + pd.Timedelta(days=nb_days) - pd.Timedelta(minutes=15))
+
+    def run(bill_calculator):
+        if not cached:
+            bill_calculator.price_cache.clear()
+        return bill_calculator.get_electricity_price(range_date, TariffElemPeriod.QUARTERLY)
+
+    return BenchmarkCase('get_electricity_price[{0},{1}d,{2}]'.format(name, nb_days, 'cached' if cached else 'uncached'),
+                         'get_electricity_price',
+                         {'tariff': name, 'days': nb_days, 'cached': cached},
+                         lambda: load_openei_tariff(name),
+                         run)
+
+
+def case_import(module, forbidden_modules=()):
+    """
+    Time the start of a fresh interpreter importing 'module', as paid by each short-lived billing process. The case
+    fails if one of 'forbidden_modules' gets imported along.
+    """
+
+    script = 'import sys, {0}\nloaded = [m for m in {1!r} if m in sys.modules]\n' \
+             'if loaded:\n    sys.exit("Unexpected imports: " + ", ".join(loaded))'.format(module, list(forbidden_modules))
+
+    return BenchmarkCase('import[{0}]'.format(module), 'import', {'module': module},
+                         lambda: None,
+                         lambda _: subprocess.check_call([sys.executable, '-c', script], cwd=ROOT_PATH))
+
+
+# The dependencies of the OpenEI API and the OpenADR signals, that a bill computation must not load
+NETWORK_MODULES = ('requests', 'lxml', 'xbos')
+
+
+def build_cases(profile):
+    """
+    List the benchmark cases of a profile
+    :param profile: 'quick', 'default' or 'full'
+    :return: a list of BenchmarkCase
+    """
+
+    if profile == 'quick':
+        return [case_import('electricitycostcalculator.cost_calculator.cost_calculator', NETWORK_MODULES + ('holidays',)),
+                case_load_tariff('E-19'),
+                case_load_compiled_tariff('E-19'),
+                case_compute_bill('E-19', 15, 1),
+                case_demand('E-19', 15, 1),
+                case_compute_bill_batch('E-19', 60, 1, 10),
+                case_price('E-19', 365, False)]
+
+    cases = [case_import('electricitycostcalculator', NETWORK_MODULES + ('pandas',)),
+             case_import('electricitycostcalculator.cost_calculator.cost_calculator', NETWORK_MODULES + ('holidays',)),
+             case_import('electricitycostcalculator.cost_calculator.portfolio', NETWORK_MODULES + ('holidays',)),
+             case_import('electricitycostcalculator.openei_tariff.openei_tariff_analyzer', NETWORK_MODULES),
+             case_import('electricitycostcalculator.openei_tariff.openei_client', NETWORK_MODULES),
+             case_import('electricitycostcalculator.oadr_signal.tariff_maps', NETWORK_MODULES + ('pandas',))]
+    cases += [case_load_tariff(name) for name in OPENEI_TARIFFS]
+    cases += [case_load_compiled_tariff(name) for name in OPENEI_TARIFFS]
+    cases += [case_compute_bill(name, 15, 1) for name in OPENEI_TARIFFS]
+    cases += [case_compute_bill('E-19', resolution, 1) for resolution in [1, 5, 60]]
+    cases += [case_compute_bill('E-19', resolution, 5) for resolution in [15, 60]]
+    cases += [case_demand('E-19', resolution, 1) for resolution in [1, 15]]
+    cases += [case_demand('E-19', 1, 1, 15, demand_window_mode) for demand_window_mode in DemandWindowMode]
+    cases += [case_low_memory('E-19', 1, nb_years) for nb_years in [1, 5]]
+    cases += [case_compute_bill_batch('E-19', 60, 1, nb_meters) for nb_meters in [1, 10, 100]]
+    cases += [case_scenarios('E-19', 15, 1, nb_scenarios) for nb_scenarios in [1, 500]]
+    cases += [case_meter_data('E-19', extension, 1, 200, 5) for extension in ['.arrow', '.parquet']]
+    cases += [case_openei_client(2, max_concurrency) for max_concurrency in [1, 8]]
+    cases += [case_synthetic_tariff(5, blocks_per_year) for blocks_per_year in [1, 12]]
+    cases += [case_synthetic_tariff(5, 1, tiered=True)]
+    cases += [case_price(name, 365, False) for name in OPENEI_TARIFFS]
+    cases += [case_price('E-19', 7, cached) for cached in [False, True]]
+
+    if profile == 'full':
+        cases += [case_compute_bill('E-19', resolution, 10) for resolution in [1, 5, 15, 60]]
+        cases += [case_demand('E-19', 1, 10)]
+        cases += [case_low_memory('E-19', 1, 10)]
+        cases += [case_compute_bill_batch('E-19', 15, 1, nb_meters) for nb_meters in [1000]]
+        cases += [case_compute_bill_batch('E-19', 60, 1, nb_meters) for nb_meters in [1000, 10000]]
+
+    return cases
+
+
+# --------------- Running and comparing --------------- #
+
+
+def run_case(case, repeat):
+    """
+    Time a benchmark case
+    :param case: a BenchmarkCase
+    :param repeat: the number of timed runs
+    :return: a dict with the timings (in seconds) and the parameters of the case
+    """
+
+    args = case.setup()
+    try:
+        case.run(args)  # warm up: compiled tables, caches of the first call ...
+
+        timings = []
+        for _ in range(repeat):
+            t_start = time.perf_counter()
+            case.run(args)
+            timings.append(time.perf_counter() - t_start)
+
+        # The memory is measured on a separate run, as tracing the allocations slows it down
+        peak_memory = None
+        if case.memory_ceiling is not None:
+            tracemalloc.start()
+            try:
+                case.run(args)
+                peak_memory = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    finally:
+        if case.teardown is not None:
+            case.teardown(args)
+
+    ret = {'group': case.group,
+           'params': case.params,
+           'repeat': repeat,
+           'min': min(timings),
+           'median': float(np.median(timings))}
+
+    if peak_memory is not None:
+        ret['peak_memory'] = peak_memory
+        ret['memory_ceiling'] = case.memory_ceiling
+
+    return ret
+
+
+def compare_results(results, baseline, tolerance):
+    """
+    Compare the median timings of the cases to a baseline
+    :param results: the 'cases' dict of a results file
+    :param baseline: the 'cases' dict of a baseline file
+    :param tolerance: the relative slowdown above which a case is a regression, e.g. 0.25
+    :return: a list of tuples (name, baseline median, median, ratio, is_regression)
+    """
+
+    ret = []
+    for name, data in list(results.items()):
+        if name not in baseline:
+            continue
+        ratio = data['median'] / baseline[name]['median'] if baseline[name]['median'] > 0 else float('inf')
+        ret.append((name, baseline[name]['median'], data['median'], ratio, ratio > 1 + tolerance))
+
+    return ret
+
+
+def get_environment():
+    return {'date': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Billing benchmark suite')
+    parser.add_argument('--profile', choices=['quick', 'default', 'full'], default='default')
+    parser.add_argument('--filter', default=None, help='only run the cases whose name contains this string')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per case')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT, help='the JSON file of the results')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='the JSON file of the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='relative slowdown considered as a regression')
+    args = parser.parse_args(argv)
+
+    cases = build_cases(args.profile)
+    if args.filter is not None:
+        cases = [case for case in cases if args.filter in case.name]
+
+    results = {}
+    nb_over_ceiling = 0
+    for case in cases:
+        results[case.name] = run_case(case, args.repeat)
+        print("{0:<55} {1:10.4f} s".format(case.name, results[case.name]['median']))
+
+        if 'peak_memory' in results[case.name]:
+            is_over_ceiling = results[case.name]['peak_memory'] > case.memory_ceiling
+            nb_over_ceiling += is_over_ceiling
+            print("{0:<55} {1:10.1f} MB (ceiling: {2:.1f} MB){3}".format('', results[case.name]['peak_memory'] / 2 ** 20,
+                                                                        case.memory_ceiling / 2 ** 20,
+                                                                        '  OVER CEILING' if is_over_ceiling else ''))
+
+    output = {'environment': get_environment(), 'profile': args.profile, 'cases': results}
+    with open(args.output, 'w') as output_file:
+        json.dump(output, output_file, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(output, baseline_file, indent=2, sort_keys=True)
+        return 1 if nb_over_ceiling > 0 else 0
+
+    if not os.path.exists(args.baseline):
+        print("\nNo baseline to compare with: {0}".format(args.baseline))
+        return 1 if nb_over_ceiling > 0 else 0
+
+    with open(args.baseline, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+
+    print("\n| Comparison with the baseline of {0}:".format(baseline['environment']['date']))
+    nb_regressions = 0
+    for (name, t_base, t_new, ratio, is_regression) in compare_results(results, baseline['cases'], args.tolerance):
+        nb_regressions += is_regression
+        print(" - {0:<55} {1:10.4f} s -> {2:10.4f} s  (x{3:.2f}){4}".format(name, t_base, t_new, ratio,
+                                                                           '  REGRESSION' if is_regression else ''))
+
+    return 1 if nb_regressions + nb_over_ceiling > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,178 @@
+__author__ = 'Olivier Van Cutsem'
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytz
+
+from electricitycostcalculator.cost_calculator.cost_calculator import CostCalculator
+from electricitycostcalculator.cost_calculator.rate_structure import TouRateSchedule, BlockRate
+from electricitycostcalculator.cost_calculator.tariff_structure import *
+from electricitycostcalculator.openei_tariff.openei_tariff_analyzer import OpenEI_tariff, tariff_struct_from_openei_data, \
+    cost_calculator_from_openei
+
+# --------------- Bundled OpenEI tariffs --------------- #
+
+# The revised OpenEI JSONs bundled in openei_tariff/, and the first year they cover
+OPENEI_TARIFFS = {
+    'A-1': (dict(utility_id='14328', sector='Commercial', tariff_rate_of_interest='A-1 Small General Service',
+                 distrib_level_of_interest=None, phasewing='Single', tou=True), 2015),
+    'A-6': (dict(utility_id='14328', sector='Commercial', tariff_rate_of_interest='A-6', distrib_level_of_interest=None,
+                 phasewing=None, tou=True, option_exclusion=['(X)', '(W)', 'Poly']), 2015),
+    'A-10': (dict(utility_id='14328', sector='Commercial', tariff_rate_of_interest='A-10',
+                  distrib_level_of_interest='Secondary', phasewing=None, tou=True), 2015),
+    'E-19': (dict(utility_id='14328', sector='Commercial', tariff_rate_of_interest='E-19',
+                  distrib_level_of_interest='Secondary', phasewing=None, tou=True), 2015),
+    'E-20': (dict(utility_id='14328', sector='Commercial', tariff_rate_of_interest='E-20',
+                  distrib_level_of_interest='Primary', phasewing=None, tou=True), 2015),
+    'B-19': (dict(utility_id='14328', sector='Commercial', tariff_rate_of_interest='B-19',
+                  distrib_level_of_interest='Secondary', phasewing=None, tou=True), 2020),
+}
+
+# The PDP events bundled with the tariffs
+PDP_EVENTS_FILENAME = 'PDP_events_ex.json'
+
+
+def load_openei_tariff(name, demand_window=None, demand_window_mode=DemandWindowMode.BLOCK):
+    """
+    Build a CostCalculator from one of the bundled revised OpenEI JSONs
+    :param name: a key of OPENEI_TARIFFS
+    :param demand_window: [optional] the demand window of the demand charges, in minutes, see OpenEI_tariff
+    :param demand_window_mode: [optional] an element of DemandWindowMode
+    :return: a CostCalculator object
+    """
+
+    tariff_openei_data = OpenEI_tariff(demand_window=demand_window, demand_window_mode=demand_window_mode,
+                                       **OPENEI_TARIFFS[name][0])
+    if tariff_openei_data.read_from_json() != 0:
+        raise IOError("Couldn't read the OpenEI tariff '{0}'".format(name))
+
+    bill_calculator = CostCalculator()
+    tariff_struct_from_openei_data(tariff_openei_data, bill_calculator, pdp_event_filenames=PDP_EVENTS_FILENAME)
+
+    return bill_calculator
+
+
+def load_compiled_openei_tariff(name, compiled_path):
+    """
+    Idem load_openei_tariff, through the compiled tariff files (see cost_calculator_from_openei)
+    :param name: a key of OPENEI_TARIFFS
+    :param compiled_path: the folder of the compiled tariffs
+    :return: a CostCalculator object
+    """
+
+    bill_calculator = cost_calculator_from_openei(OpenEI_tariff(**OPENEI_TARIFFS[name][0]),
+                                                  pdp_event_filenames=PDP_EVENTS_FILENAME, compiled_path=compiled_path)
+    if bill_calculator is None:
+        raise IOError("Couldn't read the OpenEI tariff '{0}'".format(name))
+
+    return bill_calculator
+
+
+# --------------- Synthetic meter data --------------- #
+
+
+def generate_load_profiles(start, nb_years=1, resolution=15, nb_meters=1, tz='America/Los_Angeles', seed=0):
+    """
+    Generate reproducible energy consumption profiles of commercial buildings: a base load, a daily pattern that peaks
+    in the afternoon of working days, a seasonal (cooling) component and some noise.
+    :param start: a datetime or a string, the first date
+    :param nb_years: [optional] the number of years
+    :param resolution: [optional] the sampling period, in minutes
+    :param nb_meters: [optional] the number of meters
+    :param tz: [optional] the timezone of the dates, or None for naive dates
+    :param seed: [optional] the seed of the random generator
+    :return: a pandas dataframe with one column of energy (in Wh per interval) per meter
+    """
+
+    rng = np.random.RandomState(seed)
+
+    start = pd.Timestamp(start)
+    date_index = pd.date_range(start, start + pd.DateOffset(years=nb_years), freq='{0}min'.format(resolution), tz=tz)[:-1]
+
+    hours = np.asarray(date_index.hour) + np.asarray(date_index.minute) / 60.0
+    working_day = np.asarray(date_index.dayofweek) < 5
+    season = np.cos(2 * np.pi * (np.asarray(date_index.dayofyear) - 200) / 365.0)
+
+    # The shape of the load, shared by all the meters (in p.u. of the base load)
+    daily = np.exp(-0.5 * ((hours - 14.0) / 3.5) ** 2)
+    shape = 1.0 + np.where(working_day, 1.5, 0.3) * daily + 0.4 * np.maximum(season, 0) * daily
+
+    # Each meter has its own size and sensitivity to the daily pattern
+    base_kw = rng.lognormal(mean=3.5, sigma=0.8, size=nb_meters)
+    sensitivity = rng.uniform(0.5, 1.5, size=nb_meters)
+
+    power_kw = base_kw * (1.0 + sensitivity * (shape[:, None] - 1.0))
+    power_kw *= 1.0 + 0.1 * rng.standard_normal(power_kw.shape)
+    np.maximum(power_kw, 0, out=power_kw)
+
+    energy_wh = power_kw * (1000.0 * resolution / 60.0)
+
+    return pd.DataFrame(energy_wh, index=date_index, columns=['meter_{0}'.format(m_i) for m_i in range(nb_meters)])
+
+
+# --------------- Synthetic tariffs --------------- #
+
+
+def generate_tariff(first_year, nb_years=1, blocks_per_year=1, nb_periods_in_day=24, seed=0, tiered=False):
+    """
+    Build a CostCalculator with a synthetic summer/winter TOU tariff (fixed, energy and demand charges), made of
+    'blocks_per_year' successive tariff blocks per year with slightly different rates
+    :param first_year: the first year of the tariff
+    :param nb_years: [optional] the number of years
+    :param blocks_per_year: [optional] the number of tariff blocks per year and per type of charge
+    :param nb_periods_in_day: [optional] the resolution of the daily rates, e.g. 24 for hourly rates
+    :param seed: [optional] the seed of the random generator
+    :param tiered: [optional] if True, the energy rates and the peak demand rates are BlockRates: 25% more expensive
+    above 2000 kWh consumed in the month, and 50% more expensive above 50 kW of demand
+    :return: a CostCalculator object
+    """
+
+    rng = np.random.RandomState(seed)
+    tz = pytz.timezone('America/Los_Angeles')
+
+    bill_calculator = CostCalculator()
+
+    hours = np.arange(nb_periods_in_day) * 24.0 / nb_periods_in_day
+    peak = (hours >= 12) & (hours < 18)
+    part_peak = ((hours >= 8.5) & (hours < 12)) | ((hours >= 18) & (hours < 21.5))
+
+    bounds = pd.date_range(datetime(first_year, 1, 1), datetime(first_year + nb_years, 1, 1), periods=nb_years * blocks_per_year + 1)
+    for b_i in range(len(bounds) - 1):
+        dates = (tz.localize(bounds[b_i].to_pydatetime()), tz.localize((bounds[b_i + 1] - pd.Timedelta(seconds=1)).to_pydatetime()))
+        scale = rng.uniform(0.9, 1.1)
+
+        energy_rates = {}
+        demand_rates = {}
+        for season, months, (off, part, on) in [('summer', list(range(5, 11)), (0.09, 0.12, 0.16)),
+                                                ('winter', [11, 12, 1, 2, 3, 4], (0.10, 0.11, 0.11))]:
+            weekday_rates = (np.where(peak, on, np.where(part_peak, part, off)) * scale).tolist()
+            weekend_rates = off * scale
+            weekday_demand_rates = (np.where(peak, 18.0, np.where(part_peak, 5.0, 0.0)) * scale).tolist()
+            if tiered:
+                weekday_rates = [BlockRate(r, ([1.25 * r], [2000.0])) for r in weekday_rates]
+                weekend_rates = BlockRate(weekend_rates, ([1.25 * weekend_rates], [2000.0]))
+                weekday_demand_rates = [BlockRate(r, ([1.5 * r], [50.0])) if is_peak else r
+                                        for (is_peak, r) in zip(peak, weekday_demand_rates)]
+
+            energy_rates[season] = {TouRateSchedule.MONTHLIST_KEY: months,
+                                    TouRateSchedule.DAILY_RATE_KEY: {
+                                        'weekdays': {TouRateSchedule.DAYSLIST_KEY: [0, 1, 2, 3, 4],
+                                                     TouRateSchedule.RATES_KEY: weekday_rates},
+                                        'weekends': {TouRateSchedule.DAYSLIST_KEY: [5, 6],
+                                                     TouRateSchedule.RATES_KEY: weekend_rates}}}
+            demand_rates[season] = {TouRateSchedule.MONTHLIST_KEY: months,
+                                    TouRateSchedule.DAILY_RATE_KEY: {
+                                        'weekdays': {TouRateSchedule.DAYSLIST_KEY: [0, 1, 2, 3, 4],
+                                                     TouRateSchedule.RATES_KEY: weekday_demand_rates},
+                                        'weekends': {TouRateSchedule.DAYSLIST_KEY: [5, 6],
+                                                     TouRateSchedule.RATES_KEY: 0.0}}}
+
+        bill_calculator.add_tariff(FixedTariff(dates, 150.0 * scale), str(TariffType.FIX_CUSTOM_CHARGE.value))
+        bill_calculator.add_tariff(TouEnergyChargeTariff(dates, TouRateSchedule(energy_rates)),
+                                   str(TariffType.ENERGY_CUSTOM_CHARGE.value))
+        bill_calculator.add_tariff(TouDemandChargeTariff(dates, TouRateSchedule(demand_rates)),
+                                   str(TariffType.DEMAND_CUSTOM_CHARGE_TOU.value))
+
+    return bill_calculator
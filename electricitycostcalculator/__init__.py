@@ -1,4 +1,25 @@
 __author__ = 'Olivier Van Cutsem'
 
-from electricitycostcalculator import cost_calculator, oadr_signal, openei_tariff
+import importlib
+import sys
+
 __all__ = ["cost_calculator", "oadr_signal", "openei_tariff"]
+
+
+def __getattr__(name):
+    # The subpackages are imported on first access, such that a billing process doesn't load the OpenEI and OpenADR
+    # dependencies (requests, lxml, xbos, ...)
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+
+    raise AttributeError("module '{0}' has no attribute '{1}'".format(__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals().keys()) + __all__)
+
+
+if sys.version_info < (3, 7):
+    # The module __getattr__ (PEP 562) is ignored before Python 3.7: the subpackages are imported here. Their __init__
+    # is empty, the modules that load the dependencies are still imported on demand.
+    from . import cost_calculator, oadr_signal, openei_tariff
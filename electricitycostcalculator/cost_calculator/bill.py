@@ -0,0 +1,400 @@
+__author__ = 'Olivier Van Cutsem'
+
+import numpy as np
+import pandas as pd
+
+from .rate_structure import ChargeType
+from .tariff_structure import intern_mask, get_interned_mask, get_mask_key
+
+# --------------- Bill structure --------------- #
+
+
+class Bill(object):
+    """
+    This class stores the monthly bill of one or several meters in compact arrays, instead of the nested dicts returned
+    by CostCalculator.compute_bill():
+
+     - 'metrics' and 'costs' are arrays of shape (nb_meters, nb_months, nb_labels): the metric of each tariff label and
+     its cost (in $), for each meter and month. The metric is the one of CostCalculator.compute_bill_batch().
+     - 'demand' is a table detailing the DEMAND labels, with one row per meter, month, label and TOU period. It is a
+     dict mapping each of DEMAND_COLUMNS to an array: the positions of the meter, month and label, the price of the
+     period, the position of its mask in 'masks', the max demand and its date.
+     - 'masks' is the list of the daily masks of the TOU periods (lists of bool). The Bill holds the masks themselves,
+     not the ids interned in the process that computed it (see intern_mask), such that it can be pickled and merged
+     in another process, e.g. by compute_bill_portfolio().
+
+    The totals per meter, charge type and label are computed once, the first time they are requested. The bills of
+    different meters are concatenated with Bill.concat(), and to_dict() yields the dict format of compute_bill().
+    """
+
+    DEMAND_COLUMNS = ['meter', 'month', 'label', 'price', 'mask', 'max-demand', 'max-demand-date']
+
+    def __init__(self, meters, months, labels, label_types, metrics, costs, demand=None, masks=None):
+        """
+        Constructor
+        :param meters: a list of the names of the meters
+        :param months: a list of month labels, formatted as "YYYY-MM"
+        :param labels: a list of tariff labels
+        :param label_types: a list of ChargeType, the type of each label
+        :param metrics: an array of shape (nb_meters, nb_months, nb_labels)
+        :param costs: an array of shape (nb_meters, nb_months, nb_labels)
+        :param demand: [optional] the table of the demand periods, as described in the class description
+        :param masks: [optional] the list of the masks referenced by the column 'mask' of 'demand'. If None, this column
+        holds the ids of masks interned in this process (see intern_mask), which are replaced by the masks themselves
+        """
+
+        self.meters = list(meters)
+        self.months = list(months)
+        self.labels = list(labels)
+        self.label_types = list(label_types)
+
+        self.metrics = np.asarray(metrics, dtype=float)
+        self.costs = np.asarray(costs, dtype=float)
+
+        if demand is None:
+            demand = self.empty_demand_table()
+        if masks is None:
+            (demand, masks) = self.get_local_masks(demand)
+        self.demand = demand
+        self.masks = list(masks)
+
+        # The cost of each label for each meter, summed over the months: computed on demand
+        self.__costs_per_label = None
+
+    # --- Totals
+
+    def get_total(self, meter=None):
+        """
+        Return the total cost of the bill
+        :param meter: [optional] the name of a meter. By default, the total over all the meters is returned
+        :return: a float, in $
+        """
+
+        return float(self.__get_costs_per_label(meter).sum())
+
+    def get_total_per_charge_type(self, meter=None):
+        """
+        Return the total cost for each type of charge
+        :param meter: [optional] the name of a meter. By default, the totals over all the meters are returned
+        :return: a dict mapping ChargeType.FIXED, ChargeType.ENERGY and ChargeType.DEMAND to a float, in $
+        """
+
+        costs_per_label = self.__get_costs_per_label(meter)
+
+        ret = {ChargeType.FIXED: 0.0, ChargeType.ENERGY: 0.0, ChargeType.DEMAND: 0.0}
+        for l_i, label_type in enumerate(self.label_types):
+            ret[label_type] += float(costs_per_label[l_i])
+
+        return ret
+
+    def get_total_per_label(self, meter=None):
+        """
+        Return the total cost for each tariff label
+        :param meter: [optional] the name of a meter. By default, the totals over all the meters are returned
+        :return: a dict mapping the labels to a float, in $
+        """
+
+        costs_per_label = self.__get_costs_per_label(meter)
+
+        return {label: float(costs_per_label[l_i]) for l_i, label in enumerate(self.labels)}
+
+    def get_total_per_meter(self):
+        """
+        Return the total cost of each meter
+        :return: a numpy array of float, aligned with 'meters'
+        """
+
+        if self.__costs_per_label is None:
+            self.__costs_per_label = self.costs.sum(axis=1)
+
+        return self.__costs_per_label.sum(axis=1)
+
+    # --- Conversions
+
+    def to_dict(self, meter=None, monthly_detailed=False):
+        """
+        Return the bill of a meter in the format of CostCalculator.compute_bill()
+        :param meter: [optional] the name of the meter. The first meter is considered by default
+        :param monthly_detailed: [optional] if True, the bill is detailed for each month of the calendar
+        :return: a dictionary representing the bill
+        """
+
+        m_i = 0 if meter is None else self.meters.index(meter)
+
+        ret = {}
+        for t_i, month_label in enumerate(self.months):
+            ret[month_label] = {}
+            for l_i, label in enumerate(self.labels):
+                if self.label_types[l_i] == ChargeType.DEMAND:
+                    ret[month_label][label] = {}
+                else:
+                    ret[month_label][label] = (float(self.metrics[m_i, t_i, l_i]), float(self.costs[m_i, t_i, l_i]))
+
+        # The periods of each DEMAND label, merged as in compute_bill(), with the masks interned in this process
+        masks = [get_interned_mask(intern_mask(mask)) for mask in self.masks]
+        masks_index = {}
+        dates = self.demand['max-demand-date']
+        for r_i in np.flatnonzero(self.demand['meter'] == m_i).tolist():
+            month_label = self.months[self.demand['month'][r_i]]
+            label = self.labels[self.demand['label'][r_i]]
+            bill_label = ret[month_label][label]
+
+            new_data = {float(self.demand['price'][r_i]): {'mask': masks[self.demand['mask'][r_i]],
+                                                          'max-demand': self.demand['max-demand'][r_i],
+                                                          'max-demand-date': dates[r_i].to_pydatetime()}}
+            merge_demand_bill(bill_label, masks_index.setdefault((month_label, label), {}), new_data)
+
+        if monthly_detailed is False:  # Aggregate all the months
+            return aggregate_monthly_bill(ret, dict(list(zip(self.labels, self.label_types))))
+        else:
+            return ret
+
+    def to_frame(self):
+        """
+        Return the bill as a table, in the format of CostCalculator.compute_bill_batch()
+        :return: a pandas dataframe with the columns 'meter', 'month', 'label', 'metric' and 'cost'
+        """
+
+        nb_meters = len(self.meters)
+        nb_rows_per_meter = len(self.months) * len(self.labels)
+
+        return pd.DataFrame({'meter': np.repeat(np.asarray(self.meters, dtype=object), nb_rows_per_meter),
+                             'month': np.tile(np.repeat(np.asarray(self.months, dtype=object), len(self.labels)), nb_meters),
+                             'label': np.tile(np.asarray(self.labels, dtype=object), nb_meters * len(self.months)),
+                             'metric': self.metrics.ravel(),
+                             'cost': self.costs.ravel()},
+                            columns=['meter', 'month', 'label', 'metric', 'cost'])
+
+    @staticmethod
+    def from_dict(monthly_bill, type_tariffs_map, meter=0):
+        """
+        Build the Bill of a meter from a bill detailed per month, as returned by CostCalculator.compute_bill()
+        :param monthly_bill: a dict mapping the months ("YYYY-MM") to the bill of each label
+        :param type_tariffs_map: a dict mapping the tariff labels to their ChargeType
+        :param meter: [optional] the name of the meter
+        :return: a Bill object
+        """
+
+        months = sorted(monthly_bill.keys())
+        labels = []
+        for month_label in months:
+            labels += [label for label in list(monthly_bill[month_label].keys()) if label not in labels]
+        label_types = [type_tariffs_map[label] for label in labels]
+
+        metrics = np.zeros((1, len(months), len(labels)))
+        costs = np.zeros((1, len(months), len(labels)))
+        demand_rows = {col: [] for col in Bill.DEMAND_COLUMNS}
+
+        for t_i, month_label in enumerate(months):
+            for l_i, label in enumerate(labels):
+                data = monthly_bill[month_label].get(label)
+                if data is None:
+                    continue
+
+                if label_types[l_i] != ChargeType.DEMAND:
+                    (metrics[0, t_i, l_i], costs[0, t_i, l_i]) = data
+                    continue
+
+                for p, data_demand in list(data.items()):
+                    for col, v in zip(Bill.DEMAND_COLUMNS, (0, t_i, l_i, p, intern_mask(data_demand['mask']),
+                                                            data_demand['max-demand'], data_demand['max-demand-date'])):
+                        demand_rows[col].append(v)
+
+                    costs[0, t_i, l_i] += p * data_demand['max-demand']
+                    metrics[0, t_i, l_i] = max(metrics[0, t_i, l_i], data_demand['max-demand'])
+
+        return Bill([meter], months, labels, label_types, metrics, costs, Bill.build_demand_table(demand_rows))
+
+    @staticmethod
+    def concat(bills):
+        """
+        Concatenate the bills of different meters. The months and labels are the union of those of the bills, with
+        zero metric and cost where a bill doesn't have them.
+        :param bills: a list of Bill objects
+        :return: a Bill object
+        """
+
+        months = sorted(set().union(*[b.months for b in bills]))
+        idx_months = {month_label: t_i for t_i, month_label in enumerate(months)}
+
+        labels = []
+        label_types = []
+        for b in bills:
+            for label, label_type in zip(b.labels, b.label_types):
+                if label not in labels:
+                    labels.append(label)
+                    label_types.append(label_type)
+        idx_labels = {label: l_i for l_i, label in enumerate(labels)}
+
+        nb_meters = sum([len(b.meters) for b in bills])
+        metrics = np.zeros((nb_meters, len(months), len(labels)))
+        costs = np.zeros((nb_meters, len(months), len(labels)))
+
+        meters = []
+        demand_parts = []
+        masks = []
+        idx_masks = {}  # the positions in 'masks', by content
+        for b in bills:
+            map_months = np.array([idx_months[month_label] for month_label in b.months], dtype=int)
+            map_labels = np.array([idx_labels[label] for label in b.labels], dtype=int)
+            sel_meters = slice(len(meters), len(meters) + len(b.meters))
+
+            metrics[sel_meters, map_months[:, None], map_labels[None, :]] = b.metrics
+            costs[sel_meters, map_months[:, None], map_labels[None, :]] = b.costs
+
+            demand = dict(b.demand)
+            demand['meter'] = demand['meter'] + len(meters)
+            demand['month'] = map_months[demand['month']]
+            demand['label'] = map_labels[demand['label']]
+            map_masks = []
+            for mask in b.masks:
+                key = get_mask_key(mask)
+                if key not in idx_masks:
+                    idx_masks[key] = len(masks)
+                    masks.append(mask)
+                map_masks.append(idx_masks[key])
+            demand['mask'] = np.array(map_masks, dtype=int)[demand['mask']]
+            demand_parts.append(demand)
+
+            meters += b.meters
+
+        return Bill(meters, months, labels, label_types, metrics, costs, Bill.concat_demand_tables(demand_parts), masks)
+
+    # --- Demand table
+
+    @staticmethod
+    def empty_demand_table():
+        """
+        Return a demand table without any row
+        :return: a dict mapping each of DEMAND_COLUMNS to an empty array
+        """
+
+        return Bill.build_demand_table({col: [] for col in Bill.DEMAND_COLUMNS})
+
+    @staticmethod
+    def build_demand_table(demand_rows):
+        """
+        Build a demand table from lists of values
+        :param demand_rows: a dict mapping each of DEMAND_COLUMNS to a list, or an array, of values
+        :return: a dict mapping each of DEMAND_COLUMNS to an array
+        """
+
+        return {'meter': np.asarray(demand_rows['meter'], dtype=int),
+                'month': np.asarray(demand_rows['month'], dtype=int),
+                'label': np.asarray(demand_rows['label'], dtype=int),
+                'price': np.asarray(demand_rows['price'], dtype=float),
+                'mask': np.asarray(demand_rows['mask'], dtype=int),
+                'max-demand': np.asarray(demand_rows['max-demand'], dtype=float),
+                'max-demand-date': pd.DatetimeIndex(demand_rows['max-demand-date'])}
+
+    @staticmethod
+    def get_local_masks(demand):
+        """
+        Replace the ids of the masks interned in this process (see intern_mask) by positions in a list of masks
+        :param demand: a demand table, whose column 'mask' holds interned ids
+        :return: a tuple (demand, masks), the demand table with the positions in the list of masks 'masks'
+        """
+
+        (mask_ids, idx_masks) = np.unique(demand['mask'], return_inverse=True)
+        demand = dict(demand, mask=idx_masks.reshape(-1).astype(int))
+
+        return demand, [get_interned_mask(int(mask_id)) for mask_id in mask_ids]
+
+    @staticmethod
+    def concat_demand_tables(demand_tables):
+        """
+        Concatenate demand tables
+        :param demand_tables: a list of dicts mapping each of DEMAND_COLUMNS to an array
+        :return: a dict mapping each of DEMAND_COLUMNS to an array
+        """
+
+        if len(demand_tables) == 0:
+            return Bill.empty_demand_table()
+
+        ret = {col: np.concatenate([d[col] for d in demand_tables]) for col in Bill.DEMAND_COLUMNS[:-1]}
+        ret['max-demand-date'] = demand_tables[0]['max-demand-date'].append([d['max-demand-date'] for d in demand_tables[1:]])
+
+        return ret
+
+    # --- private
+
+    def __get_costs_per_label(self, meter):
+        """
+        Return the cost of each label, summed over the months, for a meter or for all of them
+        """
+
+        if self.__costs_per_label is None:
+            self.__costs_per_label = self.costs.sum(axis=1)
+
+        if meter is None:
+            return self.__costs_per_label.sum(axis=0)
+        else:
+            return self.__costs_per_label[self.meters.index(meter)]
+
+    def __len__(self):
+        return len(self.meters)
+
+
+# --------------- Demand bill merging --------------- #
+
+
+def get_demand_masks_index(demand_bill):
+    """
+    Index a demand bill by mask
+    :param demand_bill: a dict mapping the prices to a dict (mask, max-demand, max-demand-date)
+    :return: a dict mapping the interned id of each mask (see intern_mask) to its price in 'demand_bill'
+    """
+
+    return {intern_mask(data['mask']): p for p, data in list(demand_bill.items())}
+
+
+def merge_demand_bill(demand_bill, masks_index, new_data):
+    """
+    Merge the demand data 'new_data' into 'demand_bill', applying MAX on the entries that share the same mask.
+    :param demand_bill: a dict mapping the prices to a dict (mask, max-demand, max-demand-date), updated in place
+    :param masks_index: the mask index of 'demand_bill', as returned by get_demand_masks_index(), updated in place
+    :param new_data: a dict formatted as 'demand_bill'
+    :return: /
+    """
+
+    for p, data in list(new_data.items()):  # For each price -> dict (mask, max-p, date-max-p)
+        this_mask_id = intern_mask(data['mask'])  # get the new data mask
+        existing_mask_price = masks_index.get(this_mask_id)
+
+        if existing_mask_price is not None:  # this mask has already been seen: APPLY MAX
+            if not data['max-demand'] > demand_bill[existing_mask_price]['max-demand']:
+                continue
+            del demand_bill[existing_mask_price]
+
+        # This is the first time this mask has been seen, or its demand is higher: store it
+        if p in demand_bill:  # another mask with the same price is overwritten
+            del masks_index[intern_mask(demand_bill[p]['mask'])]
+        demand_bill[p] = data
+        masks_index[this_mask_id] = p
+
+
+def aggregate_monthly_bill(monthly_bill, type_tariffs_map):
+    """
+    Aggregate a bill detailed per month into a single bill, in place: SUM for the ENERGY and FIX labels, MAX for the
+    DEMAND labels
+    :param monthly_bill: a dict mapping the months to the bill of each label, as returned by CostCalculator.compute_bill()
+    :param type_tariffs_map: a dict mapping the tariff labels to their ChargeType
+    :return: the aggregated bill of each label
+    """
+
+    data_merge = None
+    masks_index = {}  # for each demand label of data_merge, its mask index
+    for m, data_per_label in list(monthly_bill.items()):
+        if data_merge is None:
+            data_merge = data_per_label
+        else:
+            for label_tariff, data_tariff in list(data_per_label.items()):
+                if type_tariffs_map[label_tariff] == ChargeType.DEMAND:  # take max
+                    if label_tariff not in masks_index:
+                        masks_index[label_tariff] = get_demand_masks_index(data_merge[label_tariff])
+                    merge_demand_bill(data_merge[label_tariff], masks_index[label_tariff], data_tariff)
+                else:  # sum
+                    data_merge[label_tariff] = (data_merge[label_tariff][0] + data_tariff[0],
+                                                data_merge[label_tariff][1] + data_tariff[1])
+
+    return data_merge
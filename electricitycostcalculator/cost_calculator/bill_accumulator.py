@@ -0,0 +1,266 @@
+__author__ = 'Olivier Van Cutsem'
+
+import numpy as np
+import pandas as pd
+
+from .rate_structure import ChargeType
+from .tariff_structure import TariffBase, FixedTariff, TouDemandChargeTariff, TouEnergyChargeTariff
+from .timestamp_features import TimestampFeatures
+
+# --------------- Incremental billing --------------- #
+
+
+class BillAccumulator(object):
+    """
+    This class computes the bill of a meter incrementally, from data received in chunks (e.g. daily drops of AMI data,
+    or a chunked CSV reader), using the tariff blocks of a CostCalculator.
+
+    For each label, tariff block and month, it keeps running accumulators:
+     - ENERGY: the sum of the energy and of the cost. The energy consumed in the previous chunks of the month sets
+     the tiers of the BlockRates
+     - DEMAND: for each TOU period, the max demand, its date and its price. With a demand window, the last intervals
+     of the chunk are also kept (see TouDemandChargeTariff.get_window_tail()): the windows go on with the next chunk
+     of the month, as if the data was received at once
+     - FIX: the first and last dates seen, that define the number of billed days
+
+    The duration of the intervals (to convert the energy into power) is inferred once, from the first chunks holding
+    at least 2 distinct dates, and used for all the later chunks: a chunk of a single row is billed as the rest of the
+    data. Until it is known, the chunks are kept as they are.
+
+    At any point, get_bill() returns the same output as CostCalculator.compute_bill() on all the data received so far,
+    provided the chunks don't overlap, have the same resolution and, with a demand window, are received in
+    chronological order.
+    """
+
+    def __init__(self, bill_calculator, column_data=None):
+        """
+        Constructor
+        :param bill_calculator: a CostCalculator object, holding the tariff blocks
+        :param column_data: [optional] the label of the column containing the energy consumption values in the
+        chunks, see CostCalculator.compute_bill()
+        """
+
+        self.bill_calculator = bill_calculator
+        self.column_data = column_data
+
+        # For each label: the id of the blocks -> (block, {month -> accumulator})
+        self.__acc = {}
+
+        # The first and last date received
+        self.__first_date = None
+        self.__last_date = None
+
+        # The duration of the intervals, in hours, and the data received before it is known
+        self.__interval_hours = None
+        self.__pending = None
+
+        # The last intervals of the windowed demand blocks: (id of the block, month) -> (context, pending) Series
+        self.__windows = {}
+
+    def update(self, df):
+        """
+        Add a chunk of data to the bill
+        :param df: a pandas dataframe (or Series) containing energy consumption (in Wh), see CostCalculator.compute_bill()
+        :return: /
+        """
+
+        if len(df) == 0:
+            return
+
+        if not df.index.is_monotonic_increasing:
+            df = df.sort_index()
+
+        if self.__first_date is None or df.index[0] < self.__first_date:
+            self.__first_date = df.index[0]
+        if self.__last_date is None or df.index[-1] > self.__last_date:
+            self.__last_date = df.index[-1]
+
+        if self.__interval_hours is None:
+            if self.__pending is not None:
+                df = pd.concat([self.__pending, df]).sort_index(kind='mergesort')
+
+            features = TimestampFeatures(df.index)
+            if features.interval_hours is None:  # a single date so far: wait for the next chunks
+                self.__pending = df
+                return
+
+            self.__interval_hours = features.interval_hours
+            self.__pending = None
+        else:
+            features = TimestampFeatures(df.index, interval_hours=self.__interval_hours)  # shared by all the labels and blocks
+
+        date_index = df.index
+        values = TariffBase.get_data_values(df, self.column_data)
+
+        # The data of a block is selected on the local dates (see TariffBase.get_window_slice()), while the blocks are
+        # selected on the dates in UTC (see CostCalculator.get_tariff_struct()): the candidate blocks are taken a day
+        # around the chunk, and each block holding data of the chunk is accumulated. get_bill() merges the ones that
+        # compute_bill() selects for all the data received.
+        date_range = (date_index[0] - pd.Timedelta(days=1), date_index[-1] + pd.Timedelta(days=1))
+
+        for label in list(self.bill_calculator.type_tariffs_map.keys()):
+            acc_label = self.__acc.setdefault(label, {})
+
+            for tariff_block in self.bill_calculator.get_tariff_struct(label, date_range):
+                (idx_start, idx_end) = tariff_block.get_window_slice(date_index)
+                if idx_start >= idx_end:
+                    continue
+
+                (block, acc_block) = acc_label.setdefault(id(tariff_block), (tariff_block, {}))
+                for (month_label, idx_month_start, idx_month_end) in features.slice(idx_start, idx_end).get_monthly_slices():
+                    idx_month_start += idx_start
+                    idx_month_end += idx_start
+                    self.__update_month(block, acc_block, month_label,
+                                        pd.Series(values[idx_month_start:idx_month_end], index=date_index[idx_month_start:idx_month_end]),
+                                        features.slice(idx_month_start, idx_month_end))
+
+    def get_bill(self, monthly_detailed=False):
+        """
+        Return the bill of all the data received so far, formatted as the output of CostCalculator.compute_bill()
+        :param monthly_detailed: [optional] if True, the bill is detailed for each month of the calendar
+        :return: a dictionary representing the bill
+        """
+
+        ret = {}
+
+        if self.__first_date is None:
+            return ret
+
+        if self.__pending is not None:  # the duration of the intervals isn't known yet: bill the data as it is
+            return self.bill_calculator.compute_bill(self.__pending, self.column_data, monthly_detailed)
+
+        # Initialize the returned structure, and the mask index of each demand bill, kept along the merges
+        masks_index = {}
+        for month_label in self.bill_calculator.get_billing_months(self.__first_date, self.__last_date):
+            ret[month_label] = {}
+            masks_index[month_label] = {}
+            for label in list(self.bill_calculator.type_tariffs_map.keys()):
+                if self.bill_calculator.type_tariffs_map[label] == ChargeType.DEMAND:
+                    ret[month_label][label] = {}
+                    masks_index[month_label][label] = {}
+                else:
+                    ret[month_label][label] = (0, 0)
+
+        # Merge the blocks of compute_bill(), in the same order
+        for label, acc_label in list(self.__acc.items()):
+            for tariff_block in self.bill_calculator.get_tariff_struct(label, (self.__first_date, self.__last_date)):
+                if id(tariff_block) not in acc_label:
+                    continue
+
+                (block, acc_block) = acc_label[id(tariff_block)]
+                for month_label in sorted(acc_block.keys()):
+                    acc_month = acc_block[month_label]
+                    window = self.__windows.get((id(block), month_label))
+                    if window is not None and len(window[1]) > 0:  # bill the last window as it is so far
+                        acc_month = {p: dict(data) for p, data in list(acc_month.items())}
+                        self.__update_demand(block, acc_month, pd.concat(window), len(window[0]))
+
+                    self.bill_calculator.update_bill_structure(ret[month_label], label,
+                                                               self.__get_monthly_bill(block, acc_month),
+                                                               masks_index[month_label].get(label))
+
+        if monthly_detailed is False:  # Aggregate all the months
+            return self.bill_calculator.aggregate_monthly_bill(ret)
+        else:
+            return ret
+
+    # --- private
+
+    def __update_month(self, block, acc_block, month_label, data_month, features_month):
+        """
+        Update the accumulator of a block for a month, with the data of this month in a chunk
+        """
+
+        acc_month = acc_block.get(month_label)
+
+        if isinstance(block, FixedTariff):  # keep the first and last dates
+            if acc_month is None:
+                acc_block[month_label] = (data_month.index[0], data_month.index[-1])
+            else:
+                acc_block[month_label] = (min(acc_month[0], data_month.index[0]), max(acc_month[1], data_month.index[-1]))
+
+        elif isinstance(block, TouDemandChargeTariff):  # keep the max of each period
+            if acc_month is None:
+                acc_month = acc_block[month_label] = {}
+
+            # The last intervals of the previous chunk of the month go on in the windows of this one
+            window_key = (id(block), month_label)
+            (context, pending) = self.__windows.pop(window_key, (data_month.iloc[:0], data_month.iloc[:0]))
+            nb_context = len(context)
+            if nb_context + len(pending) > 0:
+                data_month = pd.concat([context, pending, data_month])
+                features_month = TimestampFeatures(data_month.index, interval_hours=self.__interval_hours)
+
+            (idx_context, idx_pending) = block.get_window_tail(data_month.index, features_month)
+            if idx_pending > nb_context:
+                self.__update_demand(block, acc_month, data_month.iloc[:idx_pending], nb_context,
+                                     features_month.slice(0, idx_pending))
+            if idx_context < len(data_month):
+                self.__windows[window_key] = (data_month.iloc[idx_context:idx_pending], data_month.iloc[idx_pending:])
+
+        elif isinstance(block, TouEnergyChargeTariff):  # sum the energy and the cost
+            energy_before = None if acc_month is None else np.array([acc_month[0]])
+            (energy, cost) = block.compute_monthly_bill_matrix(data_month.index, data_month.values.reshape(-1, 1),
+                                                               features_month, energy_before)
+            if acc_month is None:
+                acc_block[month_label] = (energy[0], cost[0])
+            else:
+                acc_block[month_label] = (acc_month[0] + energy[0], acc_month[1] + cost[0])
+
+        else:  # sum the metric and the cost
+            (metric, cost) = block.compute_monthly_bill(data_month, features=features_month)
+            if acc_month is None:
+                acc_block[month_label] = (metric, cost)
+            else:
+                acc_block[month_label] = (acc_month[0] + metric, acc_month[1] + cost)
+
+    def __update_demand(self, block, acc_month, data_month, nb_context=0, features_month=None):
+        """
+        Update the max demand of each TOU period of a block for a month, with the data of this month in a chunk. The
+        first 'nb_context' intervals were billed already, and only start the demand windows.
+        """
+
+        if features_month is None:
+            features_month = TimestampFeatures(data_month.index, interval_hours=self.__interval_hours)
+
+        max_per_set = block.compute_monthly_bill_matrix(data_month.index, data_month.values.reshape(-1, 1), features_month,
+                                                        nb_context)
+        for p, data in list(max_per_set.items()):
+            if np.isnan(data['max-demand'][0]):  # no data in this period
+                continue
+
+            # The price of a tiered period depends on its max demand only: it is kept along with the max.
+            # The mask is the one of the first day the period occurs: keep the one of the earliest chunk
+            data = {'mask': data['mask'],
+                    'max-demand': data['max-demand'][0],
+                    'max-demand-date': data['max-demand-date'][0].to_pydatetime(),
+                    'price': float(data['price'][0]) if 'price' in data else p,
+                    'first-date': data_month.index[0]}
+
+            if p not in acc_month:
+                acc_month[p] = data
+                continue
+
+            acc_p = acc_month[p]
+            if data['max-demand'] > acc_p['max-demand'] or \
+                    (data['max-demand'] == acc_p['max-demand'] and data['max-demand-date'] < acc_p['max-demand-date']):
+                acc_p['max-demand'] = data['max-demand']
+                acc_p['max-demand-date'] = data['max-demand-date']
+                acc_p['price'] = data['price']
+            if data['first-date'] < acc_p['first-date']:
+                acc_p['mask'] = data['mask']
+                acc_p['first-date'] = data['first-date']
+
+    @staticmethod
+    def __get_monthly_bill(block, acc_month):
+        """
+        Return the monthly bill of a block, as returned by its compute_monthly_bill(), from its accumulator
+        """
+
+        if isinstance(block, FixedTariff):
+            return block.compute_fixed_bill(pd.DatetimeIndex([acc_month[0], acc_month[1]]))
+        elif isinstance(block, TouDemandChargeTariff):
+            return {data['price']: {'mask': data['mask'], 'max-demand': data['max-demand'], 'max-demand-date': data['max-demand-date']}
+                    for p, data in list(acc_month.items())}
+        else:
+            return acc_month
@@ -0,0 +1,169 @@
+__author__ = 'Olivier Van Cutsem'
+
+import numpy as np
+import pandas as pd
+import pytz
+
+# --------------- Tariff blocks index --------------- #
+
+
+class TariffBlockIndex(object):
+    """
+    This class indexes a list of "tariff blocks" (TariffBase objects) by their validity period [startdate, enddate].
+
+    The blocks are kept in their insertion order, and sorted by starting date in arrays of timestamps, such that the
+    blocks effective over a period are found with binary searches. The sorted arrays are (re)built lazily, the first
+    time the index is queried after blocks have been added: adding many blocks at once costs a single sort.
+
+    Remark: naive dates (both for the blocks and the queries) are considered to be in UTC.
+    """
+
+    def __init__(self, blocks=None):
+        """
+        Constructor
+        :param blocks: [optional] a list of TariffBase objects to index
+        """
+
+        self.__blocks = []  # In insertion order
+
+        # Sorted arrays, built on demand
+        self.__sorted_pos = None  # the position in self.__blocks of the blocks, sorted by starting date
+        self.__starts = None  # the sorted starting dates, as timestamps
+        self.__ends = None  # the ending dates, in the same order
+        self.__max_ends = None  # the running max of self.__ends
+
+        if blocks is not None:
+            self.extend(blocks)
+
+    def add(self, block):
+        """
+        Add a tariff block to the index
+        :param block: a TariffBase object
+        :return: /
+        """
+
+        self.__blocks.append(block)
+        self.__sorted_pos = None
+
+    def extend(self, blocks):
+        """
+        Add several tariff blocks to the index at once
+        :param blocks: a list of TariffBase objects
+        :return: /
+        """
+
+        self.__blocks.extend(blocks)
+        self.__sorted_pos = None
+
+    def query(self, start_sel, end_sel):
+        """
+        Return the blocks that are effective over the period [start_sel, end_sel]
+        :param start_sel: a datetime
+        :param end_sel: a datetime
+        :return: a list of TariffBase objects, in their insertion order
+        """
+
+        self.build()
+
+        ts_start = self.to_timestamp(start_sel)
+        ts_end = self.to_timestamp(end_sel)
+
+        # The candidates start before the end of the period: among them, skip the first ones that end too early
+        idx_last = np.searchsorted(self.__starts, ts_end, side='right')
+        idx_first = np.searchsorted(self.__max_ends[:idx_last], ts_start, side='left')
+
+        idx_hits = idx_first + np.flatnonzero(self.__ends[idx_first:idx_last] >= ts_start)
+
+        return [self.__blocks[pos] for pos in np.sort(self.__sorted_pos[idx_hits]).tolist()]
+
+    def query_point(self, date):
+        """
+        Return the blocks that are effective at a given date
+        :param date: a datetime
+        :return: a list of TariffBase objects, in their insertion order
+        """
+
+        return self.query(date, date)
+
+    def query_first(self, starts, ends):
+        """
+        For each period [starts[i], ends[i]], return the position of the first block (in insertion order) that is
+        effective over it
+        :param starts: a numpy array of POSIX timestamps, see to_timestamps()
+        :param ends: a numpy array of POSIX timestamps, aligned with 'starts'
+        :return: a numpy array of int, the position of the block in 'blocks' for each period, -1 if there is none
+        """
+
+        self.build()
+
+        ret = np.full(len(starts), -1, dtype=int)
+        if len(starts) == 0 or len(self.__blocks) == 0:
+            return ret
+
+        # The candidates over the whole span of the periods
+        idx_last = np.searchsorted(self.__starts, np.max(ends), side='right')
+        idx_first = np.searchsorted(self.__max_ends[:idx_last], np.min(starts), side='left')
+        idx_hits = idx_first + np.flatnonzero(self.__ends[idx_first:idx_last] >= np.min(starts))
+
+        # The first blocks are assigned last, so that they take precedence
+        for idx in idx_hits[np.argsort(self.__sorted_pos[idx_hits])[::-1]]:
+            ret[(self.__starts[idx] <= ends) & (self.__ends[idx] >= starts)] = self.__sorted_pos[idx]
+
+        return ret
+
+    @property
+    def blocks(self):
+        """
+        The list of the indexed blocks, in their insertion order
+        """
+
+        return self.__blocks
+
+    def __len__(self):
+        return len(self.__blocks)
+
+    def __iter__(self):
+        return iter(self.__blocks)
+
+    @staticmethod
+    def to_timestamp(date):
+        """
+        Convert a datetime to a POSIX timestamp, considering naive dates as UTC
+        :param date: a datetime or a pandas Timestamp
+        :return: a float
+        """
+
+        if date.tzinfo is None:
+            date = date.replace(tzinfo=pytz.timezone('UTC'))
+
+        return date.timestamp()
+
+    @staticmethod
+    def to_timestamps(date_index):
+        """
+        Vectorized version of to_timestamp(), for a pandas DatetimeIndex
+        :param date_index: a pandas DatetimeIndex
+        :return: a numpy array of float
+        """
+
+        if date_index.tz is not None:
+            date_index = date_index.tz_convert(None)
+
+        return np.asarray((date_index - pd.Timestamp(0)) / pd.Timedelta(seconds=1), dtype=float)
+
+    def build(self):
+        """
+        Build the sorted arrays of the index, if blocks have been added since the last build
+        :return: /
+        """
+
+        if self.__sorted_pos is not None:
+            return
+
+        starts = np.array([self.to_timestamp(b.startdate) for b in self.__blocks], dtype=float)
+        ends = np.array([self.to_timestamp(b.enddate) for b in self.__blocks], dtype=float)
+
+        self.__sorted_pos = np.argsort(starts, kind='mergesort')
+        self.__starts = starts[self.__sorted_pos]
+        self.__ends = ends[self.__sorted_pos]
+        self.__max_ends = np.maximum.accumulate(self.__ends) if len(self.__ends) > 0 else self.__ends
@@ -0,0 +1,186 @@
+__author__ = 'Olivier Van Cutsem'
+
+import io
+import hashlib
+import mmap
+import os
+import pickle
+import struct
+
+import numpy as np
+
+from .day_calendar import HolidayCalendar, get_holiday_calendar
+from .instrumentation import instrumented
+
+# --------------- Compiled tariff files --------------- #
+
+# A compiled tariff file stores a fully built CostCalculator, such that it can be loaded without parsing the tariff
+# sources nor building the tariff blocks and rate schedules again. It is made of:
+#  - a fixed-size preamble, read without unpickling anything: MAGIC, the format version (uint32), the SHA-256 of the
+#    key of the sources the tariff was built from (64 hexadecimal characters, blank without key) and the size of the
+#    header (uint64)
+#  - a small pickled header: the layout of the arrays and the pickled calculator, where the numpy arrays (compiled rate
+#    tables, blocks indexes, ...) are replaced by references
+#  - the data of the arrays, each one aligned on ARRAY_ALIGNMENT bytes, that are memory-mapped when the file is loaded
+# The process-wide holiday calendars (see get_holiday_calendar) are stored by reference, and shared again on loading.
+
+MAGIC = b'ECCTARIF'
+COMPILED_FORMAT_VERSION = 4
+COMPILED_EXTENSION = '.ecct'
+
+ARRAY_ALIGNMENT = 64
+
+_PREAMBLE = struct.Struct('<8sI64sQ')
+
+
+class _CompiledTariffPickler(pickle.Pickler):
+    """
+    Pickle a CostCalculator, moving its numpy arrays out of the pickle
+    """
+
+    def __init__(self, file):
+        super(_CompiledTariffPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.arrays = []  # the contiguous arrays, in the order of their references
+        self.__ids_by_obj = {}  # id(array) -> index in self.arrays
+        self.__ids_by_content = {}  # (dtype, shape, digest) -> index in self.arrays, arrays with the same data are stored once
+        self.__kept = []  # the pickled arrays are kept alive, such that their ids stay unique
+
+    def persistent_id(self, obj):
+        if isinstance(obj, np.ndarray) and obj.dtype != object:
+            array_id = self.__ids_by_obj.get(id(obj))
+            if array_id is None:
+                data = np.ascontiguousarray(obj)
+                key = (data.dtype.str, data.shape, hashlib.sha1(data.tobytes()).hexdigest())
+                array_id = self.__ids_by_content.get(key)
+                if array_id is None:
+                    array_id = self.__ids_by_content[key] = len(self.arrays)
+                    self.arrays.append(data)
+                self.__ids_by_obj[id(obj)] = array_id
+                self.__kept.append(obj)
+            return 'array', array_id
+
+        if isinstance(obj, HolidayCalendar):
+            key = (obj.country, obj.state, obj.holiday_day_type)
+            if get_holiday_calendar(*key) is obj:
+                return ('calendar',) + key
+
+        return None
+
+
+class _CompiledTariffUnpickler(pickle.Unpickler):
+    """
+    Unpickle a CostCalculator, resolving the references to the arrays and the shared holiday calendars
+    """
+
+    def __init__(self, file, arrays):
+        super(_CompiledTariffUnpickler, self).__init__(file)
+        self.arrays = arrays
+
+    def persistent_load(self, pid):
+        if pid[0] == 'array':
+            return self.arrays[pid[1]]
+        elif pid[0] == 'calendar':
+            return get_holiday_calendar(*pid[1:])
+
+        raise pickle.UnpicklingError("Unknown reference in the compiled tariff: {0}".format(pid))
+
+
+def save_compiled_tariff(bill_calculator, filename, source_key=None):
+    """
+    Store a CostCalculator in a compiled tariff file. Its rate schedules and blocks indexes are compiled first.
+    The file is written atomically: a process loading it concurrently sees either the old or the new version.
+    :param bill_calculator: a CostCalculator object
+    :param filename: the path of the compiled file
+    :param source_key: [optional] a string identifying the sources the tariff was built from, see load_compiled_tariff()
+    :return: /
+    """
+
+    bill_calculator.compile()
+
+    calculator_file = io.BytesIO()
+    pickler = _CompiledTariffPickler(calculator_file)
+    pickler.dump(bill_calculator)
+
+    # The layout of the arrays data, relative to its (aligned) start
+    layout = []
+    offset = 0
+    for data in pickler.arrays:
+        layout.append((data.dtype.str, data.shape, offset))
+        offset += -(-data.nbytes // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+    header = pickle.dumps({'arrays': layout,
+                           'calculator': calculator_file.getvalue()}, protocol=pickle.HIGHEST_PROTOCOL)
+
+    data_start = -(-(_PREAMBLE.size + len(header)) // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+
+    tmp_filename = '{0}.{1}.tmp'.format(filename, os.getpid())
+    with open(tmp_filename, 'wb') as output_file:
+        output_file.write(_PREAMBLE.pack(MAGIC, COMPILED_FORMAT_VERSION, get_source_digest(source_key), len(header)))
+        output_file.write(header)
+        for data, (dtype, shape, data_offset) in zip(pickler.arrays, layout):
+            output_file.seek(data_start + data_offset)
+            output_file.write(data.tobytes())
+        output_file.truncate(data_start + offset)
+
+    os.replace(tmp_filename, filename)
+
+
+def get_source_digest(source_key):
+    """
+    Return the digest of the key of the sources stored in the preamble of a compiled tariff file
+    :param source_key: a string, or None
+    :return: 64 bytes: the hexadecimal SHA-256 of the key, or blanks if there is no key
+    """
+
+    if source_key is None:
+        return b' ' * 64
+
+    return hashlib.sha256(source_key.encode()).hexdigest().encode()
+
+
+@instrumented('load_compiled_tariff')
+def load_compiled_tariff(filename, source_key=None, use_mmap=True):
+    """
+    Load a CostCalculator from a compiled tariff file
+    :param filename: the path of the compiled file
+    :param source_key: [optional] if specified, the file is only loaded if it has been built from the sources with this
+    key, e.g. a hash of the tariff JSON
+    :param use_mmap: [optional] if True, the arrays are memory-mapped from the file (read-only). They are read in
+    memory otherwise.
+    :return: a CostCalculator object, or None if the file doesn't exist, is outdated or has been built from other sources
+    """
+
+    if not os.path.exists(filename):
+        return None
+
+    with open(filename, 'rb') as input_file:
+        preamble = input_file.read(_PREAMBLE.size)
+        if len(preamble) < _PREAMBLE.size:
+            return None
+
+        # The file is only unpickled if it is a compiled tariff of this version, built from the expected sources
+        (magic, version, source_digest, header_size) = _PREAMBLE.unpack(preamble)
+        if magic != MAGIC or version != COMPILED_FORMAT_VERSION:
+            return None
+        if source_key is not None and source_digest != get_source_digest(source_key):
+            return None
+
+        header = pickle.loads(input_file.read(header_size))
+
+        if use_mmap:
+            buffer = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            input_file.seek(0)
+            buffer = input_file.read()
+
+    data_start = -(-(_PREAMBLE.size + header_size) // ARRAY_ALIGNMENT) * ARRAY_ALIGNMENT
+    arrays = []
+    for (dtype, shape, data_offset) in header['arrays']:
+        count = int(np.prod(shape))
+        if count == 0:
+            arrays.append(np.empty(shape, dtype=np.dtype(dtype)))
+        else:
+            arrays.append(np.frombuffer(buffer, dtype=np.dtype(dtype), count=count, offset=data_start + data_offset).reshape(shape))
+
+    return _CompiledTariffUnpickler(io.BytesIO(header['calculator']), arrays).load()
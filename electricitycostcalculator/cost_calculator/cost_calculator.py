@@ -1,12 +1,25 @@
 __author__ = 'Olivier Van Cutsem'
 
 from .rate_structure import *
-from .tariff_structure import TariffType
+from .tariff_structure import TariffType, TimeOfUseTariff, intern_mask
+from .bill import Bill, aggregate_monthly_bill, get_demand_masks_index, merge_demand_bill
+from .block_index import TariffBlockIndex
+from .price_cache import PriceSignalCache
+from .lp_coefficients import LPCostCoefficients, build_incidence_matrix
+from .instrumentation import instrument
+from .timestamp_features import TimestampFeatures, get_timestamp_features
+from .scenarios import ScenarioEvaluator
 from dateutil.relativedelta import relativedelta
+import hashlib
+import numpy as np
 import pandas as pd
 import pytz
 
 
+# The number of months billed at once by compute_bill() in low memory mode
+LOW_MEMORY_CHUNK_MONTHS = 1
+
+
 class CostCalculator(object):
     """
     This class is used to manipulate the building electricity cost:
@@ -32,12 +45,14 @@ class CostCalculator(object):
                           str(TariffType.PDP_DEMAND_CREDIT.value): ChargeType.DEMAND,
                           }
 
-    def __init__(self, type_tariffs_map=None):
+    def __init__(self, type_tariffs_map=None, price_cache=None):
         """
         Initialize the class instance
 
         :param type_tariffs_map: [optional] a dictionary that map the main type of tariffs used to describe the whole
         billing logic to their type. DEFAULT_TARIFF_TYPE_LIST is used if type_tariffs_list is not specified.
+        :param price_cache: [optional] the PriceSignalCache memoizing the price signals, that can be shared by several
+        calculators. A new one is created by default.
 
         Note: the method 'add_tariff' is used to build the core "tariff_structure" object structure.
         """
@@ -54,6 +69,11 @@ class CostCalculator(object):
         for label, type_tariff in list(self.type_tariffs_map.items()):
             self.__tariffstructures[label] = self.generate_type_tariff(type_tariff)
 
+        # The memoized price signals
+        if price_cache is None:
+            price_cache = PriceSignalCache()
+        self.price_cache = price_cache
+
         # Useful data about the tariff
         self.tariff_min_kw = 0  # The minimum peak demand to stay in this tariff
         self.tariff_max_kw = float('inf')  # The maximum peak demand to stay in this tariff
@@ -63,7 +83,7 @@ class CostCalculator(object):
 
     # --- Useful methods
 
-    def compute_bill(self, df, column_data=None, monthly_detailed=False):
+    def compute_bill(self, df, column_data=None, monthly_detailed=False, as_bill=False, low_memory=False):
         """
         #TODO: create a class for the bill !
 
@@ -97,39 +117,180 @@ class CostCalculator(object):
         :param column_data: [optional] the label of the column containing the energy consumption values
         :param monthly_detailed: [optional] if False, it is assumed that the df contains values for ONE billing period.
         if True, the bill is detailed for each month of the calendar. Set to False by default.
+        :param as_bill: [optional] if True, the monthly bill is returned as a Bill object, see bill.Bill, and
+        'monthly_detailed' is ignored. Set to False by default.
+        :param low_memory: [optional] if True, the data is billed by chunks of LOW_MEMORY_CHUNK_MONTHS months, such that
+        the memory used by the intermediate arrays doesn't grow with the length of the data, e.g. for years of 1-min
+        data. The timestamp features are not kept for the next bills. Set to False by default.
         :return: a dictionary representing the bill as described above
         """
 
-        ret = {}
+        with instrument('CostCalculator.compute_bill', rows=len(df)):
+            ret = {}
+
+            if not df.index.is_monotonic_increasing:
+                df = df.sort_index()
+
+            # Initialize the returned structure, and the mask index of each demand bill, kept along the merges
+            masks_index = {}
+            for month_label in self.get_billing_months(df.index[0], df.index[-1]):
+                ret[month_label] = {}
+                masks_index[month_label] = {}
+                for k in list(self.__tariffstructures.keys()):
+                    if self.type_tariffs_map[k] == ChargeType.DEMAND:
+                        ret[month_label][k] = {}  # a dict of price -> (max, cost)
+                        masks_index[month_label][k] = {}
+                    else:
+                        ret[month_label][k] = (0, 0)  # a tuple
+
+            # The timestamps are decomposed once for all the labels and blocks, and for the next bills on this index.
+            # In low memory mode, each chunk of months is decomposed and billed in turn: a month is in a single chunk.
+            # Otherwise, the index is billed as it is: its features are found by get_timestamp_features() by its id.
+            if low_memory:
+                chunks = [df.iloc[idx_chunk_start:idx_chunk_end]
+                          for (idx_chunk_start, idx_chunk_end) in self.get_monthly_chunks(df.index, LOW_MEMORY_CHUNK_MONTHS)]
+            else:
+                chunks = [df]
+
+            for df_chunk in chunks:
+                features = TimestampFeatures(df_chunk.index) if low_memory else get_timestamp_features(df_chunk.index)
+
+                # Compute the bill for each of the tariff type, for each month
+                for label, tariff_data in list(self.__tariffstructures.items()):
+                    l_blocks = self.get_tariff_struct(label, (df_chunk.index[0], df_chunk.index[-1]))  # get all the tariff blocks for this period and this tariff type
+                    with instrument('CostCalculator.compute_bill_label', label=label, rows=len(df_chunk)):
+                        for tariff_block in l_blocks:
+                            tariff_cost_list = tariff_block.compute_bill(df_chunk, column_data, features)  # this returns a dict of time-period pointing to tuple that contains both the metric of the bill and the cost
+                            for time_label, bill_data in list(tariff_cost_list.items()):
+                                self.update_bill_structure(ret[time_label], label, bill_data,
+                                                           masks_index[time_label].get(label))
+
+            if as_bill:
+                return Bill.from_dict(ret, self.type_tariffs_map, meter=column_data)
+            elif monthly_detailed is False:  # Aggregate all the months
+                return self.aggregate_monthly_bill(ret)
+            else:
+                return ret
 
-        # Initialize the returned structure
+    def compute_bill_batch(self, data, date_index=None, columns=None, as_bill=False, low_memory=False):
+        """
+        Compute the bill of many meters sharing the same time index. The timestamps are decomposed once, and each tariff
+        block bills all the meters in the same vectorized pass.
+
+        The bill is detailed for each month of the calendar and returned as a table, with one row per meter, month and
+        tariff label:
+
+            meter | month ("YY-MM") | label | metric | cost (in $)
+
+        where the metric is the total energy or the number of days for the ENERGY and FIX tariffs (see compute_bill),
+        and the maximum demand over the periods of the month for the DEMAND tariffs. The cost of a DEMAND tariff is
+        the sum, over its periods, of the price of the period times the corresponding maximum demand. As in compute_bill(),
+        whose DEMAND bill is keyed by price, two periods with the same price but different masks in a month (e.g. from
+        two tariff blocks) are not both billed: the last one stored is kept, see merge_demand_bill().
+
+        :param data: a pandas dataframe whose columns contain the energy consumption (in Wh) of each meter, or a 2-D
+        numpy array of shape (nb_dates, nb_meters)
+        :param date_index: [optional] the pandas DatetimeIndex of the rows of 'data', if it is a numpy array
+        :param columns: [optional] the columns of the dataframe to bill, all by default. If 'data' is a numpy array,
+        the names of its columns (their position by default)
+        :param as_bill: [optional] if True, a Bill object is returned instead of the table, that also details the
+        periods of the DEMAND tariffs. Set to False by default.
+        :param low_memory: [optional] if True, the data is billed by chunks of months, see compute_bill(). The float32
+        data is then billed as is instead of being converted to float64: the max demands are taken in float32 and the
+        sums are accumulated in float64. Set to False by default.
+        :return: a pandas dataframe with the columns 'meter', 'month', 'label', 'metric' and 'cost', or a Bill object
+        """
 
-        t_s = df.index[0]
-        t_i = datetime(year=t_s.year, month=t_s.month, day=1, tzinfo=t_s.tzinfo)
-        while t_i <= df.index[-1]:
-            ret[t_i.strftime("%Y-%m")] = {}
-            for k in list(self.__tariffstructures.keys()):
-                if self.type_tariffs_map[k] == ChargeType.DEMAND:
-                    ret[t_i.strftime("%Y-%m")][k] = {}  # a dict of price -> (max, cost)
-                else:
-                    ret[t_i.strftime("%Y-%m")][k] = (0, 0)  # a tuple
+        if isinstance(data, pd.DataFrame):
+            if columns is not None:
+                data = data.loc[:, columns]
+            if not data.index.is_monotonic_increasing:
+                data = data.sort_index()
+            columns = list(data.columns)
+            date_index = data.index
+            values = data.values
+        else:
+            values = np.asarray(data)
+            if columns is None:
+                columns = list(range(values.shape[1]))
+            if not date_index.is_monotonic_increasing:
+                idx_sort = np.argsort(date_index.values, kind='mergesort')
+                date_index = date_index[idx_sort]
+                values = values[idx_sort]
+
+        if not low_memory or values.dtype not in (np.float32, np.float64):
+            values = np.asarray(values, dtype=float)
+
+        nb_meters = values.shape[1]
+        labels = list(self.__tariffstructures.keys())
+        months = self.get_billing_months(date_index[0], date_index[-1])
+        idx_months = {month_label: m_i for m_i, month_label in enumerate(months)}
+
+        metrics = np.zeros((nb_meters, len(months), len(labels)))
+        costs = np.zeros((nb_meters, len(months), len(labels)))
+        demand_parts = []
+
+        # A month is in a single chunk, see compute_bill(). Without chunks, the index is billed as it is.
+        if low_memory:
+            chunks = [(date_index[idx_chunk_start:idx_chunk_end], values[idx_chunk_start:idx_chunk_end])
+                      for (idx_chunk_start, idx_chunk_end) in self.get_monthly_chunks(date_index, LOW_MEMORY_CHUNK_MONTHS)]
+        else:
+            chunks = [(date_index, values)]
 
-            t_i += relativedelta(months=+1)
+        for (date_chunk, values_chunk) in chunks:
+            features = TimestampFeatures(date_chunk) if low_memory else get_timestamp_features(date_chunk)
 
-        # Compute the bill for each of the tariff type, for each month
-        for label, tariff_data in list(self.__tariffstructures.items()):
-            l_blocks = self.get_tariff_struct(label, (df.index[0], df.index[-1]))  # get all the tariff blocks for this period and this tariff type
-            for tariff_block in l_blocks:
-                tariff_cost_list = tariff_block.compute_bill(df, column_data)  # this returns a dict of time-period pointing to tuple that contains both the metric of the bill and the cost
-                for time_label, bill_data in list(tariff_cost_list.items()):
-                    self.update_bill_structure(ret[time_label], label, bill_data)
-
-        if monthly_detailed is False:  # Aggregate all the months
-            return self.aggregate_monthly_bill(ret)
+            for l_i, label in enumerate(labels):
+                demand_per_month = {}  # for DEMAND: month -> the demand merged over the blocks, see merge_demand_bill_matrix()
+
+                for tariff_block in self.get_tariff_struct(label, (date_chunk[0], date_chunk[-1])):
+                    for month_label, bill_data in list(tariff_block.compute_bill_matrix(date_chunk, values_chunk, features).items()):
+                        if self.type_tariffs_map[label] == ChargeType.DEMAND:
+                            self.merge_demand_bill_matrix(demand_per_month.setdefault(month_label, {}), bill_data)
+                        else:
+                            metrics[:, idx_months[month_label], l_i] += bill_data[0]
+                            costs[:, idx_months[month_label], l_i] += bill_data[1]
+
+                for month_label, demand_bill in list(demand_per_month.items()):
+                    self.add_demand_bill_matrix(metrics, costs, demand_parts if as_bill else None,
+                                                idx_months[month_label], l_i, demand_bill)
+
+        bill = Bill(columns, months, labels, [self.type_tariffs_map[label] for label in labels], metrics, costs,
+                    Bill.concat_demand_tables(demand_parts))
+
+        if as_bill:
+            return bill
         else:
-            return ret
+            return bill.to_frame()
 
-    def get_electricity_price(self, range_date, timestep):
+    def compute_bill_scenarios(self, scenarios, date_index, names=None, as_bill=False):
+        """
+        Compute the bill of many load profiles (scenarios) defined on the same time index, e.g. the candidates of a
+        battery sizing study. The prices, the TOU periods and the months of the index are computed once for all the
+        scenarios, see ScenarioEvaluator. Use get_scenario_evaluator() to keep them for several batches of scenarios.
+
+        :param scenarios: a 2-D numpy array of shape (nb_scenarios, len(date_index)), the energy consumption (in Wh) of
+        each scenario in each interval
+        :param date_index: a pandas DatetimeIndex, the dates of the intervals
+        :param names: [optional] the names of the scenarios, their position by default
+        :param as_bill: [optional] if True, a Bill object is returned instead of the table. Set to False by default.
+        :return: a pandas dataframe with one row per scenario, month and tariff label, see compute_bill_batch(), or a
+        Bill object
+        """
+
+        return self.get_scenario_evaluator(date_index).evaluate(scenarios, names, as_bill)
+
+    def get_scenario_evaluator(self, date_index):
+        """
+        Prepare the billing of scenarios defined on a time index, see compute_bill_scenarios()
+        :param date_index: a pandas DatetimeIndex, the dates of the intervals
+        :return: a ScenarioEvaluator object
+        """
+
+        with instrument('CostCalculator.get_scenario_evaluator', rows=len(date_index)):
+            return ScenarioEvaluator(self, date_index)
+
+    def get_electricity_price(self, range_date, timestep, as_array=False):
         """
 
         This function creates the electricity price signal for the specified time frame 'range_date', sampled at 'timestep'
@@ -139,6 +300,8 @@ class CostCalculator(object):
         :param range_date: a tuple (t_start, t_end) of type 'datetime', representing the period
         :param timestep: an element of TariffElemPeriod enumeration (1h, 30min or 15min), representing the sampling
         period
+        :param as_array: [optional] if True, the prices are returned as a numpy array of shape (nb_dates, nb_labels),
+        whose columns are the labels returned by get_price_labels(). Set to False by default.
 
         :return: a tuple (pd_prices, map_prices) containing:
             - pd_prices: a pandas dataframe whose index is a datetime index and containing as many cols as there are
@@ -150,21 +313,91 @@ class CostCalculator(object):
         (start_date_price, end_date_price) = range_date
         date_list = pd.date_range(start=start_date_price, end=end_date_price, freq=str(timestep.value))
 
-        # Populate the dataframe for each label, for each period
-        ret_df = None
-        for label_tariff in list(self.__tariffstructures.keys()):
+        # fixed charges not in the elec price signal
+        labels = self.get_price_labels()
+        with instrument('CostCalculator.get_electricity_price', rows=len(date_list)):
+            prices = self.get_price_matrix(labels, date_list, timestep)
 
-            if self.type_tariffs_map[label_tariff] == ChargeType.FIXED:  # fixed charges not in the elec price signal
-                continue
+        if as_array:
+            return prices, self.type_tariffs_map
+        elif len(labels) == 0:
+            return None, self.type_tariffs_map
+        else:
+            return pd.DataFrame(prices, index=date_list, columns=labels), self.type_tariffs_map
 
-            df_for_label = self.get_price_in_range(label_tariff, range_date, timestep)
+    def get_lp_coefficients(self, range_date, timestep):
+        """
+        Return the cost of the tariff over the period 'range_date', sampled at 'timestep', as the coefficients of a
+        linear optimization problem whose variables are the energy consumed in each interval: the price of energy in
+        each interval, the sparse incidence matrices of the demand periods and the months, and the fixed cost.
+        See LPCostCoefficients.
 
-            if ret_df is None:
-                ret_df = df_for_label
-            else:
-                ret_df = pd.concat([ret_df, df_for_label], axis=1)
+        :param range_date: a tuple (t_start, t_end) of type 'datetime', representing the period
+        :param timestep: an element of TariffElemPeriod enumeration (1h, 30min or 15min), representing the sampling
+        period
+        :return: a LPCostCoefficients object
+        """
 
-        return ret_df, self.type_tariffs_map
+        (start_date_price, end_date_price) = range_date
+        date_index = pd.date_range(start=start_date_price, end=end_date_price, freq=str(timestep.value))
+        nb_dates = len(date_index)
+        interval_hours = pd.Timedelta(str(timestep.value)) / pd.Timedelta(hours=1)
+
+        with instrument('CostCalculator.get_lp_coefficients', rows=nb_dates):
+            months = self.get_billing_months(date_index[0], date_index[-1]) if nb_dates > 0 else []
+            idx_months = {month_label: m_i for m_i, month_label in enumerate(months)}
+
+            # The month of each interval, as a position in 'months'
+            features = TimestampFeatures(date_index)
+            month_codes = features.month_codes.astype(np.int64)
+            if nb_dates > 0:
+                month_codes -= month_codes[0]
+
+            labels = self.get_price_labels()
+            prices = self.get_price_matrix(labels, date_index, timestep)
+
+            energy_prices = np.zeros(nb_dates)
+            demand_rows = []
+            demand_cols = []
+            demand_prices = []
+            demand_periods = []
+            for l_i, label in enumerate(labels):
+                prices_label = prices[:, l_i]
+                if self.type_tariffs_map[label] == ChargeType.ENERGY:
+                    energy_prices += np.nan_to_num(prices_label)
+                    continue
+
+                # DEMAND: one period per month and price, the intervals without price or with a null price are left out
+                idx_dates = np.flatnonzero(~np.isnan(prices_label) & (prices_label != 0))
+                if len(idx_dates) == 0:
+                    continue
+
+                periods, periods_id = np.unique(np.column_stack((month_codes[idx_dates], prices_label[idx_dates])),
+                                                axis=0, return_inverse=True)
+                demand_rows.append(len(demand_prices) + periods_id.ravel())
+                demand_cols.append(idx_dates)
+                demand_prices += periods[:, 1].tolist()
+                demand_periods += [(label, months[int(m_i)], price) for (m_i, price) in periods.tolist()]
+
+            demand_rows = np.concatenate(demand_rows) if len(demand_rows) > 0 else np.zeros(0, dtype=int)
+            demand_cols = np.concatenate(demand_cols) if len(demand_cols) > 0 else np.zeros(0, dtype=int)
+
+            # The fixed charges of each month, as billed with data over the whole period
+            fixed_cost_per_month = np.zeros(len(months))
+            if nb_dates > 0:
+                no_data = np.zeros((nb_dates, 1))
+                for label, tariff_type in list(self.type_tariffs_map.items()):
+                    if tariff_type != ChargeType.FIXED or label not in self.__tariffstructures:
+                        continue
+                    for tariff_block in self.get_tariff_struct(label, (date_index[0], date_index[-1])):
+                        for month_label, (nb_days, bill) in list(tariff_block.compute_bill_matrix(date_index, no_data, features).items()):
+                            fixed_cost_per_month[idx_months[month_label]] += bill[0]
+
+            return LPCostCoefficients(date_index, interval_hours, energy_prices,
+                                      build_incidence_matrix(demand_rows, demand_cols, (len(demand_prices), nb_dates)),
+                                      np.asarray(demand_prices, dtype=float), demand_periods,
+                                      months, build_incidence_matrix(month_codes, np.arange(nb_dates), (len(months), nb_dates)),
+                                      fixed_cost_per_month)
 
     def get_price_in_range(self, label_tariff, date_range, timestep):
         """
@@ -175,19 +408,98 @@ class CostCalculator(object):
         # Prepare the Pandas dataframe
         (start_date_price, end_date_price) = date_range
         date_range = pd.date_range(start=start_date_price, end=end_date_price, freq=str(timestep.value))
-        ret_df = pd.DataFrame(index=date_range, columns=[label_tariff])
 
-        # # Select the corresponding blocks for each day and generate the time dataframe
-        for idx_day, df_day in ret_df.groupby(ret_df.index.date):
-            date_range_period = pd.date_range(start=df_day.index[0], periods=2, freq=str(timestep.value))
-            tariff_block = self.get_tariff_struct(label_tariff, (date_range_period[0], date_range_period[1]))
+        with instrument('CostCalculator.get_price_in_range', label=label_tariff, rows=len(date_range)):
+            return pd.DataFrame(self.get_price_matrix([label_tariff], date_range, timestep), index=date_range, columns=[label_tariff])
 
-            if len(tariff_block) > 0:
-                daily_rate = tariff_block[0].rate_schedule.get_daily_rate(df_day.index[0])
-                rate_df = tariff_block[0].get_daily_price_dataframe(daily_rate, df_day)
-                ret_df.loc[df_day.index[:], label_tariff] = rate_df['price'].values
+    def get_labels(self):
+        """
+        Return the labels of the tariffs added to this calculator, in the order they were added
+        :return: a list of string
+        """
+
+        return list(self.__tariffstructures.keys())
+
+    def get_price_labels(self):
+        """
+        Return the labels of the tariffs that make up the electricity price signal, i.e. all but the fixed charges
+        :return: a list of string
+        """
+
+        return [label for label in list(self.__tariffstructures.keys()) if self.type_tariffs_map[label] != ChargeType.FIXED]
+
+    def get_price_matrix(self, labels, date_index, timestep):
+        """
+        Return the price of each tariff label at each date of 'date_index', as compute_price_matrix(). The price vector
+        of each label is memoized in 'price_cache', on the fingerprint of its tariff blocks: a request for a period
+        already covered by a cached vector is served as a slice of it.
+
+        :param labels: a list of tariff labels, the columns of the matrix
+        :param date_index: a pandas DatetimeIndex, sampled at 'timestep'
+        :param timestep: an element of TariffElemPeriod enumeration, the sampling period of 'date_index'
+        :return: a numpy array of float64 of shape (len(date_index), len(labels)), NaN where there is no price
+        """
+
+        if len(date_index) == 0:
+            return np.full((0, len(labels)), np.nan)
+
+        prices = np.empty((len(date_index), len(labels)))
+
+        missing_labels = []
+        for idx_label, label_tariff in enumerate(labels):
+            cached_prices = self.price_cache.get(self.get_label_fingerprint(label_tariff), timestep, date_index)
+            if cached_prices is None:
+                missing_labels.append(idx_label)
+            else:
+                prices[:, idx_label] = cached_prices
+
+        if len(missing_labels) > 0:
+            prices[:, missing_labels] = self.compute_price_matrix([labels[i] for i in missing_labels], date_index, timestep)
+            for idx_label in missing_labels:
+                self.price_cache.put(self.get_label_fingerprint(labels[idx_label]), timestep, date_index, prices[:, idx_label])
+
+        return prices
 
-        return ret_df
+    def compute_price_matrix(self, labels, date_index, timestep):
+        """
+        Fill a preallocated matrix with the price of each tariff label at each date of 'date_index'.
+
+        The tariff block of a day is the first one that is effective at the start of the day, over one timestep. The
+        prices of all the days sharing a block are then gathered at once from its compiled rate schedule.
+
+        :param labels: a list of tariff labels, the columns of the matrix
+        :param date_index: a sorted pandas DatetimeIndex
+        :param timestep: an element of TariffElemPeriod enumeration, the sampling period of 'date_index'
+        :return: a numpy array of float64 of shape (len(date_index), len(labels)), NaN where there is no price
+        """
+
+        prices = np.full((len(date_index), len(labels)), np.nan)
+        if len(date_index) == 0:
+            return prices
+
+        # Split the dates in days, in local time
+        local_index = date_index.tz_localize(None) if date_index.tz is not None else date_index
+        days = np.asarray(local_index, dtype='datetime64[D]')
+        idx_days = np.concatenate(([0], np.flatnonzero(days[1:] != days[:-1]) + 1))
+        days_length = np.diff(np.append(idx_days, len(date_index)))
+
+        days_start = TariffBlockIndex.to_timestamps(date_index[idx_days])
+        days_end = TariffBlockIndex.to_timestamps(date_index[idx_days].shift(1, freq=str(timestep.value)))
+
+        for idx_label, label_tariff in enumerate(labels):
+            blocks_index = self.__tariffstructures[label_tariff]['blocks_index']
+            blocks = blocks_index.blocks
+
+            with instrument('CostCalculator.compute_price_matrix', label=label_tariff, rows=len(date_index)):
+                pos_blocks = np.repeat(blocks_index.query_first(days_start, days_end), days_length)
+                for pos in np.unique(pos_blocks).tolist():
+                    if pos < 0 or not isinstance(blocks[pos], TimeOfUseTariff):
+                        continue
+
+                    idx_dates = np.flatnonzero(pos_blocks == pos)
+                    prices[idx_dates, idx_label] = blocks[pos].get_price_vector(date_index[idx_dates])
+
+        return prices
 
     def print_aggregated_bill(self, bill_struct, verbose=True):
         """
@@ -197,11 +509,15 @@ class CostCalculator(object):
          - tt is the total cost per type of tariff (energy, fix, demand)
          - ttt is the cost for each tariff label
 
-        :param bill_struct: the dictionary returned by compute_bill()
+        :param bill_struct: the dictionary returned by compute_bill(), or a Bill object
         :param verbose: [optional, default is True] print details
         :return:
         """
 
+        if isinstance(bill_struct, Bill):
+            return self.print_bill_totals(bill_struct.get_total(), bill_struct.get_total_per_charge_type(),
+                                          bill_struct.get_total_per_label(), verbose)
+
         monthly_detailed = False
 
         # If the first keys of the dict point to smth that is not the tariff type, this is a monthly bill
@@ -250,6 +566,15 @@ class CostCalculator(object):
 
             acc_per_label = bill_struct
 
+        return self.print_bill_totals(acc_tot, acc_per_chargetype, acc_per_label, verbose)
+
+    @staticmethod
+    def print_bill_totals(acc_tot, acc_per_chargetype, acc_per_label, verbose=True):
+        """
+        Print the totals computed by print_aggregated_bill()
+        :return: the tuple (acc_tot, acc_per_chargetype, acc_per_label)
+        """
+
         if verbose:
             # Total
             print(("\n| Aggregated bill: {0} ($)".format(acc_tot)))
@@ -269,6 +594,18 @@ class CostCalculator(object):
 
     # --- Construction and internal methods
 
+    def compile(self):
+        """
+        Prepare the tariff for an intensive use, e.g. before sending it to other processes: compile the rate schedules
+        of all the tariff blocks and build the blocks indexes
+        :return: /
+        """
+
+        for label, tariff_data in list(self.__tariffstructures.items()):
+            tariff_data['blocks_index'].build()
+            for tariff_block in tariff_data['list_blocks']:
+                tariff_block.compile()
+
     def add_tariff(self, tariff_obj, tariff_label, tariff_type=None):
         """
         Add a tariff block structure that fell into the category "type_rate"
@@ -278,6 +615,17 @@ class CostCalculator(object):
         :return: /
         """
 
+        self.add_tariffs([tariff_obj], tariff_label, tariff_type)
+
+    def add_tariffs(self, list_tariff_obj, tariff_label, tariff_type=None):
+        """
+        Add several tariff block structures that fell into the same category "type_rate", at once
+        :param list_tariff_obj: a list of TariffBase (or children) objects
+        :param tariff_label: the label of the tariff, in the keys given to the constructor
+        :param tariff_type: the type of tariff, an enum of ChargeType
+        :return: /
+        """
+
         # The tariff type (fix, demand or energy) is not specified: get it from the default structure
         if tariff_type is None:
             tariff_type = tariff_label
@@ -293,34 +641,52 @@ class CostCalculator(object):
         if tariff_label not in list(self.__tariffstructures.keys()):
             self.__tariffstructures[tariff_label] = self.generate_type_tariff(tariff_type)
 
-        self.__tariffstructures[tariff_label]['list_blocks'].append(tariff_obj)
+        tariff_data = self.__tariffstructures[tariff_label]
+        old_fingerprint = tariff_data['fingerprint']
+
+        tariff_data['blocks_index'].extend(list_tariff_obj)
+        tariff_data['fingerprint'] = None
+
+        # Only the price signals of this label around the new blocks are invalidated
+        if old_fingerprint is not None and len(list_tariff_obj) > 0:
+            range_blocks = (min([b.startdate for b in list_tariff_obj], key=TariffBlockIndex.to_timestamp),
+                            max([b.enddate for b in list_tariff_obj], key=TariffBlockIndex.to_timestamp))
+            self.price_cache.rekey(old_fingerprint, self.get_label_fingerprint(tariff_label), range_blocks)
+
+    def get_label_fingerprint(self, tariff_label):
+        """
+        Return a fingerprint of the content of the tariff blocks of a label, in their order: two labels with the same
+        blocks have the same fingerprint. It is computed once, until new blocks are added to the label.
+        :param tariff_label: a string pointing to the type of tariff
+        :return: a string
+        """
+
+        tariff_data = self.__tariffstructures[tariff_label]
+
+        if tariff_data['fingerprint'] is None:
+            hash_obj = hashlib.sha1()
+            for tariff_block in tariff_data['list_blocks']:
+                tariff_block.update_fingerprint(hash_obj)
+            tariff_data['fingerprint'] = hash_obj.hexdigest()
+
+        return tariff_data['fingerprint']
 
     def get_tariff_struct(self, label_tariff, dates=None):
         """
         Get the list of "tariff blocks" that influence the bill for the type of tariff "type_rate".
         If "dates" is specified, only the blocks that are effective for that period are returned
         :param label_tariff: a string pointing to the type of tariff
-        :param dates:[optional] a tuple of type datetime defining the period of selection
+        :param dates:[optional] a tuple of type datetime defining the period of selection. Naive dates are in UTC.
         :return: a list of TariffBase (or children) describing the tariffs
         """
 
-        list_struct = self.__tariffstructures[label_tariff]['list_blocks']
-
         if dates is None:
-            return list_struct
+            return self.__tariffstructures[label_tariff]['list_blocks']
         else:
             (start_sel, end_sel) = dates
-            if start_sel.tzinfo is None and len(list_struct) > 0:
-                first_block = list_struct[0]
-                start_sel = start_sel.replace(tzinfo=pytz.timezone('UTC'))
+            return self.__tariffstructures[label_tariff]['blocks_index'].query(start_sel, end_sel)
 
-            if end_sel.tzinfo is None and len(list_struct) > 0:
-                first_block = list_struct[0]
-                end_sel = end_sel.replace(tzinfo=pytz.timezone('UTC'))
-                
-            return [obj for obj in list_struct if ((obj.startdate <= start_sel <= obj.enddate) or (start_sel <= obj.startdate <= end_sel))]
-
-    def update_bill_structure(self, intermediate_monthly_bill, label_tariff, new_data):
+    def update_bill_structure(self, intermediate_monthly_bill, label_tariff, new_data, masks_index=None):
         """
         This method update the current monthly bill with new data for the same month:
          - In case of "demand charge per (k)W", apply MAX
@@ -330,26 +696,19 @@ class CostCalculator(object):
         :param new_data: a tuple (metric, cost) where:
          - metric is either a float or an int, referring to the metric that influences the cost
          - cost is a float, referring to the cost in $
+        :param masks_index: [optional] for a DEMAND label, the mask index of its bill in 'intermediate_monthly_bill' (see
+        get_demand_masks_index()), updated in place. Keeping it between the merges of a bill makes each merge independent
+        of the number of entries already merged. It is rebuilt from the bill by default.
         :return:
         """
 
         type_of_tariff = self.__tariffstructures[label_tariff]['type']
 
         if type_of_tariff == ChargeType.DEMAND:  # Demand: apply MAX
-            for p in list(new_data.keys()):  # For each price -> dict (mask, max-p, date-max-p)
-
-                this_mask = new_data[p]['mask']  # get the new data mask
-                existing_mask_price = [k for k, v in list(intermediate_monthly_bill[label_tariff].items())  if v['mask'] == this_mask]
-
-                if len(existing_mask_price) > 0:  # this mask has already been seen: APPLY MAX
-                    existing_mask_price = existing_mask_price[0]
-                    if new_data[p]['max-demand'] > intermediate_monthly_bill[label_tariff][existing_mask_price]['max-demand']:
-                        #print("Demand rate update: for mask {0}, {0} is greater than {2}".format(this_mask, new_data[p]['max-demand'], intermediate_monthly_bill[label_tariff][existing_mask_price]['max-demand'])) # debug
-
-                        del intermediate_monthly_bill[label_tariff][existing_mask_price]
-                        intermediate_monthly_bill[label_tariff][p] = new_data[p]
-                else:  # This is the first time this mask has been seen: store it
-                    intermediate_monthly_bill[label_tariff][p] = new_data[p]
+            bill_label = intermediate_monthly_bill[label_tariff]
+            if masks_index is None:
+                masks_index = self.get_demand_masks_index(bill_label)
+            self.merge_demand_bill(bill_label, masks_index, new_data)
         else:  # energy or fixed cost: apply SUM
             intermediate_monthly_bill[label_tariff] = (intermediate_monthly_bill[label_tariff][0] + new_data[0],
                                                        intermediate_monthly_bill[label_tariff][1] + new_data[1])
@@ -361,33 +720,132 @@ class CostCalculator(object):
         :return: /
         """
 
-        data_merge = None
-        for m, data_per_label in list(monthly_bill.items()):
-            if data_merge is None:
-                data_merge = data_per_label
+        return aggregate_monthly_bill(monthly_bill, self.type_tariffs_map)
+
+    @staticmethod
+    def get_demand_masks_index(demand_bill):
+        """
+        Index a demand bill by mask, see bill.get_demand_masks_index()
+        """
+
+        return get_demand_masks_index(demand_bill)
+
+    @staticmethod
+    def merge_demand_bill(demand_bill, masks_index, new_data):
+        """
+        Merge the demand data 'new_data' into 'demand_bill', applying MAX on the entries that share the same mask.
+        See bill.merge_demand_bill()
+        """
+
+        merge_demand_bill(demand_bill, masks_index, new_data)
+
+    @staticmethod
+    def merge_demand_bill_matrix(demand_bill, new_data):
+        """
+        Merge the demand data of several meters, as returned by TouDemandChargeTariff.compute_monthly_bill_matrix(),
+        applying MAX for each meter on the periods that share the same mask.
+
+        As in the bill of compute_bill(), keyed by price (see merge_demand_bill()), the bill of a meter holds a single
+        period per price: a period stored for a meter drops the period of another mask with the same price, and a
+        period of 'new_data' is dropped if a later one has the same price for this meter (a tiered period).
+        :param demand_bill: a dict mapping the interned id of the masks to a list [prices, max_demands, dates] with one
+        value per meter, updated in place. A period dropped for a meter has a NaN max demand.
+        :param new_data: a dict mapping the prices to a dict (mask, max-demand, max-demand-date), and the price of each
+        meter (price) for the tiered periods
+        :return: /
+        """
+
+        periods = []
+        for p, data in list(new_data.items()):
+            new_max = np.array(data['max-demand'], dtype=float)
+            new_prices = np.broadcast_to(np.asarray(data.get('price', p), dtype=float), new_max.shape)
+            periods.append((intern_mask(data['mask']), new_prices, new_max, data['max-demand-date']))
+
+        for (i, (_, prices_i, max_i, _)) in enumerate(periods):
+            for (_, prices_j, max_j, _) in periods[i + 1:]:
+                max_i[(prices_i == prices_j) & ~np.isnan(max_j)] = np.nan
+
+        for (this_mask_id, new_prices, new_max, new_dates) in periods:
+            if this_mask_id not in demand_bill:
+                is_stored = ~np.isnan(new_max)
+                demand_bill[this_mask_id] = [np.array(new_prices), new_max, new_dates]
             else:
-                for label_tariff, data_tariff in list(data_per_label.items()):
-                    if self.type_tariffs_map[label_tariff] == ChargeType.DEMAND:  # take max
-                        for p, data in list(data_tariff.items()):  # For each price -> dict (mask, max, date)
-                            this_mask = data['mask']  # get the new data mask
-                            existing_mask_price = [k for k, v in list(data_merge[label_tariff].items()) if v['mask'] == this_mask]
-
-                            if len(existing_mask_price) > 0:  # this mask has already been seen: APPLY MAX
-                                existing_mask_price = existing_mask_price[0]
-                                if data['max-demand'] > data_merge[label_tariff][existing_mask_price]['max-demand']:
-                                    #print("Demand rate update: for mask {1}, {0} is greater than {2}".format(this_mask, data, data_merge[label_tariff][p]))  # debug
-                                    del data_merge[label_tariff][existing_mask_price]
-                                    data_merge[label_tariff][p] = data
-                            else:  # This is the first time this price has been seen: store it
-                                data_merge[label_tariff][p] = data
-                    else:  # sum
-                        data_merge[label_tariff] = (data_merge[label_tariff][0] + data_tariff[0],
-                                                    data_merge[label_tariff][1] + data_tariff[1])
-
-        return data_merge
+                (prices_meters, max_meters, dates_meters) = demand_bill[this_mask_id]
+                is_stored = (new_max > max_meters) | (np.isnan(max_meters) & ~np.isnan(new_max))
+                prices_meters[is_stored] = new_prices[is_stored]
+                max_meters[is_stored] = new_max[is_stored]
+                demand_bill[this_mask_id][2] = dates_meters.where(~is_stored, new_dates)
+
+            for mask_id, (prices_meters, max_meters, dates_meters) in list(demand_bill.items()):
+                if mask_id != this_mask_id:
+                    max_meters[is_stored & (prices_meters == new_prices)] = np.nan
+
+    @staticmethod
+    def add_demand_bill_matrix(metrics, costs, demand_parts, m_i, l_i, demand_bill):
+        """
+        Add the demand bill of several meters for a month and a label, merged by merge_demand_bill_matrix(), to the
+        arrays of a Bill
+        :param metrics: the array of the metrics of the Bill, of shape (nb_meters, nb_months, nb_labels), updated in place
+        :param costs: the array of the costs of the Bill, updated in place
+        :param demand_parts: a list of the demand tables of the Bill, to which the periods are appended, or None
+        :param m_i: the position of the month in the Bill
+        :param l_i: the position of the label in the Bill
+        :param demand_bill: see merge_demand_bill_matrix()
+        :return: /
+        """
+
+        for mask_id, (prices_meters, max_meters, dates_meters) in list(demand_bill.items()):
+            has_data = ~np.isnan(max_meters)
+            costs[:, m_i, l_i] += np.where(has_data, prices_meters * max_meters, 0.0)
+            metrics[:, m_i, l_i] = np.where(has_data, np.maximum(metrics[:, m_i, l_i], max_meters), metrics[:, m_i, l_i])
+
+            if demand_parts is not None:
+                idx_meters = np.flatnonzero(has_data)
+                demand_parts.append({'meter': idx_meters,
+                                     'month': np.full(len(idx_meters), m_i),
+                                     'label': np.full(len(idx_meters), l_i),
+                                     'price': prices_meters[idx_meters],
+                                     'mask': np.full(len(idx_meters), mask_id),
+                                     'max-demand': max_meters[idx_meters],
+                                     'max-demand-date': dates_meters[idx_meters]})
+
+    @staticmethod
+    def get_monthly_chunks(date_index, nb_months=1):
+        """
+        Split a sorted DatetimeIndex into chunks of whole calendar months, without decomposing its timestamps
+        :param date_index: a non-empty sorted pandas DatetimeIndex
+        :param nb_months: [optional] the number of months per chunk
+        :return: a list of tuples (idx_start, idx_end), the ranges of positions of the chunks
+        """
+
+        months = CostCalculator.get_billing_months(date_index[0], date_index[-1])
+        chunks_start = [pd.Timestamp(month_label + '-01', tz=date_index.tz) for month_label in months[nb_months::nb_months]]
+        idx_bounds = [0] + date_index.searchsorted(chunks_start).tolist() + [len(date_index)]
+
+        return [(idx_start, idx_end) for idx_start, idx_end in zip(idx_bounds[:-1], idx_bounds[1:]) if idx_end > idx_start]
+
+    @staticmethod
+    def get_billing_months(t_first, t_last):
+        """
+        List the months of the calendar between two dates
+        :param t_first: a datetime
+        :param t_last: a datetime
+        :return: a list of month labels, formatted as "YYYY-MM"
+        """
+
+        months = []
+
+        t_i = datetime(year=t_first.year, month=t_first.month, day=1)
+        while t_i <= datetime(year=t_last.year, month=t_last.month, day=1):
+            months.append(t_i.strftime("%Y-%m"))
+            t_i += relativedelta(months=+1)
 
+        return months
 
     @staticmethod
     def generate_type_tariff(type_tariff):
+        blocks_index = TariffBlockIndex()
         return {'type': type_tariff,
-                'list_blocks': []}
+                'list_blocks': blocks_index.blocks,
+                'blocks_index': blocks_index,
+                'fingerprint': None}
@@ -0,0 +1,150 @@
+__author__ = 'Olivier Van Cutsem'
+
+from datetime import date
+
+import numpy as np
+
+# --------------- Day-type calendar --------------- #
+
+
+class HolidayCalendar(object):
+    """
+    This class maps each date to a "day-type" code, as used by TouRateSchedule to select the daily rates:
+     - a day of the week, from 0 (monday) to 6 (sunday), for a normal day
+     - 'holiday_day_type' for a holiday of the calendar
+
+    The codes are precomputed for a range of years, such that looking up the day-types of a whole DatetimeIndex costs a
+    few numpy operations. The range is extended automatically when dates outside of it are requested.
+    """
+
+    DEFAULT_YEARS = (2000, 2040)
+
+    def __init__(self, country='US', state=None, holiday_day_type=0, years=None):
+        """
+        Constructor
+        :param country: the name of the country in the 'holidays' package, e.g. 'US'
+        :param state: [optional] the state (or province) whose holidays must be added, e.g. 'CA'
+        :param holiday_day_type: [optional] the day-type code of the holidays. Set to 0 by default
+        :param years: [optional] a tuple (first_year, last_year) to precompute. DEFAULT_YEARS is used by default
+        """
+
+        self.country = country
+        self.state = state
+        self.holiday_day_type = holiday_day_type
+
+        if years is None:
+            years = self.DEFAULT_YEARS
+
+        self.__first_day = None
+        self.__day_types = None
+        self.__years = None
+
+        self.precompute(years)
+
+    def get_day_type(self, date_sel):
+        """
+        Return the day-type code of a single date
+        :param date_sel: a datetime, date or pandas Timestamp
+        :return: an int
+        """
+
+        day = np.datetime64(date(date_sel.year, date_sel.month, date_sel.day), 'D')
+        self.__check_range(date_sel.year, date_sel.year)
+
+        return int(self.__day_types[(day - self.__first_day).astype(int)])
+
+    def get_day_types(self, date_index):
+        """
+        Return the day-type code of each date in a pandas DatetimeIndex, as a vectorized lookup in the precomputed
+        calendar. For tz-aware indexes, the local date is considered.
+        :param date_index: a pandas DatetimeIndex
+        :return: a numpy array of int, aligned with 'date_index'
+        """
+
+        if len(date_index) == 0:
+            return np.zeros(0, dtype=int)
+
+        if date_index.tz is not None:
+            date_index = date_index.tz_localize(None)
+
+        return self.get_day_types_of_days(np.asarray(date_index, dtype='datetime64[D]'))
+
+    def get_day_types_of_days(self, days):
+        """
+        Return the day-type code of each day in an array, see get_day_types()
+        :param days: a non-empty numpy array of datetime64[D]
+        :return: a numpy array of int, aligned with 'days'
+        """
+
+        self.__check_range(int(days.min().astype(object).year), int(days.max().astype(object).year))
+
+        return self.__day_types[(days - self.__first_day).astype(int)]
+
+    def precompute(self, years):
+        """
+        (Re)build the day-type codes for all the days of the years in the range 'years'
+        :param years: a tuple (first_year, last_year)
+        :return: /
+        """
+
+        (first_year, last_year) = years
+
+        first_day = np.datetime64('{0:04d}-01-01'.format(first_year), 'D')
+        last_day = np.datetime64('{0:04d}-01-01'.format(last_year + 1), 'D')
+        days = np.arange(first_day, last_day)
+
+        # numpy days start on thursday: 1970-01-01 was a thursday (3)
+        day_types = (days.astype(int) + 3) % 7
+
+        list_holidays = np.asarray(list(self.get_holidays(range(first_year, last_year + 1)).keys()), dtype='datetime64[D]')
+        day_types[np.isin(days, list_holidays)] = self.holiday_day_type
+
+        self.__first_day = first_day
+        self.__day_types = day_types
+        self.__years = (first_year, last_year)
+
+    def get_holidays(self, years):
+        """
+        Return the holidays of this calendar for the given years
+        :param years: a list of int
+        :return: a dict-like object mapping dates to the holiday names
+        """
+
+        import holidays  # only needed to precompute a calendar: unpickled and compiled tariffs don't load it
+
+        if self.state is not None:
+            return getattr(holidays, self.country)(state=self.state, years=list(years))
+        else:
+            return getattr(holidays, self.country)(years=list(years))
+
+    @property
+    def years(self):
+        """
+        The range of years that is currently precomputed
+        """
+
+        return self.__years
+
+    def __check_range(self, first_year, last_year):
+        if first_year < self.__years[0] or last_year > self.__years[1]:
+            self.precompute((min(first_year, self.__years[0]), max(last_year, self.__years[1])))
+
+
+# The calendars shared within the process, per (country, state, holiday_day_type)
+_calendars = {}
+
+
+def get_holiday_calendar(country='US', state='CA', holiday_day_type=0):
+    """
+    Return the process-wide HolidayCalendar for a country/state, building it the first time it is requested
+    :param country: the name of the country in the 'holidays' package
+    :param state: the state (or province), or None for the national holidays only
+    :param holiday_day_type: the day-type code of the holidays
+    :return: a HolidayCalendar instance
+    """
+
+    key = (country, state, holiday_day_type)
+    if key not in _calendars:
+        _calendars[key] = HolidayCalendar(country, state, holiday_day_type)
+
+    return _calendars[key]
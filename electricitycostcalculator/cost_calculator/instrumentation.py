@@ -0,0 +1,430 @@
+__author__ = 'Olivier Van Cutsem'
+
+from abc import abstractmethod
+from functools import wraps
+import logging
+import threading
+import time
+import tracemalloc
+
+# --------------- Instrumentation of the billing pipeline --------------- #
+
+# The sinks receiving the records: the instrumentation is disabled when there is none
+_sinks = []
+
+# Whether the peak memory allocation of the calls is measured, with tracemalloc
+_track_memory = False
+
+# The calls in progress, per thread
+_state = threading.local()
+_call_ids_lock = threading.Lock()
+_call_ids = [0]
+
+
+class InstrumentationRecord(object):
+    """
+    The measures of one instrumented call:
+     - name: the instrumented function, e.g. 'CostCalculator.compute_bill'
+     - label: the tariff label, inherited from the enclosing call if not given
+     - block: the tariff block (see get_block_name), or the source of the tariff for the loading functions
+     - rows: the number of rows (dates) processed
+     - wall_time: the duration of the call, in seconds
+     - peak_memory: the peak of memory allocated during the call, in bytes (None if the memory is not tracked)
+     - call_id: the id of the outermost instrumented call it belongs to, e.g. one compute_bill() call
+     - depth: its depth in the tree of instrumented calls, 0 for the outermost one
+    """
+
+    __slots__ = ('name', 'label', 'block', 'rows', 'wall_time', 'peak_memory', 'call_id', 'depth')
+
+    def __init__(self, name, label, block, rows, wall_time, peak_memory, call_id, depth):
+        self.name = name
+        self.label = label
+        self.block = block
+        self.rows = rows
+        self.wall_time = wall_time
+        self.peak_memory = peak_memory
+        self.call_id = call_id
+        self.depth = depth
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def __repr__(self):
+        return 'InstrumentationRecord({0})'.format(', '.join(['{0}={1!r}'.format(k, getattr(self, k)) for k in self.__slots__]))
+
+
+# --------------- Sinks --------------- #
+
+
+class InstrumentationSink(object):
+    """
+    The base class of the destinations of the instrumentation records
+    """
+
+    @abstractmethod
+    def record(self, rec):
+        """
+        Receive the record of an instrumented call, when the call ends
+        :param rec: an InstrumentationRecord
+        :return: /
+        """
+
+        pass
+
+
+class MemoryCollector(InstrumentationSink):
+    """
+    This sink keeps the records in memory, to be retrieved per outermost call (e.g. per bill)
+    """
+
+    def __init__(self):
+        self.records = []
+        self.__lock = threading.Lock()
+
+    def record(self, rec):
+        with self.__lock:
+            self.records.append(rec)
+
+    def get_call_ids(self):
+        """
+        Return the ids of the outermost calls that have been recorded, in their order
+        :return: a list of int
+        """
+
+        return sorted(set([rec.call_id for rec in self.records]))
+
+    def get_records(self, call_id=None):
+        """
+        Return the records of a call, in the order they ended (the outermost call comes last)
+        :param call_id: [optional] the id of an outermost call, the last one by default
+        :return: a list of InstrumentationRecord
+        """
+
+        if len(self.records) == 0:
+            return []
+        if call_id is None:
+            call_id = self.records[-1].call_id
+
+        return [rec for rec in self.records if rec.call_id == call_id]
+
+    def summary(self, call_id=None):
+        """
+        Aggregate the records per function, label and block
+        :param call_id: [optional] the id of an outermost call. All the calls are aggregated by default
+        :return: a dict mapping (name, label, block) to a dict with the 'calls', 'rows', 'wall_time' and 'peak_memory'
+        """
+
+        records = self.records if call_id is None else self.get_records(call_id)
+
+        return summarize_records(records)
+
+    def clear(self):
+        with self.__lock:
+            self.records = []
+
+
+class LoggingSink(InstrumentationSink):
+    """
+    This sink writes each record to a logger
+    """
+
+    def __init__(self, logger=None, level=logging.DEBUG):
+        """
+        Constructor
+        :param logger: [optional] a logging.Logger. The logger of this module is used by default
+        :param level: [optional] the logging level of the records
+        """
+
+        self.logger = logger if logger is not None else logging.getLogger(__name__)
+        self.level = level
+
+    def record(self, rec):
+        self.logger.log(self.level, "%s%s label=%s block=%s rows=%d time=%.6fs peak_memory=%s call=%d",
+                        '  ' * rec.depth, rec.name, rec.label, rec.block, rec.rows, rec.wall_time, rec.peak_memory, rec.call_id)
+
+
+class PrometheusSink(InstrumentationSink):
+    """
+    This sink aggregates the records per function, label and block, and dumps them in the Prometheus text format
+    """
+
+    PREFIX = 'electricitycostcalculator'
+
+    def __init__(self):
+        self.__summary = {}
+        self.__lock = threading.Lock()
+
+    def record(self, rec):
+        with self.__lock:
+            update_summary(self.__summary, rec)
+
+    def dump(self):
+        """
+        Return the aggregated measures in the Prometheus text exposition format
+        :return: a string
+        """
+
+        with self.__lock:
+            summary = dict(self.__summary)
+
+        metrics = [('calls_total', 'counter', 'Number of calls', 'calls'),
+                   ('rows_total', 'counter', 'Number of rows processed', 'rows'),
+                   ('wall_time_seconds_total', 'counter', 'Wall time spent in the calls', 'wall_time'),
+                   ('peak_memory_bytes', 'gauge', 'Largest peak memory allocation of a call', 'peak_memory')]
+
+        lines = []
+        for (metric_name, metric_type, metric_help, key) in metrics:
+            full_name = '{0}_{1}'.format(self.PREFIX, metric_name)
+            lines.append('# HELP {0} {1}'.format(full_name, metric_help))
+            lines.append('# TYPE {0} {1}'.format(full_name, metric_type))
+            for (name, label, block), data in sorted(list(summary.items()), key=lambda x: tuple(str(k) for k in x[0])):
+                if data[key] is None:
+                    continue
+                tags = ','.join(['{0}="{1}"'.format(k, self.escape(v)) for k, v in [('name', name), ('label', label), ('block', block)]
+                                 if v is not None])
+                lines.append('{0}{{{1}}} {2}'.format(full_name, tags, repr(float(data[key]))))
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self, filename):
+        """
+        Write the dump to a file, e.g. for the textfile collector of the Prometheus node exporter
+        :param filename: the path of the file
+        :return: /
+        """
+
+        with open(filename, 'w') as output_file:
+            output_file.write(self.dump())
+
+    def clear(self):
+        with self.__lock:
+            self.__summary = {}
+
+    @staticmethod
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def summarize_records(records):
+    """
+    Aggregate records per function, label and block
+    :param records: a list of InstrumentationRecord
+    :return: see MemoryCollector.summary()
+    """
+
+    summary = {}
+    for rec in records:
+        update_summary(summary, rec)
+
+    return summary
+
+
+def update_summary(summary, rec):
+    key = (rec.name, rec.label, rec.block)
+    data = summary.get(key)
+    if data is None:
+        data = summary[key] = {'calls': 0, 'rows': 0, 'wall_time': 0.0, 'peak_memory': None}
+
+    data['calls'] += 1
+    data['rows'] += rec.rows
+    data['wall_time'] += rec.wall_time
+    if rec.peak_memory is not None:
+        data['peak_memory'] = max(data['peak_memory'] or 0, rec.peak_memory)
+
+
+# --------------- Configuration --------------- #
+
+
+def enable_instrumentation(*sinks, **kwargs):
+    """
+    Start sending the records of the instrumented calls to the given sinks
+    :param sinks: InstrumentationSink objects
+    :param track_memory: [optional, keyword] if True, the peak memory allocation of each call is measured with
+    tracemalloc, which slows the computation down. Set to False by default.
+    :return: /
+    """
+
+    global _track_memory
+
+    for sink in sinks:
+        if sink not in _sinks:
+            _sinks.append(sink)
+
+    _track_memory = kwargs.get('track_memory', False)
+    if _track_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_instrumentation(*sinks):
+    """
+    Stop sending the records to some sinks
+    :param sinks: InstrumentationSink objects. All the sinks are removed if none is given
+    :return: /
+    """
+
+    global _track_memory
+
+    if len(sinks) == 0:
+        sinks = list(_sinks)
+
+    for sink in sinks:
+        if sink in _sinks:
+            _sinks.remove(sink)
+
+    if len(_sinks) == 0:
+        _track_memory = False
+
+
+def is_instrumentation_enabled():
+    return len(_sinks) > 0
+
+
+def get_block_name(tariff_block):
+    """
+    Return the name identifying a tariff block in the records: its name if it has one, or its type and dates
+    :param tariff_block: a TariffBase object
+    :return: a string
+    """
+
+    if tariff_block.name is not None:
+        return str(tariff_block.name)
+
+    return '{0}[{1}, {2}]'.format(type(tariff_block).__name__, tariff_block.startdate, tariff_block.enddate)
+
+
+# --------------- Instrumented calls --------------- #
+
+
+class NoInstrumentation(object):
+    """
+    The context returned by instrument() when the instrumentation is disabled. It is shared by all the calls: the
+    measures set on it (e.g. 'rows') are ignored.
+    """
+
+    __slots__ = ()
+
+    rows = 0
+
+    def __setattr__(self, name, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_NO_INSTRUMENTATION = NoInstrumentation()
+
+
+class InstrumentedCall(object):
+    """
+    The context measuring an instrumented call, see instrument()
+    """
+
+    def __init__(self, name, label, block, rows):
+        self.name = name
+        self.label = label
+        self.block = block
+        self.rows = rows
+
+        self.call_id = None
+        self.depth = 0
+        self.__start = None
+        self.__memory_start = None
+        self.__memory_peak = None
+
+    def __enter__(self):
+        stack = getattr(_state, 'stack', None)
+        if stack is None:
+            stack = _state.stack = []
+
+        if len(stack) > 0:
+            parent = stack[-1]
+            self.call_id = parent.call_id
+            self.depth = parent.depth + 1
+            if self.label is None:
+                self.label = parent.label
+            if self.block is None:
+                self.block = parent.block
+        else:
+            with _call_ids_lock:
+                _call_ids[0] += 1
+                self.call_id = _call_ids[0]
+
+        if _track_memory and tracemalloc.is_tracing():
+            # The peak is reset for this call: keep the one of the enclosing call so far
+            (current, peak) = tracemalloc.get_traced_memory()
+            if len(stack) > 0:
+                stack[-1].update_memory_peak(peak)
+            if hasattr(tracemalloc, 'reset_peak'):  # python >= 3.9, the peak is global otherwise
+                tracemalloc.reset_peak()
+            self.__memory_start = current
+            self.__memory_peak = current
+
+        stack.append(self)
+        self.__start = time.perf_counter()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        wall_time = time.perf_counter() - self.__start
+
+        stack = _state.stack
+        stack.pop()
+
+        peak_memory = None
+        if self.__memory_start is not None:
+            self.update_memory_peak(tracemalloc.get_traced_memory()[1])
+            peak_memory = self.__memory_peak - self.__memory_start
+            if len(stack) > 0:
+                stack[-1].update_memory_peak(self.__memory_peak)
+
+        rec = InstrumentationRecord(self.name, self.label, self.block, int(self.rows), wall_time, peak_memory,
+                                    self.call_id, self.depth)
+        for sink in list(_sinks):
+            sink.record(rec)
+
+        return False
+
+    def update_memory_peak(self, peak):
+        if self.__memory_peak is not None and peak > self.__memory_peak:
+            self.__memory_peak = peak
+
+
+def instrument(name, label=None, block=None, rows=0):
+    """
+    Return a context manager measuring the code it encloses, when the instrumentation is enabled:
+
+        with instrument('TariffBase.compute_bill', block=get_block_name(self)) as measure:
+            ...
+            measure.rows = len(df)
+
+    :param name: the name of the instrumented function
+    :param label: [optional] the tariff label, inherited from the enclosing instrumented call by default
+    :param block: [optional] the tariff block, inherited from the enclosing instrumented call by default
+    :param rows: [optional] the number of rows processed, that can also be set on the returned object
+    :return: a context manager
+    """
+
+    if len(_sinks) == 0:
+        return _NO_INSTRUMENTATION
+
+    return InstrumentedCall(name, label, block, rows)
+
+
+def instrumented(name):
+    """
+    Decorator measuring each call of a function, see instrument()
+    :param name: the name of the instrumented function
+    """
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with instrument(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
@@ -0,0 +1,113 @@
+__author__ = 'Olivier Van Cutsem'
+
+import numpy as np
+
+# --------------- Cost coefficients of a linear optimization problem --------------- #
+
+
+class LPCostCoefficients(object):
+    """
+    This class stores the cost of a tariff over a horizon, as the coefficients of a linear (or mixed-integer) program
+    whose variables are the energy consumed in each interval of 'date_index', E_t in kWh:
+
+        cost = energy_prices . E  +  demand_prices . D  +  fixed_cost
+
+        with D_k >= E_t / interval_hours  for each (k, t) such that demand_matrix[k, t] == 1
+
+     - 'energy_prices' is an array of the price of energy ($/kWh) in each interval, summed over the ENERGY labels
+     - each row k of the sparse matrix 'demand_matrix' (scipy.sparse CSR, of shape (nb_periods, nb_intervals)) selects
+     the intervals of a demand period: the intervals of a month where a DEMAND label has the same price. D_k is the max
+     demand (kW) of the period, 'demand_prices' its price ($/kW) and 'demand_periods' lists the tuples (label, month,
+     price) of the periods. The periods with a negative price (e.g. PDP credits) make the program non-convex.
+     - 'month_matrix' (CSR, of shape (nb_months, nb_intervals)) maps the intervals to the billing 'months', e.g. for
+     monthly energy or demand constraints
+     - 'fixed_cost' is the constant cost of the FIXED labels over the months of the horizon, detailed per month in
+     'fixed_cost_per_month'
+
+    The prices of each label are the ones of CostCalculator.get_electricity_price(), without the missing values: the
+    tiered rates (see BlockRate) are linearized at the rate of their first tier.
+
+    The demand windows (see TouDemandChargeTariff) aren't modelled: the constraints bound the demand of each interval,
+    which is an upper bound of the average demand over a window.
+
+    Remark: when the tariff blocks of a DEMAND label change within a month, the periods are split per price, each one
+    charged on its own intervals, whereas compute_bill() charges the max demand of the daily periods that share the same
+    pattern once.
+    """
+
+    def __init__(self, date_index, interval_hours, energy_prices, demand_matrix, demand_prices, demand_periods,
+                 months, month_matrix, fixed_cost_per_month):
+        """
+        Constructor
+        :param date_index: a pandas DatetimeIndex, the start of the intervals
+        :param interval_hours: the duration of an interval, in hours
+        :param energy_prices: an array of size nb_intervals
+        :param demand_matrix: a scipy.sparse matrix of shape (nb_periods, nb_intervals)
+        :param demand_prices: an array of size nb_periods
+        :param demand_periods: a list of nb_periods tuples (label, month, price)
+        :param months: a list of month labels, formatted as "YYYY-MM"
+        :param month_matrix: a scipy.sparse matrix of shape (nb_months, nb_intervals)
+        :param fixed_cost_per_month: an array of size nb_months
+        """
+
+        self.date_index = date_index
+        self.interval_hours = interval_hours
+
+        self.energy_prices = energy_prices
+
+        self.demand_matrix = demand_matrix
+        self.demand_prices = demand_prices
+        self.demand_periods = demand_periods
+
+        self.months = months
+        self.month_matrix = month_matrix
+
+        self.fixed_cost_per_month = fixed_cost_per_month
+        self.fixed_cost = float(np.sum(fixed_cost_per_month))
+
+    def get_cost(self, energy):
+        """
+        Evaluate the cost of energy profiles with these coefficients, e.g. to check a solution of the program
+        :param energy: an array of the energy (kWh) of each interval, or a 2-D array of shape (nb_intervals, nb_profiles)
+        :return: a float, or an array of the cost of each profile
+        """
+
+        energy = np.asarray(energy, dtype=float)
+        power = energy.reshape(len(energy), -1) / self.interval_hours
+
+        # The max demand of each period: the intervals of the periods are the non-zeros of the CSR rows
+        indptr = self.demand_matrix.indptr
+        indices = self.demand_matrix.indices
+        max_demand = np.zeros((len(self.demand_prices), power.shape[1]))
+        for k in range(len(self.demand_prices)):
+            if indptr[k + 1] > indptr[k]:
+                max_demand[k] = power[indices[indptr[k]:indptr[k + 1]]].max(axis=0)
+
+        cost = self.energy_prices.dot(power) * self.interval_hours + self.demand_prices.dot(max_demand) + self.fixed_cost
+
+        return float(cost[0]) if energy.ndim == 1 else cost
+
+    @property
+    def nb_intervals(self):
+        return len(self.date_index)
+
+    @property
+    def nb_demand_periods(self):
+        return len(self.demand_prices)
+
+
+def build_incidence_matrix(rows, cols, shape):
+    """
+    Build a sparse 0/1 matrix
+    :param rows: an array of the row of each non-zero
+    :param cols: an array of the column of each non-zero
+    :param shape: a tuple (nb_rows, nb_cols)
+    :return: a scipy.sparse CSR matrix, with sorted column indices in each row
+    """
+
+    from scipy import sparse  # only needed for the optimization problems
+
+    matrix = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=shape)
+    matrix.sort_indices()
+
+    return matrix
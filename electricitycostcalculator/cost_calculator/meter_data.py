@@ -0,0 +1,296 @@
+__author__ = 'Olivier Van Cutsem'
+
+import os
+
+import numpy as np
+import pandas as pd
+
+# --------------- Columnar meter data --------------- #
+
+
+class MeterDataFile(object):
+    """
+    This class reads the meter data stored in a columnar file: one column of energy consumption (in Wh) per meter,
+    and a column of timestamps sorted in increasing order. Only the requested meters and period are read:
+     - the Arrow IPC files (ARROW_EXTENSIONS) are memory-mapped: the meters are read from the pages of the file, without
+     copy when their column has no missing values and a single chunk
+     - the Parquet files (PARQUET_EXTENSIONS) only decode the columns of the requested meters, in the row groups
+     overlapping the requested period
+
+    The data read by read() can be billed directly, see bill_meter_data().
+    """
+
+    ARROW_EXTENSIONS = ('.arrow', '.feather', '.ipc')
+    PARQUET_EXTENSIONS = ('.parquet', '.pq')
+
+    def __init__(self, filename, time_column=None):
+        """
+        Constructor: only the schema of the file is read
+        :param filename: the path of an Arrow IPC or Parquet file
+        :param time_column: [optional] the name of the column of timestamps. By default, the index stored by pandas if
+        any (see save_meter_data), the first column of timestamps otherwise
+        """
+
+        import pyarrow as pa  # only needed to read columnar files
+
+        self.filename = filename
+
+        extension = os.path.splitext(filename)[1].lower()
+        if extension in self.ARROW_EXTENSIONS:
+            import pyarrow.ipc
+
+            self.__source = pa.memory_map(filename, 'r')
+            self.__reader = pyarrow.ipc.open_file(self.__source)
+            self.__is_parquet = False
+            schema = self.__reader.schema
+        elif extension in self.PARQUET_EXTENSIONS:
+            import pyarrow.parquet
+
+            self.__source = None
+            self.__reader = None
+            self.__is_parquet = True
+            schema = pyarrow.parquet.read_schema(filename, memory_map=True)
+        else:
+            raise ValueError("Unknown format of meter data file: '{0}'".format(filename))
+
+        if time_column is None:
+            time_column = self.get_time_column(schema)
+        if time_column is None:
+            raise ValueError("No column of timestamps in '{0}'".format(filename))
+
+        self.time_column = time_column
+        self.__schema = schema
+
+    @property
+    def meters(self):
+        """
+        The names of the meter columns, in the order of the file
+        """
+
+        pandas_metadata = self.__schema.pandas_metadata or {}
+        index_columns = [c for c in pandas_metadata.get('index_columns', []) if isinstance(c, str)]
+
+        return [name for name in self.__schema.names if name != self.time_column and name not in index_columns]
+
+    def read(self, meters=None, range_date=None, dtype=None):
+        """
+        Read the data of some meters over a period
+        :param meters: [optional] the list of the meter columns to read. All the meters by default
+        :param range_date: [optional] a tuple (t_start, t_end) of datetime, the (inclusive) period to read. The dates
+        without timezone are taken in the timezone of the timestamps. The whole file by default
+        :param dtype: [optional] the numpy dtype of the values, e.g. np.float32. The type of the columns is kept by
+        default if it is a floating point type, float64 otherwise
+        :return: a tuple (date_index, values), where date_index is a pandas DatetimeIndex and values a 2-D numpy array
+        of shape (len(date_index), len(meters))
+        """
+
+        if meters is None:
+            meters = self.meters
+
+        table = self.__read_table([self.time_column] + list(meters), range_date)
+        date_index = self.get_date_index(table.column(self.time_column))
+
+        # The range of the period: the Parquet row groups were filtered, the Arrow tables are sliced without copy
+        (idx_start, idx_end) = (0, len(date_index))
+        if range_date is not None:
+            (t_start, t_end) = [self.localize(t, date_index.tz) for t in range_date]
+            idx_start = date_index.searchsorted(t_start, side='left')
+            idx_end = date_index.searchsorted(t_end, side='right')
+            date_index = date_index[idx_start:idx_end]
+            table = table.slice(idx_start, idx_end - idx_start)
+
+        columns = [self.get_column_values(table.column(meter), dtype) for meter in meters]
+        if len(columns) == 1:
+            values = columns[0].reshape(-1, 1)  # a view on the column
+        else:
+            values = np.empty((len(date_index), len(columns)), dtype=columns[0].dtype if len(columns) > 0 else float)
+            for m_i, column in enumerate(columns):
+                values[:, m_i] = column
+
+        return date_index, values
+
+    def read_series(self, meter, range_date=None, dtype=None):
+        """
+        Read the data of a meter over a period, see read()
+        :return: a pandas Series, sharing the values read from the file when possible
+        """
+
+        (date_index, values) = self.read([meter], range_date, dtype)
+
+        return pd.Series(values[:, 0], index=date_index, name=meter, copy=False)
+
+    def close(self):
+        """
+        Release the memory-mapped file. The arrays read without copy must not be used after that.
+        :return: /
+        """
+
+        if self.__source is not None:
+            self.__source.close()
+            self.__source = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    # --- private
+
+    def __read_table(self, columns, range_date):
+        """
+        Read some columns of the file as a pyarrow Table
+        """
+
+        if not self.__is_parquet:
+            return self.__reader.read_all().select(columns)  # memory-mapped: the buffers point to the file
+
+        import pyarrow.parquet
+
+        filters = None
+        if range_date is not None:
+            time_type = self.__schema.field(self.time_column).type
+            tz = getattr(time_type, 'tz', None)
+            (t_start, t_end) = [self.localize(t, tz) for t in range_date]
+            filters = [(self.time_column, '>=', t_start), (self.time_column, '<=', t_end)]
+
+        return pyarrow.parquet.read_table(self.filename, columns=columns, filters=filters, memory_map=True)
+
+    @staticmethod
+    def get_time_column(schema):
+        """
+        Return the name of the column of timestamps of a schema: the index stored by pandas, or the first timestamp
+        column
+        :param schema: a pyarrow Schema
+        :return: a string, or None if there isn't any column of timestamps
+        """
+
+        import pyarrow as pa
+
+        pandas_metadata = schema.pandas_metadata or {}
+        for name in pandas_metadata.get('index_columns', []):
+            if isinstance(name, str) and pa.types.is_timestamp(schema.field(name).type):
+                return name
+
+        for field in schema:
+            if pa.types.is_timestamp(field.type):
+                return field.name
+
+        return None
+
+    @staticmethod
+    def get_date_index(time_column):
+        """
+        Convert a column of Arrow timestamps into a pandas DatetimeIndex, in the timezone of the column
+        :param time_column: a pyarrow ChunkedArray of timestamps
+        :return: a pandas DatetimeIndex
+        """
+
+        tz = time_column.type.tz
+        dates = time_column.to_numpy()  # datetime64, in UTC for the timestamps with a timezone
+
+        date_index = pd.DatetimeIndex(dates)
+        if tz is not None:
+            date_index = date_index.tz_localize('UTC').tz_convert(tz)
+
+        return date_index
+
+    @staticmethod
+    def get_column_values(column, dtype=None):
+        """
+        Return the values of a column as a numpy array, without copy when possible: a single chunk of floats, without
+        missing values and of the requested type. The missing values are NaN.
+        :param column: a pyarrow ChunkedArray
+        :param dtype: [optional] the numpy dtype of the values, see MeterDataFile.read()
+        :return: a 1-D numpy array
+        """
+
+        import pyarrow as pa
+
+        if dtype is None:
+            dtype = column.type.to_pandas_dtype() if pa.types.is_floating(column.type) else np.float64
+
+        if column.num_chunks == 1 and column.null_count == 0 and column.type.to_pandas_dtype() == dtype:
+            return column.chunk(0).to_numpy(zero_copy_only=True)
+
+        if not pa.types.is_floating(column.type):
+            column = column.cast(pa.float64())
+
+        return np.asarray(column.to_numpy(), dtype=dtype)  # the nulls are NaN
+
+    @staticmethod
+    def localize(date, tz):
+        """
+        Return a date as a pandas Timestamp in a timezone: a date without timezone is considered in this timezone
+        :param date: a datetime
+        :param tz: a timezone, or None
+        :return: a pandas Timestamp
+        """
+
+        date = pd.Timestamp(date)
+        if tz is None:
+            return date.tz_localize(None) if date.tzinfo is not None else date
+        elif date.tzinfo is None:
+            return date.tz_localize(tz)
+        else:
+            return date.tz_convert(tz)
+
+
+def save_meter_data(df, filename, row_group_size=None):
+    """
+    Store the meter data of a dataframe (one column per meter, indexed by date) in a columnar file that MeterDataFile
+    can read: an uncompressed Arrow IPC file, that can be memory-mapped, or a Parquet file, depending on the extension
+    of 'filename'
+    :param df: a pandas dataframe indexed by a DatetimeIndex
+    :param filename: the path of the file
+    :param row_group_size: [optional] the number of rows of the Parquet row groups, e.g. a month of data, such that
+    the periods are read without decoding the whole file
+    :return: /
+    """
+
+    import pyarrow as pa  # only needed to write columnar files
+
+    if df.index.name is None:
+        df = df.rename_axis('date')
+
+    table = pa.Table.from_pandas(df.sort_index())
+
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in MeterDataFile.ARROW_EXTENSIONS:
+        import pyarrow.ipc
+
+        table = table.combine_chunks()  # a single chunk per column: the meters can be read without copy
+        with pa.OSFile(filename, 'wb') as output_file:
+            with pyarrow.ipc.new_file(output_file, table.schema) as writer:
+                writer.write_table(table)
+    elif extension in MeterDataFile.PARQUET_EXTENSIONS:
+        import pyarrow.parquet
+
+        pyarrow.parquet.write_table(table, filename, row_group_size=row_group_size)
+    else:
+        raise ValueError("Unknown format of meter data file: '{0}'".format(filename))
+
+
+def bill_meter_data(bill_calculator, meter_file, meters=None, range_date=None, as_bill=False, low_memory=False):
+    """
+    Bill some meters of a columnar file over a period, reading only their data, see CostCalculator.compute_bill_batch()
+    :param bill_calculator: a CostCalculator object
+    :param meter_file: a MeterDataFile object, or the path of a file
+    :param meters: [optional] the list of the meters to bill. All the meters by default
+    :param range_date: [optional] a tuple (t_start, t_end) of datetime, the period to bill. The whole file by default
+    :param as_bill: [optional] see CostCalculator.compute_bill_batch()
+    :param low_memory: [optional] see CostCalculator.compute_bill_batch()
+    :return: see CostCalculator.compute_bill_batch()
+    """
+
+    if not isinstance(meter_file, MeterDataFile):
+        with MeterDataFile(meter_file) as opened_file:
+            return bill_meter_data(bill_calculator, opened_file, meters, range_date, as_bill, low_memory)
+
+    if meters is None:
+        meters = meter_file.meters
+
+    (date_index, values) = meter_file.read(meters, range_date)
+
+    return bill_calculator.compute_bill_batch(values, date_index=date_index, columns=list(meters), as_bill=as_bill,
+                                              low_memory=low_memory)
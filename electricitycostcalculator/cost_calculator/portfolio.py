@@ -0,0 +1,126 @@
+__author__ = 'Olivier Van Cutsem'
+
+from concurrent.futures import ProcessPoolExecutor
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from .bill import Bill
+
+# --------------- Portfolio billing --------------- #
+
+# The state of a worker process, loaded on its first task by get_portfolio_worker_state()
+_worker_state = {}
+
+
+def compute_bill_portfolio(bill_calculator, data, date_index=None, columns=None, max_workers=None, meters_per_task=200,
+                           as_bill=False):
+    """
+    Compute the bill of a portfolio of meters sharing the same time index, fanning the work out over a pool of
+    processes. See CostCalculator.compute_bill_batch() for the format of the inputs and of the returned table.
+
+    The tariff is compiled (see CostCalculator.compile()) and pickled once, along with the time index, to a file that
+    each worker loads on its first task. The meter data is written once to a memory-mapped file, that the workers map
+    instead of receiving pickled dataframes: a task is only a range of columns and the paths of the two files. Both
+    files are in shared memory (/dev/shm) when it exists.
+
+    :param bill_calculator: a CostCalculator object
+    :param data: a pandas dataframe whose columns contain the energy consumption (in Wh) of each meter, or a 2-D
+    numpy array of shape (nb_dates, nb_meters)
+    :param date_index: [optional] the pandas DatetimeIndex of the rows of 'data', if it is a numpy array
+    :param columns: [optional] the columns of the dataframe to bill, all by default. If 'data' is a numpy array,
+    the names of its columns (their position by default)
+    :param max_workers: [optional] the number of processes, the number of CPUs by default
+    :param meters_per_task: [optional] the number of meters billed by a worker in a task
+    :param as_bill: [optional] if True, a Bill object is returned instead of the table
+    :return: a pandas dataframe with the columns 'meter', 'month', 'label', 'metric' and 'cost', or a Bill object
+    """
+
+    if isinstance(data, pd.DataFrame):
+        if columns is not None:
+            data = data.loc[:, columns]
+        columns = list(data.columns)
+        date_index = data.index
+        data = data.values
+    elif columns is None:
+        columns = list(range(data.shape[1]))
+
+    nb_meters = data.shape[1]
+    bill_calculator.compile()
+
+    shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+    shm_paths = []
+    for suffix in ['.pkl', '.dat']:
+        fd, path = tempfile.mkstemp(prefix='ecc_portfolio_', suffix=suffix, dir=shm_dir)
+        os.close(fd)
+        shm_paths.append(path)
+    (state_path, values_path) = shm_paths
+
+    try:
+        with open(state_path, 'wb') as state_file:
+            pickle.dump((bill_calculator, date_index), state_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+        shared_values = np.memmap(values_path, dtype=np.float64, mode='w+', shape=data.shape)
+        shared_values[:] = data
+        shared_values.flush()
+        del shared_values
+
+        # The worker state is loaded by the first task of each worker: the 'initializer' of the pool needs Python 3.7
+        list_bills = []
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            tasks = [((state_path, values_path, data.shape), idx_start, min(idx_start + meters_per_task, nb_meters),
+                      columns[idx_start:idx_start + meters_per_task], as_bill)
+                     for idx_start in range(0, nb_meters, meters_per_task)]
+            for bill_table in executor.map(compute_bill_portfolio_task, tasks):
+                list_bills.append(bill_table)
+    finally:
+        for path in shm_paths:
+            os.remove(path)
+
+    if as_bill:
+        return Bill.concat(list_bills)
+    else:
+        return pd.concat(list_bills, ignore_index=True)
+
+
+def get_portfolio_worker_state(state_key):
+    """
+    Return the state of a worker process of compute_bill_portfolio(): the compiled tariff, the time index and the
+    mapped meter data. They are loaded by the first task of the worker, and kept for the next tasks of the portfolio.
+    :param state_key: a tuple (state_path, values_path, shape) of the files written by compute_bill_portfolio() and of
+    the shape of the meter data
+    :return: a dict {'bill_calculator': ..., 'date_index': ..., 'values': ...}
+    """
+
+    if _worker_state.get('key') != state_key:
+        (state_path, values_path, shape) = state_key
+        with open(state_path, 'rb') as state_file:
+            (bill_calculator, date_index) = pickle.load(state_file)
+
+        _worker_state.clear()
+        _worker_state.update({'key': state_key,
+                              'bill_calculator': bill_calculator,
+                              'date_index': date_index,
+                              'values': np.memmap(values_path, dtype=np.float64, mode='r', shape=shape)})
+
+    return _worker_state
+
+
+def compute_bill_portfolio_task(task):
+    """
+    Bill a range of meters, in a worker process of compute_bill_portfolio()
+    :param task: a tuple (state_key, idx_start, idx_end, columns, as_bill) of the worker state (see
+    get_portfolio_worker_state()), the range of columns to bill, their names and the format of the result
+    :return: a pandas dataframe or a Bill object, see CostCalculator.compute_bill_batch()
+    """
+
+    (state_key, idx_start, idx_end, columns, as_bill) = task
+    worker_state = get_portfolio_worker_state(state_key)
+
+    return worker_state['bill_calculator'].compute_bill_batch(worker_state['values'][:, idx_start:idx_end],
+                                                              date_index=worker_state['date_index'],
+                                                              columns=columns,
+                                                              as_bill=as_bill)
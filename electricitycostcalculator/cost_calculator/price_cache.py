@@ -0,0 +1,127 @@
+__author__ = 'Olivier Van Cutsem'
+
+from collections import OrderedDict
+
+import pandas as pd
+
+from .block_index import TariffBlockIndex
+
+# --------------- Price signal cache --------------- #
+
+
+class PriceSignalCache(object):
+    """
+    This class is a bounded LRU cache of price signals, as generated by CostCalculator.get_price_matrix().
+
+    Each entry is the price vector of one tariff label over a regular DatetimeIndex. It is keyed on the fingerprint of
+    the content of the label's tariff blocks (see CostCalculator.get_label_fingerprint()), the sampling timestep and the
+    timezone of the dates, such that:
+     - a request is served as a slice of any cached vector that covers it, on the same time grid
+     - calculators with the same tariffs can share a cache
+    """
+
+    DEFAULT_MAXSIZE = 64
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE):
+        """
+        Constructor
+        :param maxsize: [optional] the maximum number of price vectors to keep
+        """
+
+        self.maxsize = maxsize
+
+        # (fingerprint, timestep, tz, first date, last date) -> (date_index, prices), the least recently used first
+        self.__entries = OrderedDict()
+
+        # Statistics
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, fingerprint, timestep, date_index):
+        """
+        Look up the price vector of a tariff label over a regular DatetimeIndex
+        :param fingerprint: the fingerprint of the tariff label
+        :param timestep: an element of TariffElemPeriod enumeration, the sampling period of 'date_index'
+        :param date_index: a non-empty pandas DatetimeIndex, sampled at 'timestep'
+        :return: a read-only numpy array aligned with 'date_index', or None if it is not in the cache
+        """
+
+        group = (fingerprint, timestep.value, str(date_index.tz))
+
+        for key, (cached_index, cached_prices) in reversed(list(self.__entries.items())):
+            if key[:3] != group or date_index[0] < key[3] or date_index[-1] > key[4]:
+                continue
+
+            # The request must be on the same time grid
+            idx_start = cached_index.searchsorted(date_index[0])
+            idx_end = idx_start + len(date_index)
+            if cached_index[idx_start] != date_index[0] or idx_end > len(cached_index) or cached_index[idx_end - 1] != date_index[-1]:
+                continue
+
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return cached_prices[idx_start:idx_end]
+
+        self.misses += 1
+        return None
+
+    def put(self, fingerprint, timestep, date_index, prices):
+        """
+        Store the price vector of a tariff label, evicting the least recently used vectors beyond 'maxsize'
+        :param fingerprint: the fingerprint of the tariff label
+        :param timestep: an element of TariffElemPeriod enumeration, the sampling period of 'date_index'
+        :param date_index: a non-empty pandas DatetimeIndex, sampled at 'timestep'
+        :param prices: a numpy array aligned with 'date_index'. It is copied.
+        :return: /
+        """
+
+        prices = prices.copy()
+        prices.flags.writeable = False
+
+        key = (fingerprint, timestep.value, str(date_index.tz), date_index[0], date_index[-1])
+        self.__entries[key] = (date_index, prices)
+        self.__entries.move_to_end(key)
+
+        while len(self.__entries) > self.maxsize:
+            self.__entries.popitem(last=False)
+
+    def rekey(self, fingerprint, new_fingerprint, range_date):
+        """
+        Update the cache after tariff blocks effective over 'range_date' have been added to a label: the vectors of the
+        label that don't overlap this period (with a margin of a day, as the blocks are selected per day) are still
+        valid and moved to the new fingerprint of the label, the others are dropped.
+        :param fingerprint: the fingerprint of the label before the blocks were added
+        :param new_fingerprint: the fingerprint of the label after the blocks were added
+        :param range_date: a tuple (t_start, t_end) of datetime, the period spanned by the new blocks
+        :return: /
+        """
+
+        ts_start = TariffBlockIndex.to_timestamp(range_date[0])
+        ts_end = TariffBlockIndex.to_timestamp(range_date[1])
+        margin = pd.Timedelta(days=1)
+
+        entries = OrderedDict()
+        for key, entry in list(self.__entries.items()):
+            if key[0] != fingerprint:
+                entries[key] = entry
+            elif TariffBlockIndex.to_timestamp(key[4] + margin) < ts_start or TariffBlockIndex.to_timestamp(key[3] - margin) > ts_end:
+                entries[(new_fingerprint,) + key[1:]] = entry
+
+        self.__entries = entries
+
+    def clear(self):
+        """
+        Remove all the price vectors
+        :return: /
+        """
+
+        self.__entries.clear()
+
+    def __getstate__(self):
+        # The price vectors are not sent along with the calculator, e.g. to the workers of compute_bill_portfolio()
+        state = self.__dict__.copy()
+        state['_PriceSignalCache__entries'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.__entries)
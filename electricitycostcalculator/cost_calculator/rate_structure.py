@@ -2,8 +2,12 @@ __author__ = 'Olivier Van Cutsem'
 
 from enum import Enum
 from datetime import datetime
+from functools import reduce
+from math import gcd
 
-import holidays
+import numpy as np
+
+from .day_calendar import get_holiday_calendar
 
 # --------------- Schedule structures --------------- #
 
@@ -38,9 +42,13 @@ class TouRateSchedule:
 
     Remark: a month spans from 1 (january) to 12 (december) ; a day spans from 0 (sunday) to 6 (saturday)
 
-    """
+    The first time the rates are looked up by array, the dict is compiled into a dense table indexed by
+    (month, day, slot of the day), see 'rate_table'. The dict must therefore not be modified after that.
 
-    # TODO: use BlockRate instead of assuming it's a float !
+    A rate can also be a BlockRate, whose price depends on the energy consumed in the month (or the demand): the table
+    then stores its base rate, and 'tier_table' tells which slots are tiered, see get_tiers_from_index().
+
+    """
 
     # Keys used internally
     MONTHLIST_KEY = 'months_list'
@@ -48,16 +56,27 @@ class TouRateSchedule:
     DAYSLIST_KEY = 'days_list'
     RATES_KEY = 'rates'
 
-    def __init__(self, rates_schedule):
+    def __init__(self, rates_schedule, holiday_calendar=None):
         """
         Constructor
         :param rates_schedule: a dict formatted as explain in the class description
+        :param holiday_calendar: [optional] a HolidayCalendar mapping the dates to the days used in 'days_list'.
+        The process-wide calendar of California is used by default.
         """
 
         # TODO: assert the format is correct
 
         self.__rates = rates_schedule
 
+        if holiday_calendar is None:
+            holiday_calendar = get_holiday_calendar('US', 'CA')
+        self.holiday_calendar = holiday_calendar
+
+        # The compiled version of the rates, built on demand
+        self.__rate_table = None
+        self.__tier_table = None
+        self.__block_rates = None
+
     def get_from_timestamp(self, date):
         """
         Return the rate corresponding to a given timestamp
@@ -102,20 +121,186 @@ class TouRateSchedule:
         else:
             return rate_struct
 
-    # --- private
-    @staticmethod
-    def get_day_in_the_week(date_sel):
+    def get_rates_from_index(self, date_index, features=None):
+        """
+        Return the rates corresponding to each date of a pandas DatetimeIndex, in a single vectorized lookup
+        :param date_index: a pandas DatetimeIndex
+        :param features: [optional] the TimestampFeatures of 'date_index', shared with the other schedules. The index is
+        decomposed by this call otherwise.
+        :return: a numpy array of float, aligned with 'date_index'. NaN where there is no associated rate
         """
-        TODO write description
 
-        :param date_sel:
-        :return:
+        rate_table = self.rate_table
+
+        return rate_table[self.get_table_positions(date_index, rate_table.shape[2], features)]
+
+    def get_tiers_from_index(self, date_index, features=None):
+        """
+        Return the BlockRate that applies to each date of a pandas DatetimeIndex
+        :param date_index: a pandas DatetimeIndex
+        :param features: [optional] the TimestampFeatures of 'date_index', see get_rates_from_index()
+        :return: a numpy array of int, aligned with 'date_index': 0 where the rate is not tiered, the position + 1 of the
+        BlockRate in 'block_rates' otherwise
         """
 
-        if date_sel in holidays.US(state='CA', years=date_sel.year):
-            return 0  # Hardcoded: holidays are like Sundays ...
+        tier_table = self.tier_table
+
+        return tier_table[self.get_table_positions(date_index, tier_table.shape[2], features)]
+
+    def get_table_positions(self, date_index, nb_slots, features=None):
+        """
+        Return the positions of the dates of a DatetimeIndex in the compiled tables, see 'rate_table'
+        :param date_index: a pandas DatetimeIndex
+        :param nb_slots: the number of slots in a day of the table
+        :param features: [optional] the TimestampFeatures of 'date_index'
+        :return: a tuple of 3 numpy arrays of int (months, days, slots), aligned with 'date_index'
+        """
+
+        if features is None:
+            m_dates = np.asarray(date_index.month) - 1
+            d_dates = self.get_days_in_the_week(date_index)
+            slots = (np.asarray(date_index.hour) * 60 + np.asarray(date_index.minute)) * nb_slots // (24 * 60)
         else:
-            return date_sel.weekday()
+            m_dates = features.months
+            d_dates = features.get_day_types(self.holiday_calendar)
+            slots = features.get_slots(nb_slots)
+
+        return m_dates, d_dates, slots
+
+    @property
+    def is_tiered(self):
+        """
+        True if at least one rate of the schedule is a BlockRate
+        """
+
+        return len(self.block_rates) > 0
+
+    @property
+    def tier_table(self):
+        """
+        The BlockRates compiled as a numpy array of int of the same shape as 'rate_table': 0 for the slots with a flat
+        rate, the position + 1 of the BlockRate in 'block_rates' otherwise
+        """
+
+        if self.__tier_table is None:
+            (self.__tier_table, self.__block_rates) = self.compile_tier_table()
+
+        return self.__tier_table
+
+    @property
+    def block_rates(self):
+        """
+        The distinct BlockRates of the schedule, see 'tier_table'
+        """
+
+        if self.__block_rates is None:
+            (self.__tier_table, self.__block_rates) = self.compile_tier_table()
+
+        return self.__block_rates
+
+    @property
+    def rate_table(self):
+        """
+        The rates compiled as a numpy array of shape (12, 7, nb_slots), mapping (month-1, day, slot) to a rate.
+        The number of slots in a day is the smallest one that represents all the daily rates of the schedule.
+        """
+
+        if self.__rate_table is None:
+            self.__rate_table = self.compile_rate_table()
+
+        return self.__rate_table
+
+    def compile_rate_table(self):
+        """
+        Build the dense (month x day x slot) array of rates from the rates dict
+        :return: a numpy array of float, with NaN for the (month, day) that don't have any rate
+        """
+
+        # All the daily rates must be representable with the same number of slots
+        lengths = [1]
+        for m_data in list(self.__rates.values()):
+            for d_data in list(m_data[self.DAILY_RATE_KEY].values()):
+                if type(d_data[self.RATES_KEY]) is list:
+                    lengths.append(len(d_data[self.RATES_KEY]))
+        nb_slots = reduce(lambda a, b: a * b // gcd(a, b), lengths)
+
+        rate_table = np.full((12, 7, nb_slots), np.nan)
+        for m_date in range(1, 13):
+            for d_date in range(7):
+                rate_struct = self.get_rate(m_date, d_date)
+                if rate_struct is None:
+                    continue
+                if type(rate_struct) is list:
+                    rate_table[m_date - 1, d_date, :] = np.repeat([float(r) for r in rate_struct], nb_slots // len(rate_struct))
+                else:
+                    rate_table[m_date - 1, d_date, :] = float(rate_struct)
+
+        return rate_table
+
+    def compile_tier_table(self):
+        """
+        Build the dense (month x day x slot) array of BlockRates from the rates dict, see 'tier_table'
+        :return: a tuple (tier_table, block_rates)
+        """
+
+        nb_slots = self.rate_table.shape[2]
+
+        tier_table = np.zeros((12, 7, nb_slots), dtype=np.int32)
+        block_rates = []
+        for m_date in range(1, 13):
+            for d_date in range(7):
+                rate_struct = self.get_rate(m_date, d_date)
+                if rate_struct is None:
+                    continue
+                if type(rate_struct) is not list:
+                    rate_struct = [rate_struct]
+                for i, r in enumerate(rate_struct):
+                    if not isinstance(r, BlockRate):
+                        continue
+                    if r not in block_rates:
+                        block_rates.append(r)
+                    slot_len = nb_slots // len(rate_struct)
+                    tier_table[m_date - 1, d_date, i * slot_len:(i + 1) * slot_len] = block_rates.index(r) + 1
+
+        return tier_table, block_rates
+
+    def update_fingerprint(self, hash_obj):
+        """
+        Feed the compiled rates and the holiday calendar to a hash object, see TariffBase.update_fingerprint()
+        :param hash_obj: a hashlib object
+        :return: /
+        """
+
+        rate_table = self.rate_table
+        calendar = self.holiday_calendar
+
+        hash_obj.update(repr((rate_table.shape, calendar.country, calendar.state, calendar.holiday_day_type)).encode())
+        hash_obj.update(rate_table.tobytes())
+
+        if self.is_tiered:
+            hash_obj.update(repr([br.key for br in self.block_rates]).encode())
+            hash_obj.update(self.tier_table.tobytes())
+
+    # --- private
+    def get_days_in_the_week(self, date_index):
+        """
+        Vectorized version of 'get_day_in_the_week', for a pandas DatetimeIndex
+        :param date_index: a pandas DatetimeIndex
+        :return: a numpy array of int
+        """
+
+        return self.holiday_calendar.get_day_types(date_index)
+
+    def get_day_in_the_week(self, date_sel):
+        """
+        Return the day used to select the daily rates of 'date_sel': its day of the week, or the day given to the
+        holidays by the holiday calendar (holidays are like Sundays ...)
+
+        :param date_sel: a datetime
+        :return: an int
+        """
+
+        return self.holiday_calendar.get_day_type(date_sel)
 
     def get_rate_in_day(self, rate_struct, time_select):
         """
@@ -172,31 +357,105 @@ class TouRateSchedule:
 
 class BlockRate:
     """
-    This class stores and manipulates the rate of energy that vary as a function of the total consumption energy
+    This class stores and manipulates the rate of energy that vary as a function of the total consumption energy:
+    the rate is 'cost_base' up to the first threshold, then the i-th rate of 'block_rate' from its i-th threshold.
+    The thresholds are expressed in the unit of the metric (e.g. kWh of energy consumed in the month, or kW of demand).
+
+    A BlockRate can be used as a rate in a TouRateSchedule: it is then worth its base rate in the price signals.
     """
 
     def __init__(self, cost_base, block_rate=None):
+        """
+        Constructor
+        :param cost_base: the rate of the first tier
+        :param block_rate: [optional] a tuple (costs, thresholds) of lists: the rate of each next tier and the value
+        of the metric from which it applies, in increasing order
+        """
 
-        self.__rates = [cost_base]
-        self.__thresholds = [0]
+        rates = [cost_base]
+        thresholds = [0]
 
         if block_rate is not None:
 
             (costs, thres) = block_rate
-            self.__rates += costs
-            self.__thresholds += thres
+            rates += list(costs)
+            thresholds += list(thres)
 
-        self.__thresholds.append(float('inf'))
+        self.__rates = np.asarray(rates, dtype=float)
+        self.__thresholds = np.asarray(thresholds, dtype=float)
+
+        # The cost of the metric up to each threshold
+        self.__costs_at_thresholds = np.concatenate(([0.0], np.cumsum(np.diff(self.__thresholds) * self.__rates[:-1])))
 
     def get_rate(self, acc=None):
         """
-
-        :param acc:
-        :return:
+        Return the rate that applies at a value of the metric
+        :param acc: [optional] the value of the metric, e.g. the energy consumed so far. The base rate by default
+        :return: a float
         """
 
         if acc is None:
-            return self.__rates[0]
+            return float(self.__rates[0])
         else:
-            return [self.__rates[i] for i in range(len(self.__rates)) if self.__thresholds[i] <= acc < self.__thresholds[i+1]][0]
+            return float(self.get_rates(acc))
+
+    def get_rates(self, acc):
+        """
+        Vectorized version of get_rate()
+        :param acc: a numpy array of the values of the metric
+        :return: a numpy array of the rates, of the same shape
+        """
+
+        return self.__rates[self.get_tiers(acc)]
+
+    def get_cost(self, acc):
+        """
+        Return the cost of a metric, summed over the tiers it spans: e.g. the cost of the energy consumed from 0 to
+        'acc'. A negative value is billed at the base rate.
+        :param acc: a float or a numpy array of the values of the metric
+        :return: a float or a numpy array of the same shape
+        """
+
+        tiers = self.get_tiers(acc)
+
+        return self.__costs_at_thresholds[tiers] + self.__rates[tiers] * (acc - self.__thresholds[tiers])
+
+    def get_tiers(self, acc):
+        """
+        Return the tier of each value of the metric
+        :param acc: a float or a numpy array of the values of the metric
+        :return: an int or a numpy array of int, the positions of the tiers
+        """
+
+        return np.maximum(np.searchsorted(self.__thresholds, acc, side='right') - 1, 0)
+
+    @property
+    def rates(self):
+        return self.__rates
+
+    @property
+    def thresholds(self):
+        return self.__thresholds
+
+    @property
+    def key(self):
+        """
+        A hashable tuple identifying the tiers
+        """
+
+        return tuple(self.__rates.tolist()), tuple(self.__thresholds.tolist())
+
+    def __float__(self):
+        return float(self.__rates[0])
+
+    def __eq__(self, other):
+        return isinstance(other, BlockRate) and self.key == other.key
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.key)
 
+    def __repr__(self):
+        return 'BlockRate({0!r}, {1!r})'.format(self.__rates.tolist(), self.__thresholds.tolist())
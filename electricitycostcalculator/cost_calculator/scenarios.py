@@ -0,0 +1,244 @@
+__author__ = 'Olivier Van Cutsem'
+
+import numpy as np
+
+from .bill import Bill
+from .rate_structure import ChargeType
+from .tariff_structure import FixedTariff, TouDemandChargeTariff, TouEnergyChargeTariff
+from .timestamp_features import TimestampFeatures
+
+# --------------- Scenario evaluation --------------- #
+
+
+class ScenarioEvaluator(object):
+    """
+    This class bills many load profiles (scenarios) defined on the same time index with the tariff of a CostCalculator,
+    e.g. the candidate profiles of a battery sizing or a demand response study.
+
+    Everything that only depends on the index is computed once, when the evaluator is created:
+     - the months and the range of each tariff block
+     - FIX: the fixed cost of each month
+     - ENERGY: the price of each interval. The blocks sharing the same range are billed with a single matrix product
+     - DEMAND: the TOU period of each interval, as runs of consecutive intervals
+
+    evaluate() then only reads the scenarios: the energy costs are matrix products and the max demand of each run is
+    a single reduction over the data of the month.
+
+    The tiered energy rates (see BlockRate), the demand windows and the unknown types of tariff blocks are billed as
+    compute_bill_batch() does, with the timestamp features computed once.
+    """
+
+    def __init__(self, bill_calculator, date_index):
+        """
+        Constructor
+        :param bill_calculator: a CostCalculator object, holding the tariff blocks. They must not change afterwards.
+        :param date_index: a non-empty pandas DatetimeIndex, the dates of the intervals of the scenarios
+        """
+
+        self.bill_calculator = bill_calculator
+
+        self.__idx_sort = None
+        if not date_index.is_monotonic_increasing:
+            self.__idx_sort = np.argsort(date_index.values, kind='mergesort')
+            date_index = date_index[self.__idx_sort]
+
+        self.date_index = date_index
+
+        self.labels = bill_calculator.get_labels()
+        self.label_types = [bill_calculator.type_tariffs_map[label] for label in self.labels]
+        self.months = bill_calculator.get_billing_months(date_index[0], date_index[-1])
+
+        # The billing terms of each kind, in the order compute_bill_batch() merges them
+        self.__fixed = []  # (m_i, l_i, metric, cost)
+        self.__energy = {}  # (idx_start, idx_end) -> (list of the price vectors, list of (m_i, l_i, mult_energy_unit))
+        self.__demand = []  # (m_i, l_i, idx_start, idx_end, block, segments bounds, periods, power_coeff)
+        self.__others = []  # (m_i, l_i, idx_start, idx_end, block, features)
+
+        self.__compile()
+
+    def evaluate(self, scenarios, names=None, as_bill=False):
+        """
+        Compute the bill of each scenario, detailed for each month of the calendar
+        :param scenarios: a 2-D numpy array of shape (nb_scenarios, len(date_index)), the energy consumption (in Wh) of
+        each scenario in each interval
+        :param names: [optional] the names of the scenarios, their position by default
+        :param as_bill: [optional] if True, a Bill object is returned instead of the table. Set to False by default.
+        :return: a pandas dataframe with the columns 'meter' (the scenario), 'month', 'label', 'metric' and 'cost', or a
+        Bill object, see CostCalculator.compute_bill_batch()
+        """
+
+        scenarios = np.asarray(scenarios, dtype=float)
+        if scenarios.ndim == 1:
+            scenarios = scenarios.reshape(1, -1)
+
+        if scenarios.shape[1] != len(self.date_index):
+            raise ValueError("The scenarios have {0} intervals instead of {1}".format(scenarios.shape[1], len(self.date_index)))
+
+        if self.__idx_sort is not None:
+            scenarios = scenarios[:, self.__idx_sort]
+
+        nb_scenarios = scenarios.shape[0]
+        if names is None:
+            names = list(range(nb_scenarios))
+
+        metrics = np.zeros((nb_scenarios, len(self.months), len(self.labels)))
+        costs = np.zeros((nb_scenarios, len(self.months), len(self.labels)))
+        demand_per_month = {}  # (m_i, l_i) -> the demand merged over the blocks, see merge_demand_bill_matrix()
+
+        for (m_i, l_i, metric, cost) in self.__fixed:
+            metrics[:, m_i, l_i] += metric
+            costs[:, m_i, l_i] += cost
+
+        # ENERGY: the energy and the cost of all the blocks of a range in one product
+        for (idx_start, idx_end), (prices, terms) in list(self.__energy.items()):
+            result = scenarios[:, idx_start:idx_end].dot(prices)
+            for t_i, (m_i, l_i, mult_energy_unit) in enumerate(terms):
+                metrics[:, m_i, l_i] += result[:, 0] / mult_energy_unit
+                costs[:, m_i, l_i] += result[:, t_i + 1]
+
+        for (m_i, l_i, idx_start, idx_end, block, bounds, periods, power_coeff) in self.__demand:
+            bill_data = self.__get_demand_bill(scenarios[:, idx_start:idx_end], self.date_index[idx_start:idx_end],
+                                               block, bounds, periods, power_coeff)
+            self.bill_calculator.merge_demand_bill_matrix(demand_per_month.setdefault((m_i, l_i), {}), bill_data)
+
+        for (m_i, l_i, idx_start, idx_end, block, features) in self.__others:
+            bill_data = block.compute_monthly_bill_matrix(self.date_index[idx_start:idx_end],
+                                                          scenarios[:, idx_start:idx_end].T, features)
+            if self.label_types[l_i] == ChargeType.DEMAND:
+                self.bill_calculator.merge_demand_bill_matrix(demand_per_month.setdefault((m_i, l_i), {}), bill_data)
+            else:
+                metrics[:, m_i, l_i] += bill_data[0]
+                costs[:, m_i, l_i] += bill_data[1]
+
+        demand_parts = [] if as_bill else None
+        for (m_i, l_i), demand_bill in sorted(demand_per_month.items(), key=lambda item: (item[0][1], item[0][0])):
+            self.bill_calculator.add_demand_bill_matrix(metrics, costs, demand_parts, m_i, l_i, demand_bill)
+
+        bill = Bill(names, self.months, self.labels, self.label_types, metrics, costs,
+                    Bill.concat_demand_tables(demand_parts or []))
+
+        if as_bill:
+            return bill
+        else:
+            return bill.to_frame()
+
+    # --- private
+
+    def __compile(self):
+        """
+        Split the index into the billing terms of each tariff block and month
+        """
+
+        date_index = self.date_index
+        features = TimestampFeatures(date_index)
+        idx_months = {month_label: m_i for m_i, month_label in enumerate(self.months)}
+
+        for l_i, label in enumerate(self.labels):
+            for tariff_block in self.bill_calculator.get_tariff_struct(label, (date_index[0], date_index[-1])):
+                (idx_block_start, idx_block_end) = tariff_block.get_window_slice(date_index)
+
+                for (month_label, idx_start, idx_end) in features.slice(idx_block_start, idx_block_end).get_monthly_slices():
+                    (idx_start, idx_end) = (idx_block_start + idx_start, idx_block_start + idx_end)
+                    m_i = idx_months[month_label]
+                    date_month = date_index[idx_start:idx_end]
+                    features_month = features.slice(idx_start, idx_end)
+
+                    if isinstance(tariff_block, FixedTariff):
+                        (nb_days, bill) = tariff_block.compute_fixed_bill(date_month)
+                        self.__fixed.append((m_i, l_i, nb_days, bill))
+                    elif isinstance(tariff_block, TouEnergyChargeTariff) and not self.__is_tiered(tariff_block, date_month, features_month):
+                        mult_energy_unit = float(tariff_block.unit_metric.value)
+                        prices = tariff_block.get_price_vector(date_month, features_month)
+                        prices = prices * float(tariff_block.unit_cost.value) / mult_energy_unit
+
+                        (prices_range, terms) = self.__energy.setdefault((idx_start, idx_end), ([np.ones(idx_end - idx_start)], []))
+                        prices_range.append(prices)
+                        terms.append((m_i, l_i, mult_energy_unit))
+                    elif isinstance(tariff_block, TouDemandChargeTariff) and tariff_block.demand_window is None:
+                        periods = tariff_block.get_demand_periods(date_month, features_month)
+                        if len(periods) > 0:
+                            (bounds, periods_runs) = self.get_period_runs(periods)
+                            self.__demand.append((m_i, l_i, idx_start, idx_end, tariff_block, bounds, periods_runs,
+                                                  tariff_block.get_power_coeff(date_month, features_month)))
+                    else:
+                        self.__others.append((m_i, l_i, idx_start, idx_end, tariff_block, features_month))
+
+        self.__energy = {idx_range: (np.column_stack(prices_range), terms)
+                         for idx_range, (prices_range, terms) in list(self.__energy.items())}
+
+    @staticmethod
+    def __is_tiered(tariff_block, date_index, features):
+        """
+        Return True if some intervals of a month are billed on a BlockRate
+        """
+
+        return tariff_block.rate_schedule.is_tiered and tariff_block.rate_schedule.get_tiers_from_index(date_index, features).any()
+
+    @staticmethod
+    def get_period_runs(periods):
+        """
+        Split the intervals of the TOU periods of a month into runs of consecutive intervals
+        :param periods: the periods of a month, see TouDemandChargeTariff.get_demand_periods()
+        :return: a tuple (bounds, periods_runs), where 'bounds' is the sorted array of the first position of each run
+        and of each gap between the runs, and 'periods_runs' lists the tuples (price, mask, block_rate, runs_id,
+        runs_start, runs_length) of the periods, with 'runs_id' the positions of their runs in 'bounds'
+        """
+
+        runs = []
+        for (price, mask, idx_period, block_rate) in periods:
+            idx_breaks = np.flatnonzero(np.diff(idx_period) != 1) + 1
+            runs_start = idx_period[np.concatenate(([0], idx_breaks))]
+            runs_end = idx_period[np.concatenate((idx_breaks - 1, [len(idx_period) - 1]))] + 1
+            runs.append((price, mask, block_rate, runs_start, runs_end - runs_start))
+
+        # The runs of different periods don't overlap: their bounds split the month into runs and gaps
+        nb_dates = max(runs_start[-1] + runs_length[-1] for (_, _, _, runs_start, runs_length) in runs)
+        bounds = np.unique(np.concatenate([np.concatenate((runs_start, runs_start + runs_length))
+                                           for (_, _, _, runs_start, runs_length) in runs]))
+        bounds = bounds[bounds < nb_dates]
+
+        periods_runs = [(price, mask, block_rate, np.searchsorted(bounds, runs_start), runs_start, runs_length)
+                        for (price, mask, block_rate, runs_start, runs_length) in runs]
+
+        return bounds, periods_runs
+
+    @staticmethod
+    def __get_demand_bill(values, date_index, tariff_block, bounds, periods, power_coeff):
+        """
+        Compute the demand bill of the scenarios for a block and a month, as TouDemandChargeTariff.compute_monthly_bill_matrix()
+        :param values: a 2-D array of shape (nb_scenarios, len(date_index))
+        """
+
+        metric_unit_mult = float(tariff_block.unit_metric.value)
+        metric_price_mult = float(tariff_block.unit_cost.value)
+
+        # The max of each run, ignoring the missing values
+        max_runs = np.fmax.reduceat(values, bounds, axis=1)
+
+        max_per_set = {}
+        for (price, mask, block_rate, runs_id, runs_start, runs_length) in periods:
+            max_runs_period = max_runs[:, runs_id]
+            max_power_period = np.fmax.reduce(max_runs_period, axis=1)
+            no_data = np.isnan(max_power_period)
+
+            # The first occurrence of the max: in the first run reaching it
+            run_max = np.argmax(max_runs_period == max_power_period[:, np.newaxis], axis=1)
+            idx_max = runs_start[run_max]
+            for r_i in np.unique(run_max[~no_data]):
+                is_run = (run_max == r_i) & ~no_data
+                values_run = values[:, runs_start[r_i]:runs_start[r_i] + runs_length[r_i]]
+                if not is_run.all():
+                    values_run = values_run[is_run]
+                idx_max[is_run] += np.argmax(values_run == max_power_period[is_run, np.newaxis], axis=1)
+
+            max_power_period = np.where(no_data, np.nan, max_power_period).astype(float) / metric_unit_mult
+            max_power_period *= power_coeff  # from kWh to kW
+
+            max_power_date = date_index[idx_max]
+            if no_data.any():
+                max_power_date = max_power_date.where(~no_data)
+
+            max_per_set[metric_price_mult * price] = tariff_block.get_period_bill(price, mask, block_rate,
+                                                                                  max_power_period, max_power_date)
+
+        return max_per_set
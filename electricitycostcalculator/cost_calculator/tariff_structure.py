@@ -3,9 +3,12 @@ __author__ = 'Olivier Van Cutsem'
 from abc import abstractmethod
 from enum import Enum
 from datetime import datetime
-import calendar
+import numpy as np
 import pandas as pd
 
+from .instrumentation import instrument, is_instrumentation_enabled, get_block_name
+from .timestamp_features import TimestampFeatures
+
 # --------------- TARIFF structures --------------- #
 
 
@@ -40,6 +43,64 @@ class TariffElemCostUnit(Enum):
     DOLLAR = 1
 
 
+class DemandWindowMode(Enum):
+    BLOCK = 'block'  # the windows are consecutive, aligned on the clock (e.g. 10:00-10:15, 10:15-10:30)
+    SLIDING = 'sliding'  # a window ends at each interval
+
+
+# --------------- TOU masks --------------- #
+
+# The daily masks seen in the process: the canonical list of each mask, and their ids by content and by object
+_masks = []
+_masks_ids = {}
+_masks_ids_by_obj = {}
+
+
+def intern_mask(mask):
+    """
+    Return the integer id of a daily mask (a list of bool), such that identical masks share the same id within the
+    process. The canonical list of the mask is kept and returned by get_interned_mask().
+    :param mask: a list of bool
+    :return: an int
+    """
+
+    # Fast path: this is a canonical mask
+    mask_id = _masks_ids_by_obj.get(id(mask))
+    if mask_id is not None and _masks[mask_id] is mask:
+        return mask_id
+
+    key = get_mask_key(mask)
+    mask_id = _masks_ids.get(key)
+    if mask_id is None:
+        mask_id = len(_masks)
+        canonical_mask = list(mask)
+        _masks.append(canonical_mask)
+        _masks_ids[key] = mask_id
+        _masks_ids_by_obj[id(canonical_mask)] = mask_id
+
+    return mask_id
+
+
+def get_mask_key(mask):
+    """
+    Return a hashable key of the content of a daily mask: its length and its packed bits
+    :param mask: a list of bool
+    :return: a tuple (int, bytes)
+    """
+
+    return len(mask), np.packbits(np.asarray(mask, dtype=bool)).tobytes()
+
+
+def get_interned_mask(mask_id):
+    """
+    Return the canonical list of an interned mask. This list is shared and must not be modified.
+    :param mask_id: an int, as returned by intern_mask()
+    :return: a list of bool
+    """
+
+    return _masks[mask_id]
+
+
 class TariffBase(object):
     """
     This abstract class represent the base of any tariffication structure.
@@ -56,7 +117,7 @@ class TariffBase(object):
         self.name = name
         self.unit_cost = unit_cost
 
-    def compute_bill(self, df, data_col=None):
+    def compute_bill(self, df, data_col=None, features=None):
         """
         Compute the bill due to the power/energy consumption in df, for each billing period specified in billing_periods
 
@@ -69,59 +130,146 @@ class TariffBase(object):
         :param df: a pandas dataframe containing power consumption timeseries
         :param billing_periods: a dictionary mapping the billing periods label to a tuple (t_start, t_end) of datetime,
         defining the period related to the billing label
+        :param features: [optional] the TimestampFeatures of the index of df, shared with the other tariff blocks, see
+        get_timestamp_features(). The index is decomposed by this block otherwise.
         :return: a dictionary formatted as in this method signature
         """
 
         ret = {}
 
-        # Select only the data in this tariff window
-        start_sel = self.startdate
-        start_sel = start_sel.replace(tzinfo=df.index[0].tzinfo)
+        with instrument('TariffBase.compute_bill', block=get_block_name(self) if is_instrumentation_enabled() else None) as measure:
+            if not df.index.is_monotonic_increasing:
+                df = df.sort_index()
+                features = None
 
-        end_sel = self.enddate
-        end_sel = end_sel.replace(tzinfo=df.index[0].tzinfo)
+            # Select only the data in this tariff window
+            (idx_start, idx_end) = self.get_window_slice(df.index)
+            df = df.iloc[idx_start:idx_end]
+            features = TimestampFeatures(df.index) if features is None else features.slice(idx_start, idx_end)
+            measure.rows = len(df)
+
+            # Loop over the months: each month is a contiguous slice of the data
+            for (month_label, idx_month_start, idx_month_end) in features.get_monthly_slices():
+                with instrument(type(self).__name__ + '.compute_monthly_bill', rows=idx_month_end - idx_month_start):
+                    monthly_bill = self.compute_monthly_bill(df.iloc[idx_month_start:idx_month_end], data_col,
+                                                             features.slice(idx_month_start, idx_month_end))
+                ret[month_label] = monthly_bill
 
-        mask = (df.index >= start_sel) & (df.index <= end_sel)
-        df = df.loc[mask]
+        return ret
 
-        # Loop over the months
-        t_s = df.index[0]
-        last_day_of_month = calendar.monthrange(t_s.year, t_s.month)[1]  # The last day of this month
-        t_e = datetime(t_s.year, t_s.month, last_day_of_month, hour=23, minute=59, second=59, tzinfo=t_s.tzinfo)  # end of the current month
-        t_e = min(df.index[-1], t_e)
+    def compute_bill_matrix(self, date_index, values, features=None):
+        """
+        Compute the bill of several meters sharing the same time index, for each billing month.
+        The time index is decomposed once for all the meters.
 
-        while t_s <= t_e:
-            mask = (df.index >= t_s) & (df.index <= t_e)
-            df_month = df.loc[mask]
-            monthly_bill = self.compute_monthly_bill(df_month, data_col)
-            ret[t_s.strftime("%Y-%m")] = monthly_bill
+        :param date_index: a sorted pandas DatetimeIndex
+        :param values: a 2-D numpy array of shape (len(date_index), nb_meters), the energy consumption of each meter
+        :param features: [optional] the TimestampFeatures of 'date_index', see compute_bill()
+        :return: a dictionary mapping the billing month labels "YYYY-MM" to the output of compute_monthly_bill_matrix()
+        """
 
-            # Prepare the next billing month
-            month = t_e.month + 1
-            year = t_e.year
-            if month >= 13:
-                month = 1
-                year += 1
+        ret = {}
 
-            t_s = datetime(year, month, 1, hour=0, minute=0, second=0, tzinfo=t_s.tzinfo)
+        # Select only the data in this tariff window
+        (idx_start, idx_end) = self.get_window_slice(date_index)
+        date_index = date_index[idx_start:idx_end]
+        values = values[idx_start:idx_end]
+        features = TimestampFeatures(date_index) if features is None else features.slice(idx_start, idx_end)
 
-            last_day_of_month = calendar.monthrange(year, month)[1]
-            t_e = datetime(year, month, last_day_of_month, hour=23, minute=59, second=59, tzinfo=t_s.tzinfo)
-            t_e = min(df.index[-1], t_e)
+        for (month_label, idx_month_start, idx_month_end) in features.get_monthly_slices():
+            ret[month_label] = self.compute_monthly_bill_matrix(date_index[idx_month_start:idx_month_end],
+                                                                values[idx_month_start:idx_month_end],
+                                                                features.slice(idx_month_start, idx_month_end))
 
         return ret
 
+    def get_window_slice(self, date_index):
+        """
+        Return the range of positions of a sorted DatetimeIndex that are within the dates of this tariff
+        :param date_index: a sorted pandas DatetimeIndex
+        :return: a tuple (idx_start, idx_end)
+        """
+
+        if len(date_index) == 0:
+            return 0, 0
+
+        start_sel = self.startdate
+        start_sel = start_sel.replace(tzinfo=date_index[0].tzinfo)
+
+        end_sel = self.enddate
+        end_sel = end_sel.replace(tzinfo=date_index[0].tzinfo)
+
+        return date_index.searchsorted(start_sel, side='left'), date_index.searchsorted(end_sel, side='right')
+
     @abstractmethod
-    def compute_monthly_bill(self, df, data_col=None):
+    def compute_monthly_bill(self, df, data_col=None, features=None):
         """
         Compute the monthly bill due to the power/energy consumption in df
         :param df: a pandas dataframe
         :param data_col: the column label containing the data
+        :param features: [optional] the TimestampFeatures of the index of df
         :return: a tuple (float, float) -> (value, cost), representing the bill and the corresponding metric linked to the cost
         """
 
         pass
 
+    @abstractmethod
+    def compute_monthly_bill_matrix(self, date_index, values, features=None):
+        """
+        Compute the monthly bill of several meters at once, see compute_bill_matrix()
+        :param date_index: a pandas DatetimeIndex
+        :param values: a 2-D numpy array of shape (len(date_index), nb_meters)
+        :param features: [optional] the TimestampFeatures of 'date_index'
+        :return: the same structure as compute_monthly_bill(), where each number is an array of size nb_meters
+        """
+
+        pass
+
+    def compile(self):
+        """
+        Prepare the internal structures used to compute the bill, e.g. before sending the tariff to other processes
+        :return: /
+        """
+
+        pass
+
+    def update_fingerprint(self, hash_obj):
+        """
+        Feed the content of this tariff block to a hash object, such that blocks with the same content have the same
+        fingerprint. The block must not be modified after its fingerprint has been taken.
+        :param hash_obj: a hashlib object, e.g. hashlib.sha1()
+        :return: /
+        """
+
+        hash_obj.update(repr((type(self).__name__, self.__startdate, self.__enddate, self.unit_cost)).encode())
+
+    @staticmethod
+    def get_data_values(df, data_col=None):
+        """
+        Return the data of a dataframe as a numpy array
+        :param df: a pandas Series, or a dataframe
+        :param data_col: the column label containing the data. If None, df must be a Series or have a single column
+        :return: a 1-D numpy array
+        """
+
+        if data_col is not None:
+            return df.loc[:, data_col].values
+        elif isinstance(df, pd.DataFrame):
+            return df.iloc[:, 0].values
+        else:
+            return df.values
+
+    @staticmethod
+    def get_monthly_slices(date_index):
+        """
+        Split a sorted DatetimeIndex into calendar months, in a single pass over the index
+        :param date_index: a sorted pandas DatetimeIndex
+        :return: a list of tuples (month_label, idx_start, idx_end), where month_label is formatted as "YYYY-MM" and
+        [idx_start, idx_end) is the range of positions of this month in the index
+        """
+
+        return TimestampFeatures(date_index).get_monthly_slices()
+
     @property
     def startdate(self):
         """
@@ -170,15 +318,35 @@ class FixedTariff(TariffBase):
         self.__rate_period = bill_period
         self.__rate_value = rate_value
 
-    def compute_monthly_bill(self, df, data_col=None):
+    def compute_monthly_bill(self, df, data_col=None, features=None):
         """
         Compute the monthly bill due to a fixed periodic cost
 
         :param df: a pandas dataframe
         :return: a tuple (float, float), representing the bill and the duration (in months)
         """
-        first_day = df.index[0].day
-        last_day = df.index[-1].day
+
+        return self.compute_fixed_bill(df.index)
+
+    def compute_monthly_bill_matrix(self, date_index, values, features=None):
+        """
+        idem super: the fixed cost is the same for all the meters
+        """
+
+        (nb_days, bill) = self.compute_fixed_bill(date_index)
+        nb_meters = values.shape[1]
+
+        return np.full(nb_meters, nb_days), np.full(nb_meters, bill, dtype=float)
+
+    def compute_fixed_bill(self, date_index):
+        """
+        Compute the fixed cost over the days spanned by a monthly index
+        :param date_index: a pandas DatetimeIndex
+        :return: a tuple (int, float), the number of days and the bill
+        """
+
+        first_day = date_index[0].day
+        last_day = date_index[-1].day
 
         nb_days = last_day - first_day + 1
         nb_days_per_month = 365/12
@@ -192,6 +360,14 @@ class FixedTariff(TariffBase):
 
         return nb_days, bill
 
+    def update_fingerprint(self, hash_obj):
+        """
+        idem super: add the rate and its period
+        """
+
+        super(FixedTariff, self).update_fingerprint(hash_obj)
+        hash_obj.update(repr((self.__rate_value, self.__rate_period)).encode())
+
     def period_metric(self):
         return self.__rate_period
 
@@ -221,13 +397,30 @@ class TimeOfUseTariff(TariffBase):
         self.__unit_metric = unit_metric
 
     @abstractmethod
-    def compute_monthly_bill(self, df, data_col=None):
+    def compute_monthly_bill(self, df, data_col=None, features=None):
         """
         idem super
         """
 
         pass
 
+    def compile(self):
+        """
+        idem super: compile the rate schedule
+        """
+
+        self.__schedule.rate_table
+        self.__schedule.tier_table
+
+    def update_fingerprint(self, hash_obj):
+        """
+        idem super: add the unit of the metric and the compiled rate schedule
+        """
+
+        super(TimeOfUseTariff, self).update_fingerprint(hash_obj)
+        hash_obj.update(repr(self.__unit_metric).encode())
+        self.__schedule.update_fingerprint(hash_obj)
+
     @property
     def rate_schedule(self):
         return self.__schedule
@@ -252,14 +445,43 @@ class TimeOfUseTariff(TariffBase):
     def get_price_from_timestamp(self, timestamp):
         return self.__schedule.get_from_timestamp(timestamp)
 
+    def get_price_vector(self, date_index, features=None):
+        """
+        Return the price corresponding to each date of 'date_index', looked up in the compiled rate schedule
+        :param date_index: a pandas DatetimeIndex
+        :param features: [optional] the TimestampFeatures of 'date_index'
+        :return: a numpy array of float, aligned with 'date_index'
+        """
+
+        return self.__schedule.get_rates_from_index(date_index, features)
+
+    def get_daily_mask(self, date, price, nb_periods=None):
+        """
+        Return the periods of the day 'date' where the rate is 'price'
+        :param date: a datetime
+        :param price: a float, the rate of interest
+        :param nb_periods: [optional] the number of periods in the day. The resolution of the rates is used by default
+        :return: a list of bool, of length 'nb_periods'. This list is interned (see intern_mask) and must not be modified
+        """
+
+        daily_rate = self.__schedule.get_daily_rate(date)
+        if nb_periods is None:
+            nb_periods = len(daily_rate)
+
+        idx_periods = np.arange(nb_periods) * len(daily_rate) // nb_periods
+        mask = (np.asarray(daily_rate, dtype=float)[idx_periods] == price).tolist()
+
+        return get_interned_mask(intern_mask(mask))
+
     @staticmethod
     def get_daily_price_dataframe(daily_rate, df_day):
 
         # Constructing the dataframe for an easier manipulation of time
-        period_rate = len(daily_rate) / 24.0
+        nb_periods = len(daily_rate)
 
         # In some cases the day might not be full: missing data or DST
-        daily_prices = [daily_rate[int((df_day.index[i].hour + df_day.index[i].minute / 60.0) * period_rate)] for i in range(len(df_day.index))]
+        idx_periods = (np.asarray(df_day.index.hour) * 60 + np.asarray(df_day.index.minute)) * nb_periods // (24 * 60)
+        daily_prices = np.asarray(daily_rate)[idx_periods]
         data = {'date': df_day.index[:], 'price': daily_prices}
         df_prices = pd.DataFrame(data=data)
         df_prices.set_index('date')
@@ -272,22 +494,62 @@ class TouDemandChargeTariff(TimeOfUseTariff):
     This class represents a Time Of Use Demand Charge tariff
     """
 
-    def __init__(self, dates, time_schedule, unit_metric=TariffElemMetricUnit.DEMAND_KW, unit_cost=TariffElemCostUnit.DOLLAR, name=None):
+    def __init__(self, dates, time_schedule, unit_metric=TariffElemMetricUnit.DEMAND_KW, unit_cost=TariffElemCostUnit.DOLLAR, name=None,
+                 demand_window=None, demand_window_mode=DemandWindowMode.BLOCK):
         """
         Constructor
         :param dates: see FixedTariff init
         :param rate_list: TODO
         :param time_schedule: TODO
         :param name: see FixedTariff init
+        :param demand_window: [optional] the duration of the demand window in minutes, e.g. 15: the demand is the average
+        power over a window instead of the power of each interval of the data. None by default.
+        :param demand_window_mode: [optional] an element of DemandWindowMode, BLOCK by default
         """
 
         super(TouDemandChargeTariff, self).__init__(dates, time_schedule, unit_metric, unit_cost, name)
 
-    def compute_monthly_bill(self, df, data_col=None):
+        self.__demand_window = demand_window
+        self.__demand_window_mode = demand_window_mode
+
+    def compute_monthly_bill(self, df, data_col=None, features=None):
         """
         Compute the bill due to a TOU tariff
         :param df: a pandas dataframe
-        :return: a tuple (dict, float) -> ({p1: (max_power_p1, time_max_p1), p2: (max_power_p2, time_max_p2), cost)
+        :param features: [optional] the TimestampFeatures of the index of df
+        :return: a dict {p1: {'mask': mask_p1, 'max-demand': max_power_p1, 'max-demand-date': time_max_p1}, p2: ...},
+        where the keys are the prices of the TOU periods and the mask is the daily pattern of the period, taken on the
+        first day the period occurs in the month
+        """
+
+        values = self.get_data_values(df, data_col)
+        max_per_set_meters = self.compute_monthly_bill_matrix(df.index, values.reshape(-1, 1), features)
+
+        max_per_set = {}
+        for price_key, data in list(max_per_set_meters.items()):
+            if np.isnan(data['max-demand'][0]):  # no data in this period
+                continue
+
+            if 'price' in data:  # tiered period: the price depends on the max demand
+                price_key = float(data['price'][0])
+
+            max_per_set[price_key] = {'mask': data['mask'],
+                                      'max-demand': data['max-demand'][0],
+                                      'max-demand-date': data['max-demand-date'][0].to_pydatetime()}
+
+        return max_per_set
+
+    def compute_monthly_bill_matrix(self, date_index, values, features=None, nb_dates_before=0):
+        """
+        idem super: a dict {p1: {'mask': mask_p1, 'max-demand': max_power_p1, 'max-demand-date': time_max_p1}, ...}
+        where max_power_p1 is an array of the max demand of each meter (NaN if a meter has no data in the period) and
+        time_max_p1 a DatetimeIndex of the corresponding dates (NaT if no data)
+
+        If the rate of a period is a BlockRate, p1 is its base rate and the dict of the period also holds 'price': an
+        array of the price of each meter, such that price * max_power_p1 is the cost of its max demand over the tiers
+
+        The first 'nb_dates_before' dates (0 by default) only start the demand windows of the next ones: they were billed
+        with the previous chunk of the month, see get_window_tail()
         """
 
         # Scaling the power unit and cost
@@ -296,101 +558,260 @@ class TouDemandChargeTariff(TimeOfUseTariff):
 
         max_per_set = {}
 
+        if features is None:
+            features = TimestampFeatures(date_index)  # shared by the prices and the TOU periods
+
         # df is in kWh and demand in kW: convert to Power
-        timestep_data = self.get_pd_timestep_data(df)
-
-        for idx, df_day in df.groupby(df.index.date):
-            daily_rate = self.rate_schedule.get_daily_rate(df_day.index[0])
-
-            set_of_daily_prices = set(daily_rate)
-            df_prices = self.get_daily_price_dataframe(daily_rate, df_day)
-
-            power_coeff = 1
-            if timestep_data == '15T':
-                power_coeff = 4
-            elif timestep_data == '30T':
-                power_coeff = 2
-            elif timestep_data == '60T' or timestep_data == 'H':
-                power_coeff = 1
-
-            for day_p in set_of_daily_prices:
-
-                # Create the mask in the day for this price
-                mask_price = df_prices['price'] == day_p
-                mask_price = mask_price.tolist()
-
-                date_max_period = None
-                if data_col is not None:
-                    df_masked = df_day.loc[mask_price, data_col]
-                    if len(df_masked) > 0:
-                        date_max_period = df_masked.idxmax()
-                else:
-                    df_masked = df_day.loc[mask_price]
-                    if len(df_masked) > 0:
-                        date_max_period = df_masked.idxmax()
-
-                if date_max_period is None:
-                    continue
-
-                if data_col is not None:
-                    max_power_period = df_day.loc[date_max_period, data_col] / metric_unit_mult
-                else:
-                    max_power_period = df_day[date_max_period] / metric_unit_mult
-
-                max_power_period *= power_coeff  # from kWh to kW
-
-                # Search for the same mask and update the value if a new mask
-                mask_price24h = mask_price
-                if len(mask_price) != len(daily_rate):  # if this price is already in the list, take the corresponding mask ...
-                    price_key = metric_price_mult * day_p
-                    if price_key in list(max_per_set.keys()):
-                        mask_price24h = max_per_set[price_key]['mask']
-
-                add_this_demand = True
-                existing_mask_price = [k for k, v in list(max_per_set.items()) if v['mask'] == mask_price24h]
-                if len(existing_mask_price) > 0:  # Find the identical mask over the day
-                    existing_mask_price = existing_mask_price[0]
-                    if max_power_period > max_per_set[existing_mask_price]['max-demand']:  # Check if the corresponding demand is greater
-                        del max_per_set[existing_mask_price]  # delete the former value, and add it (after)
-                    else:
-                        add_this_demand = False
-
-                # This is the first time this mask is seen OR this new demand is higher than the corresponding former: add it
-                if add_this_demand:
-
-                    if type(date_max_period) is not pd.Timestamp:
-                        max_power_date = date_max_period[data_col].to_pydatetime()
-                    else:
-                        max_power_date = date_max_period.to_pydatetime()
-
-                    # The mask must be 24 hour long:
-                    # it might not be the case for the first and last day, and the DST
-                    price_key = metric_price_mult * day_p
-
-                    max_per_set[price_key] = {'mask': mask_price24h, 'max-demand': max_power_period, 'max-demand-date': max_power_date}
+        power_coeff = self.get_power_coeff(date_index, features)
+        values = self.get_window_values(date_index, values, features)
+        if nb_dates_before > 0:
+            values = np.concatenate((np.full((nb_dates_before, values.shape[1]), np.nan), values[nb_dates_before:]))
+
+        range_meters = np.arange(values.shape[1])
+        for (day_p, mask_price, idx_period, block_rate) in self.get_demand_periods(date_index, features):
+
+            # Max demand of each meter in this period, and its first occurrence
+            values_period = values[idx_period]
+            values_period = np.where(np.isnan(values_period), -np.inf, values_period)
+
+            idx_max = np.argmax(values_period, axis=0)
+            max_power_period = values_period[idx_max, range_meters]
+            no_data = np.isneginf(max_power_period)
+
+            max_power_period = np.where(no_data, np.nan, max_power_period).astype(float) / metric_unit_mult
+            max_power_period *= power_coeff  # from kWh to kW
+
+            max_power_date = date_index[idx_period[idx_max]]
+            if no_data.any():
+                max_power_date = max_power_date.where(~no_data)
+
+            max_per_set[metric_price_mult * day_p] = self.get_period_bill(day_p, mask_price, block_rate,
+                                                                          max_power_period, max_power_date)
 
         return max_per_set
 
+    def get_window_values(self, date_index, values, features):
+        """
+        Return the average energy per interval over the demand window of each interval, in a single pass over the
+        data with cumulative sums. The missing values are left out of the averages.
+         - BLOCK: the average over the window of the clock containing the interval
+         - SLIDING: the average over the window ending at the interval, i.e. the intervals starting less than
+         'demand_window' minutes before it. The windows are bounded by the dates, such that the gaps in the data and the
+         DST changes are not averaged across. The first windows of the data are shorter.
+        :param date_index: a sorted pandas DatetimeIndex
+        :param values: a 2-D numpy array of shape (nb_dates, nb_meters), the energy of each interval
+        :param features: the TimestampFeatures of 'date_index'
+        :return: a 2-D numpy array of the same shape, 'values' itself if the window isn't longer than an interval
+        """
+
+        if not self.__is_windowed(features):
+            return values
+
+        is_valid = ~np.isnan(values)
+        values_valid = np.where(is_valid, values, 0.0)
+
+        if self.__demand_window_mode == DemandWindowMode.BLOCK:
+            idx_windows = self.__get_block_windows(features)
+
+            sums = np.add.reduceat(values_valid, idx_windows, axis=0, dtype=np.float64)
+            counts = np.add.reduceat(is_valid, idx_windows, axis=0, dtype=np.int64)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                averages = sums / counts
+
+            return np.repeat(averages, np.diff(np.concatenate((idx_windows, [len(values)]))), axis=0)
+
+        # SLIDING: the sums between the first interval of each window and the interval itself
+        idx_first = self.__get_sliding_starts(date_index)
+
+        sums = np.cumsum(values_valid, axis=0, dtype=np.float64)
+        counts = np.cumsum(is_valid, axis=0, dtype=np.int64)
+        sums = sums - np.concatenate((np.zeros((1, sums.shape[1])), sums))[idx_first]
+        counts = counts - np.concatenate((np.zeros((1, counts.shape[1]), dtype=np.int64), counts))[idx_first]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return sums / counts
+
+    def get_window_tail(self, date_index, features):
+        """
+        Return the last intervals of a chunk of data that the demand windows of the next chunk depend on, to bill the
+        data chunk by chunk (see BillAccumulator):
+         - BLOCK: the intervals of the last window, whose average isn't known until the next chunk. They are billed
+         with the next chunk.
+         - SLIDING: the intervals of the last 'demand_window' minutes, where the windows of the next chunk start
+        :param date_index: a sorted pandas DatetimeIndex
+        :param features: the TimestampFeatures of 'date_index'
+        :return: a tuple (idx_context, idx_pending) of positions in 'date_index': the intervals from 'idx_context' on are
+        kept for the next chunk, and the ones from 'idx_pending' on are not billed yet
+        """
+
+        nb_dates = len(date_index)
+        if nb_dates == 0 or not self.__is_windowed(features):
+            return nb_dates, nb_dates
+
+        if self.__demand_window_mode == DemandWindowMode.BLOCK:
+            idx_last = int(self.__get_block_windows(features)[-1])
+            return idx_last, idx_last
+
+        return int(self.__get_sliding_starts(date_index)[-1]), nb_dates
+
+    def get_demand_periods(self, date_index, features=None):
+        """
+        Assign the intervals of a monthly index to the TOU periods of this tariff: the intervals sharing the same price
+        :param date_index: a pandas DatetimeIndex, within a month
+        :param features: [optional] the TimestampFeatures of 'date_index'
+        :return: a list of tuples (price, mask, idx_period, block_rate), one per period, where 'idx_period' is the array
+        of the positions of its intervals in chronological order, 'mask' the daily pattern of the period, taken on the
+        first day it occurs and sampled at the data resolution, and 'block_rate' the BlockRate of the period (None if
+        its rate isn't tiered)
+        """
+
+        if features is None:
+            features = TimestampFeatures(date_index)
+
+        prices = self.get_price_vector(date_index, features)
+        tiers = self.rate_schedule.get_tiers_from_index(date_index, features) if self.rate_schedule.is_tiered else None
+
+        idx_valid = np.flatnonzero(~np.isnan(prices))
+        if len(idx_valid) == 0:
+            return []
+
+        periods_prices, idx_first, periods_id = np.unique(prices[idx_valid], return_index=True, return_inverse=True)
+        periods_id = periods_id.ravel()
+
+        # The intervals of each period, in chronological order
+        idx_sorted = idx_valid[np.argsort(periods_id, kind='mergesort')]
+        idx_bounds = np.searchsorted(np.sort(periods_id), np.arange(len(periods_prices) + 1))
+
+        nb_periods_in_day = None
+        if features.interval_hours is not None:
+            nb_periods_in_day = max(1, int(round(24 / features.interval_hours)))
+
+        periods = []
+        for p_i in range(len(periods_prices)):
+            day_p = float(periods_prices[p_i])
+            idx_period = idx_sorted[idx_bounds[p_i]:idx_bounds[p_i + 1]]
+
+            mask_price = self.get_daily_mask(date_index[idx_valid[idx_first[p_i]]], day_p, nb_periods_in_day)
+
+            tier_p = tiers[idx_period[0]] if tiers is not None else 0
+            block_rate = self.rate_schedule.block_rates[tier_p - 1] if tier_p > 0 else None
+
+            periods.append((day_p, mask_price, idx_period, block_rate))
+
+        return periods
+
+    def get_period_bill(self, price, mask, block_rate, max_power, max_power_date):
+        """
+        Format the bill of a TOU period, see compute_monthly_bill_matrix()
+        :param price: the rate of the period
+        :param mask: the daily pattern of the period
+        :param block_rate: the BlockRate of the period, or None
+        :param max_power: an array of the max demand of each meter (in kW), NaN if no data
+        :param max_power_date: a DatetimeIndex of the dates of the max demands
+        :return: a dict {'mask': mask, 'max-demand': max_power, 'max-demand-date': max_power_date}, with 'price' if the
+        rate is tiered
+        """
+
+        period_bill = {'mask': mask, 'max-demand': max_power, 'max-demand-date': max_power_date}
+
+        # Tiered period: the average price of the max demand over the tiers
+        if block_rate is not None:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                avg_rate = block_rate.get_cost(max_power) / max_power
+            period_bill['price'] = float(self.unit_cost.value) * np.where(max_power > 0, avg_rate, price)
+
+        return period_bill
+
+    def update_fingerprint(self, hash_obj):
+        """
+        idem super: add the demand window
+        """
+
+        super(TouDemandChargeTariff, self).update_fingerprint(hash_obj)
+        hash_obj.update(repr((self.__demand_window, self.__demand_window_mode)).encode())
+
+    @property
+    def demand_window(self):
+        return self.__demand_window
+
+    @property
+    def demand_window_mode(self):
+        return self.__demand_window_mode
+
+    # --- private
+
+    def __is_windowed(self, features):
+        """
+        Return True if the demand is averaged over windows longer than the intervals of the data
+        """
+
+        interval_hours = features.interval_hours
+
+        return self.__demand_window is not None and interval_hours is not None and self.__demand_window > interval_hours * 60
+
+    def __get_block_windows(self, features):
+        """
+        Return the position of the first interval of each BLOCK window. A window also ends where the local time goes
+        back, at the end of the DST, such that the repeated hour isn't merged with the previous one.
+        """
+
+        minutes = features.local_days.astype(np.int64) * TimestampFeatures.MINUTES_IN_DAY + features.minutes_of_day
+        windows_id = minutes // self.__demand_window
+        is_first = (np.diff(windows_id) != 0) | (np.diff(minutes) <= 0)
+
+        return np.concatenate(([0], np.flatnonzero(is_first) + 1))
+
+    def __get_sliding_starts(self, date_index):
+        """
+        Return the position of the first interval of the SLIDING window ending at each interval: the first one starting
+        less than 'demand_window' minutes before it, in absolute time
+        """
+
+        dates = np.asarray(date_index.values)  # in UTC if the index is tz-aware
+
+        return np.searchsorted(dates, dates - np.timedelta64(int(round(self.__demand_window * 60)), 's'), side='right')
+
+    def get_power_coeff(self, date_index, features=None):
+        """
+        Return the coefficient converting the energy of an interval (kWh) into the average power (kW): the inverse of
+        the duration of the intervals (in hours), see TimestampFeatures.interval_hours. The data is considered hourly
+        if the duration can't be inferred.
+        :param date_index: a pandas DatetimeIndex
+        :param features: [optional] the TimestampFeatures of 'date_index', whose duration of the intervals is inferred
+        once for the whole index
+        :return: a float
+        """
+
+        interval_hours = self.get_index_timestep(date_index, features) / pd.Timedelta(hours=1)
+
+        return 1.0 / interval_hours
+
     def get_pd_timestep_data(self, df):
         """
-        Return the most likely data frequency
-        :return:
+        Return the most likely duration of the intervals of the data
+        :return: a pandas Timedelta
         """
 
-        freq = 1
+        return self.get_index_timestep(df.index)
+
+    @staticmethod
+    def get_index_timestep(date_index, features=None):
+        """
+        Return the most likely duration of the intervals of a DatetimeIndex: the median time between consecutive dates,
+        in a single vectorized pass. The gaps in the data and the irregular dates don't change it.
+        :param date_index: a sorted pandas DatetimeIndex
+        :param features: [optional] the TimestampFeatures of 'date_index'
+        :return: a pandas Timedelta, 1 hour if the index has less than 2 distinct dates
+        """
 
-        # Dataframe is complete
-        if df.index.freq is not None:
-            return df.index.freq
+        if features is None:
+            features = TimestampFeatures(date_index)
 
-        # Days are missing: loop through the day until getting a frequency
-        for idx, df_day in df.groupby(df.index.date):
-            if df_day.index.freq is not None:
-                return df_day.index.freq
-            elif len(df_day.index) > 2:  # need at least 3 dates
-                return pd.infer_freq(df_day.index)
+        interval_hours = features.interval_hours
+        if interval_hours is None:
+            return pd.Timedelta(hours=1)
 
-        return 1
+        return pd.Timedelta(hours=interval_hours)
 
 
 class TouEnergyChargeTariff(TimeOfUseTariff):
@@ -408,39 +829,57 @@ class TouEnergyChargeTariff(TimeOfUseTariff):
 
         super(TouEnergyChargeTariff, self).__init__(dates, time_schedule, unit_metric, unit_cost, name)
 
-    def compute_monthly_bill(self, df, data_col=None):
+    def compute_monthly_bill(self, df, data_col=None, features=None):
         """
         Compute the bill due to a TOU tariff
         :param df: a pandas dataframe
+        :param features: [optional] the TimestampFeatures of the index of df
         :return: a tuple (float, float) -> (cost, tot_energy)
         """
 
-        # Iterates over the days
-        energy = 0.0
-        cost = 0.0
+        values = self.get_data_values(df, data_col)
+        (energy, cost) = self.compute_monthly_bill_matrix(df.index, values.reshape(-1, 1), features)
 
-        # TODO: check for blockrate instead of assuming it's a float !
+        return energy[0], cost[0]
 
-        for idx, df_day in df.groupby(df.index.date):
+    def compute_monthly_bill_matrix(self, date_index, values, features=None, energy_before=None):
+        """
+        idem super: a tuple of arrays (energy, cost), the total energy and cost of each meter
 
-            daily_rate = self.rate_schedule.get_daily_rate(df_day.index[0])
-            df_prices = self.get_daily_price_dataframe(daily_rate, df_day)
+        The intervals whose rate is a BlockRate are billed on the tiers reached by the energy consumed since the start
+        of the month, e.g. an interval that crosses a threshold is billed partly at each rate
 
-            # Unit and cost scale
-            mult_energy_unit = float(self.unit_metric.value)
-            mult_cost_unit = float(self.unit_cost.value)
+        :param energy_before: [optional] an array of the energy already consumed by each meter in the month, before
+        'date_index' (in the unit of the metric), e.g. when the month is billed in several chunks
+        """
 
-            # Cumulate the energy over the month
+        # Unit and cost scale
+        mult_energy_unit = float(self.unit_metric.value)
+        mult_cost_unit = float(self.unit_cost.value)
 
-            if data_col is not None:
-                df_values_in_day = df_day.loc[:, data_col]
-            else:
-                df_values_in_day = df_day[:]
+        prices = self.get_price_vector(date_index, features)
 
-            energy += sum(df_values_in_day) / mult_energy_unit
+        # Cumulate the energy and the bill over the month
+        energy = np.sum(values, axis=0, dtype=np.float64) / mult_energy_unit
 
-            # Cumulate the bill over the month
-            cost += sum(mult_cost_unit * df_values_in_day.multiply(df_prices.loc[:, 'price'].tolist())) / mult_energy_unit
+        tiers = self.rate_schedule.get_tiers_from_index(date_index, features) if self.rate_schedule.is_tiered else None
+        if tiers is None or not tiers.any():
+            cost = mult_cost_unit * prices.dot(values) / mult_energy_unit
+            return energy, cost
 
-        return energy, cost
+        # Tiered rates: the cost of an interval is the cost of the energy consumed up to its end, minus up to its start
+        energy_intervals = np.asarray(values, dtype=float) / mult_energy_unit
+        energy_cumulated = np.cumsum(np.nan_to_num(energy_intervals), axis=0)
+        if energy_before is not None:
+            energy_cumulated += energy_before
 
+        cost_intervals = prices[:, np.newaxis] * energy_intervals
+        for tier_id in np.unique(tiers[tiers > 0]):
+            idx_tier = np.flatnonzero(tiers == tier_id)
+            block_rate = self.rate_schedule.block_rates[tier_id - 1]
+            energy_end = energy_cumulated[idx_tier]
+            cost_intervals[idx_tier] = block_rate.get_cost(energy_end) - block_rate.get_cost(energy_end - energy_intervals[idx_tier])
+
+        cost = mult_cost_unit * np.sum(cost_intervals, axis=0)
+
+        return energy, cost
@@ -0,0 +1,225 @@
+__author__ = 'Olivier Van Cutsem'
+
+from collections import OrderedDict
+import weakref
+
+import numpy as np
+
+# --------------- Timestamp features --------------- #
+
+
+class TimestampFeatures(object):
+    """
+    This class stores the decomposition of a sorted DatetimeIndex into the features used to bill it, in local time:
+     - the month code of each date (year * 12 + month - 1) and the boundaries of the billing months
+     - the local day of each date, and its day-type code in a HolidayCalendar
+     - the minute of the day of each date, and its slot in a day divided in 'nb_slots' (the resolution of a schedule)
+     - the duration of the intervals, to convert their energy into power
+
+    Each feature is computed once, the first time it is requested, on the whole index. All the tariff blocks and labels
+    billing the index (or a range of it, see slice()) then share it. Use get_timestamp_features() to also share them
+    between the bills computed on the same index.
+    """
+
+    MINUTES_IN_DAY = 24 * 60
+
+    def __init__(self, date_index, features=None, idx_start=0, idx_end=None, interval_hours=None):
+        """
+        Constructor
+        :param date_index: a sorted pandas DatetimeIndex
+        :param features: [internal] the TimestampFeatures of the whole index, for a view created by slice()
+        :param idx_start: [internal] the first position of the view in the whole index
+        :param idx_end: [internal] the end position of the view in the whole index
+        :param interval_hours: [optional] the duration of the intervals, in hours, when it is known beforehand (e.g. for
+        a chunk of a longer history). It is inferred from the index by default, see interval_hours.
+        """
+
+        if features is None:
+            # The local dates are kept instead of the index, such that the cache doesn't keep the index alive
+            if date_index.tz is not None:
+                date_index = date_index.tz_localize(None)
+            self.__local_dates = np.asarray(date_index, dtype='datetime64[ns]')
+            self.__arrays = {}  # the features of the whole index, by name
+            if interval_hours is not None:
+                self.__arrays['interval_hours'] = float(interval_hours)
+            idx_end = len(self.__local_dates)
+        else:
+            self.__local_dates = features.__local_dates
+            self.__arrays = features.__arrays
+
+        self.__idx_start = idx_start
+        self.__idx_end = idx_end
+
+    def slice(self, idx_start, idx_end):
+        """
+        Return the features of a range of positions of this index, sharing the computed features
+        :param idx_start: the first position of the range
+        :param idx_end: the end position of the range
+        :return: a TimestampFeatures object
+        """
+
+        return TimestampFeatures(None, self, self.__idx_start + idx_start, self.__idx_start + min(idx_end, len(self)))
+
+    @property
+    def local_days(self):
+        """
+        The local day of each date, as a numpy array of datetime64[D]
+        """
+
+        return self.__get('local_days')
+
+    @property
+    def month_codes(self):
+        """
+        The month of each date as year * 12 + month - 1, as a numpy array of int
+        """
+
+        return self.__get('month_codes')
+
+    @property
+    def months(self):
+        """
+        The month of each date, from 0 (january) to 11 (december), as a numpy array of int
+        """
+
+        return self.__get('months')
+
+    @property
+    def minutes_of_day(self):
+        """
+        The minute of the day of each date, as a numpy array of int
+        """
+
+        return self.__get('minutes_of_day')
+
+    @property
+    def interval_hours(self):
+        """
+        The duration of the intervals of the whole index, in hours: the median time between consecutive distinct dates,
+        such that the gaps in the data don't change it. None if the index has less than 2 distinct dates.
+        """
+
+        interval_hours = self.__get_full('interval_hours')
+
+        return float(interval_hours) if interval_hours > 0 else None
+
+    def get_slots(self, nb_slots):
+        """
+        Return the slot of each date in a day divided in 'nb_slots' slots of the same length
+        :param nb_slots: an int, e.g. 24 for hourly slots
+        :return: a numpy array of int
+        """
+
+        return self.__get(('slots', nb_slots))
+
+    def get_day_types(self, holiday_calendar):
+        """
+        Return the day-type code of each date in a HolidayCalendar, see HolidayCalendar.get_day_types()
+        :param holiday_calendar: a HolidayCalendar object
+        :return: a numpy array of int
+        """
+
+        key = ('day_types', holiday_calendar.country, holiday_calendar.state, holiday_calendar.holiday_day_type)
+        if key not in self.__arrays:
+            self.__arrays[key] = holiday_calendar.get_day_types_of_days(self.__get_full('local_days')).astype(np.int8)
+
+        return self.__get(key)
+
+    def get_monthly_slices(self):
+        """
+        Split the dates into calendar months, see TariffBase.get_monthly_slices()
+        :return: a list of tuples (month_label, idx_start, idx_end), with the positions relative to this range
+        """
+
+        if len(self) == 0:
+            return []
+
+        # The boundaries of the months strictly within this range
+        bounds = self.__get_full('month_bounds')
+        pos_start = np.searchsorted(bounds, self.__idx_start, side='right')
+        pos_end = np.searchsorted(bounds, self.__idx_end, side='left')
+        idx_bounds = np.concatenate(([self.__idx_start], bounds[pos_start:pos_end], [self.__idx_end])) - self.__idx_start
+
+        month_codes = self.month_codes
+        return [("{0:04d}-{1:02d}".format(month_codes[i_s] // 12, month_codes[i_s] % 12 + 1), i_s, i_e)
+                for i_s, i_e in zip(idx_bounds[:-1].tolist(), idx_bounds[1:].tolist())]
+
+    def __len__(self):
+        return self.__idx_end - self.__idx_start
+
+    # --- private
+    def __get(self, key):
+        """
+        Return a feature over the range of this object
+        """
+
+        return self.__get_full(key)[self.__idx_start:self.__idx_end]
+
+    def __get_full(self, key):
+        """
+        Return a feature over the whole index, computing it the first time
+        """
+
+        array = self.__arrays.get(key)
+        if array is not None:
+            return array
+
+        if key == 'local_days':
+            array = self.__local_dates.astype('datetime64[D]')
+        elif key == 'month_codes':
+            array = (self.__local_dates.astype('datetime64[M]').astype(np.int64) + 1970 * 12).astype(np.int32)
+        elif key == 'months':
+            array = (self.__get_full('month_codes') % 12).astype(np.int8)
+        elif key == 'minutes_of_day':
+            array = ((self.__local_dates - self.__get_full('local_days')) // np.timedelta64(1, 'm')).astype(np.int16)
+        elif key == 'month_bounds':
+            month_codes = self.__get_full('month_codes')
+            array = np.concatenate(([0], np.flatnonzero(np.diff(month_codes)) + 1, [len(month_codes)]))
+        elif key == 'interval_hours':
+            timesteps = np.diff(self.__local_dates)
+            timesteps = timesteps[timesteps > np.timedelta64(0)]  # the duplicates, e.g. the end of the DST
+            array = np.median(timesteps / np.timedelta64(1, 'h')) if len(timesteps) > 0 else 0.0
+        elif key[0] == 'slots':
+            array = self.__get_full('minutes_of_day').astype(np.int32) * key[1] // self.MINUTES_IN_DAY
+        else:
+            raise KeyError(key)
+
+        self.__arrays[key] = array
+        return array
+
+
+# The features of the indexes billed recently, by id of the index
+_features = OrderedDict()
+
+FEATURES_CACHE_MAXSIZE = 8
+
+
+def get_timestamp_features(date_index):
+    """
+    Return the TimestampFeatures of a sorted DatetimeIndex, shared by the bills computed on the same index object: pandas
+    indexes are immutable. The features are kept until the index is garbage collected, for the last
+    FEATURES_CACHE_MAXSIZE indexes.
+    :param date_index: a sorted pandas DatetimeIndex
+    :return: a TimestampFeatures object
+    """
+
+    key = id(date_index)
+    entry = _features.get(key)
+    if entry is not None and entry[0]() is date_index:
+        _features.move_to_end(key)
+        return entry[1]
+
+    features = TimestampFeatures(date_index)
+    index_ref = weakref.ref(date_index, lambda ref: _drop_features(key, ref))
+    _features[key] = (index_ref, features)
+
+    while len(_features) > FEATURES_CACHE_MAXSIZE:
+        _features.popitem(last=False)
+
+    return features
+
+
+def _drop_features(key, index_ref):
+    entry = _features.get(key)
+    if entry is not None and entry[0] is index_ref:
+        del _features[key]
@@ -8,7 +8,6 @@ from .tariff_maps import tariff_maps
 from cost_calculator.cost_calculator import *
 from openei_tariff.openei_tariff_analyzer import *
 from .utils import *
-from xbos import get_client
 
 def pollEvents(pollSceApi, sceConfig, pollPelicans, pelicanConfig, mdalClient=None):
     eventStartTimes = []
@@ -61,7 +60,6 @@ def getHourlyDayPrices(startDateTime, tariff_name='PGEA10', verbose=False, isItE
     eventStartDate = startDateTime.date()
 
     tariff_openei_data = tariff_maps[tariff_name]
-    bill_calc = CostCalculator()
     if isItEventDay:
         pdp_events = list(populate_pdp_events_from_json(openei_tarif_obj=tariff_openei_data, pdp_event_filenames='PDP_events.json'))
         utilityId = int(tariff_openei_data.req_param['eia'])
@@ -73,16 +71,16 @@ def getHourlyDayPrices(startDateTime, tariff_name='PGEA10', verbose=False, isItE
             pdp_events.append({'utility_id': utilityId, 'start_date': st, 'end_date': et})
             update_pdp_json(openei_tarif_obj=tariff_openei_data, pdp_dict=pdp_events, pdp_event_filenames='PDP_events.json')
 
-    if tariff_openei_data.read_from_json() == 0:  # Reading revised JSON blocks containing the utility rates
+    # TODO: compare start dates of events
+    # The tariff is only rebuilt from the revised JSON when the JSON or the PDP events changed, see cost_calculator_from_openei
+    bill_calc = cost_calculator_from_openei(tariff_openei_data, pdp_event_filenames='PDP_events.json')
+    if bill_calc is not None:
         if verbose:
             print("Tariff read from JSON successful")
     else:
         print("An error occurred when reading the JSON file" ) # <------------------- handle error
         return
 
-    # TODO: compare start dates of events
-    tariff_struct_from_openei_data(tariff_openei_data, bill_calc, pdp_event_filenames='PDP_events.json')
-
     pd_prices, map_prices = bill_calc.get_electricity_price(timestep=TariffElemPeriod.HOURLY,
                                                             range_date=(dtime.datetime(eventStartDate.year,
                                                                                           eventStartDate.month,
@@ -142,6 +140,9 @@ def generateDRSignal(startTime, requestId, eventId, modificationNumber, eventSta
     return drEventFilename, eventId, modificationNumber, startTime
 
 def getMdalClient(pelicanConfig):
+    from xbos import get_client
+    from xbos.services import mdal
+
     client = None
     if "xbosEntityPath" in list(pelicanConfig.keys()):
         entityPath = pelicanConfig["xbosEntityPath"]
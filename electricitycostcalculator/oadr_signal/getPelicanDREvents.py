@@ -1,7 +1,11 @@
 import datetime
-from xbos.services import mdal
 
-def get_uuid_data(UUIDs, freq, names, st, et, client, mdal_functions=mdal.MEAN, aligned=True):
+def get_uuid_data(UUIDs, freq, names, st, et, client, mdal_functions=None, aligned=True):
+    from xbos.services import mdal
+
+    if mdal_functions is None:
+        mdal_functions = mdal.MEAN
+
     query1 = {
         "Composition": UUIDs,
         "Selectors": mdal_functions,
@@ -34,6 +38,8 @@ def get_uuid_data(UUIDs, freq, names, st, et, client, mdal_functions=mdal.MEAN,
                                     }]
 '''
 def pollPelicanEvents(pelicanConfig, client):
+    from xbos.services import mdal
+
     uuid_tariff_map = pelicanConfig['pelican_uuid_tariff_map']
     checkHoursBefore = pelicanConfig['checkHoursBefore']
     events = []
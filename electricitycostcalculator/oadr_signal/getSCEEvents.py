@@ -1,8 +1,6 @@
 import pandas as pd
 # import urllib2
 import datetime
-from lxml import html
-import requests
 import pytz
 
 '''
@@ -21,6 +19,9 @@ import pytz
                                     }]
 '''
 def pollSCEEvents(sceConfig):
+    from lxml import html
+    import requests
+
     url = sceConfig['url']
     eventTypes = sceConfig['eventTypesToListenFor']  # CPP
 
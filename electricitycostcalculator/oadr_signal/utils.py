@@ -4,7 +4,6 @@ import datetime as dtime
 
 import pandas
 import pytz
-import requests
 
 def generateAlphanumericId(length=20, createdRandomIds=[]):
     rndm = ''.join(random.choice(string.ascii_lowercase[:6] + string.digits) for _ in range(length))
@@ -75,6 +74,7 @@ def arePricesDifferent(prices1, prices2):
     return False
 
 def sendSignalToServer(url, filename):
+    import requests
 
     # do something
     xml = open(OADR_PATH+"signals/"+filename, "r").read()
@@ -0,0 +1,227 @@
+__author__ = 'Olivier Van Cutsem'
+
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+import argparse
+import glob
+import json
+import os
+import threading
+import time
+
+from electricitycostcalculator.openei_tariff.openei_tariff_analyzer import THIS_PATH, SUFFIX_REVISED
+
+# --------------- Local stand-in of the OpenEI API --------------- #
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    An HTTP server answering each request in its own thread, such that concurrent requests are served concurrently
+    """
+
+    daemon_threads = True
+
+
+class FakeOpenEIServer(object):
+    """
+    A local HTTP server answering the requests of the OpenEI utility rates API with the tariff blocks of the JSON
+    fixtures of this package (the raw API answers, not the revised ones), such that the API clients can be run and
+    timed offline:
+     - the blocks are filtered on the 'eia' and 'sector' parameters and sorted by 'startdate'
+     - the answer is paginated with the 'offset' and 'limit' parameters, as {'items': [...]}
+
+    A latency and some transient failures (HTTP 503) can be simulated, see the constructor.
+    """
+
+    def __init__(self, fixtures=None, host='127.0.0.1', port=0, delay=0.0, fail_requests=0):
+        """
+        Constructor: the fixtures are loaded, the server is started by start()
+        :param fixtures: [optional] a list of tariff blocks (dict) to serve. The JSON fixtures of this package by default
+        :param host: [optional] the address of the server
+        :param port: [optional] the port of the server. A free port is picked by default
+        :param delay: [optional] the latency of each answer, in seconds
+        :param fail_requests: [optional] the number of requests answered with an HTTP 503 error before serving the data
+        """
+
+        if fixtures is None:
+            fixtures = self.load_fixtures()
+
+        self.fixtures = sorted(fixtures, key=lambda block: block['startdate'])
+        self.delay = delay
+        self.fail_requests = fail_requests
+
+        self.nb_requests = 0
+        self.__lock = threading.Lock()
+        self.__answers = {}  # the encoded pages, see get_answer()
+
+        self.__server = ThreadingHTTPServer((host, port), self.__get_handler())
+        self.__thread = None
+
+    @property
+    def url(self):
+        """
+        The URL of the utility rates API served, to use instead of OpenEI_tariff.URL_OPENEI
+        """
+
+        (host, port) = self.__server.server_address[:2]
+
+        return 'http://{0}:{1}/utility_rates'.format(host, port)
+
+    def start(self):
+        """
+        Serve the requests in a background thread
+        :return: the server itself
+        """
+
+        self.__thread = threading.Thread(target=self.__server.serve_forever, daemon=True)
+        self.__thread.start()
+
+        return self
+
+    def stop(self):
+        """
+        Stop the server and release its port
+        :return: /
+        """
+
+        if self.__thread is not None:
+            self.__server.shutdown()
+            self.__thread.join()
+            self.__thread = None
+        self.__server.server_close()
+
+    def serve_forever(self):
+        """
+        Serve the requests in the current thread, until interrupted
+        :return: /
+        """
+
+        try:
+            self.__server.serve_forever()
+        finally:
+            self.__server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def get_page(self, params):
+        """
+        Return the answer of the API to a request
+        :param params: a dict of the parameters of the request, e.g. {'eia': '14328', 'sector': 'Commercial', 'offset':
+        '0', 'limit': '500'}
+        :return: a dict {'items': [...]}, the blocks of the requested page
+        """
+
+        items = self.fixtures
+        if params.get('eia') is not None:
+            items = [block for block in items if str(block.get('eiaid')) == str(params['eia'])]
+        if params.get('sector') is not None:
+            items = [block for block in items if str(block.get('sector', '')).lower() == params['sector'].lower()]
+
+        offset = int(params.get('offset', 0))
+        limit = int(params.get('limit', len(items)))
+
+        return {'items': items[offset:offset+limit]}
+
+    def get_answer(self, params):
+        """
+        Return the JSON-encoded answer of the API to a request, see get_page(). The answers are encoded once per page,
+        such that the server time is mostly the simulated latency.
+        :param params: a dict of the parameters of the request
+        :return: bytes
+        """
+
+        key = tuple(params.get(name) for name in ['eia', 'sector', 'offset', 'limit'])
+        if key not in self.__answers:
+            self.__answers[key] = json.dumps(self.get_page(params)).encode()
+
+        return self.__answers[key]
+
+    @staticmethod
+    def load_fixtures(path=THIS_PATH):
+        """
+        Read the tariff blocks of the raw OpenEI answers stored in a folder, see OpenEI_tariff.call_api(). The blocks
+        found in several files (same label, name and starting date) are kept once.
+        :param path: [optional] the folder of the JSON files, the folder of this package by default
+        :return: a list of dict
+        """
+
+        fixtures = {}
+        for filename in sorted(glob.glob(os.path.join(path, 'u*.json'))):
+            if filename.endswith(SUFFIX_REVISED + '.json'):
+                continue
+
+            with open(filename, 'r') as input_file:
+                for block in json.load(input_file):
+                    fixtures.setdefault((block.get('label'), block['name'], block['startdate']), block)
+
+        return list(fixtures.values())
+
+    def count_request(self):
+        """
+        Count a request received by the server
+        :return: True if this request must fail, see fail_requests
+        """
+
+        with self.__lock:
+            self.nb_requests += 1
+            return self.nb_requests <= self.fail_requests
+
+    # --- private
+
+    def __get_handler(self):
+        """
+        Return the request handler class of the server, bound to this object
+        """
+
+        fake_server = self
+
+        class FakeOpenEIHandler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                params = {k: v[-1] for k, v in list(parse_qs(url.query).items())}
+
+                is_failing = fake_server.count_request()
+
+                if fake_server.delay > 0:
+                    time.sleep(fake_server.delay)
+
+                if is_failing:
+                    self.__send(503, {'error': 'Service temporarily unavailable'})
+                elif url.path.rstrip('/') != '/utility_rates':
+                    self.__send(404, {'error': 'Unknown path: {0}'.format(url.path)})
+                else:
+                    try:
+                        self.__send(200, fake_server.get_answer(params))
+                    except ValueError as e:
+                        self.__send(400, {'error': str(e)})
+
+            def __send(self, status, data):
+                body = data if isinstance(data, bytes) else json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # silent
+
+        return FakeOpenEIHandler
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve the OpenEI JSON fixtures as a local utility rates API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--delay', type=float, default=0.0, help="the latency of each answer, in seconds")
+    args = parser.parse_args()
+
+    server = FakeOpenEIServer(host=args.host, port=args.port, delay=args.delay)
+    print("Serving the OpenEI fixtures on {0}".format(server.url))
+    server.serve_forever()
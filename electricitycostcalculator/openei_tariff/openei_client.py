@@ -0,0 +1,171 @@
+__author__ = 'Olivier Van Cutsem'
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from electricitycostcalculator.cost_calculator.instrumentation import instrumented
+from electricitycostcalculator.openei_tariff.openei_tariff_analyzer import OpenEI_tariff
+
+logger = logging.getLogger(__name__)
+
+# --------------- Concurrent OpenEI requests --------------- #
+
+
+class OpenEIClient(object):
+    """
+    This class requests the tariff blocks of many OpenEI_tariff objects from the OpenEI utility rates API concurrently,
+    with asyncio, instead of one blocking request per tariff (see OpenEI_tariff.call_api()):
+     - at most 'max_concurrency' requests are in flight at once
+     - the answer of each tariff is read page by page (parameters 'offset' and 'limit') until a page is not full
+     - the requests failing with a connection error, an HTTP 429 or a 5xx status are retried with an exponential backoff
+     - the blocks are filtered page by page with OpenEI_tariff.is_block_of_interest(), then stored as call_api() does
+
+    The HTTP requests are made with 'requests' in a pool of threads, such that no asynchronous HTTP library is needed.
+    Nothing is printed: the retries are logged at the DEBUG level and the tariffs that could not be retrieved at the
+    INFO level, on the logger of this module.
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, url=OpenEI_tariff.URL_OPENEI, max_concurrency=8, page_size=500, max_retries=3, backoff=0.5,
+                 timeout=30):
+        """
+        Constructor
+        :param url: [optional] the URL of the utility rates API, e.g. the one of a FakeOpenEIServer
+        :param max_concurrency: [optional] the maximum number of requests in flight
+        :param page_size: [optional] the number of blocks requested per page
+        :param max_retries: [optional] the number of retries of a failing request
+        :param backoff: [optional] the delay before the first retry, in seconds. It doubles at each retry.
+        :param timeout: [optional] the timeout of a request, in seconds
+        """
+
+        self.url = url
+        self.max_concurrency = max_concurrency
+        self.page_size = page_size
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    @instrumented('OpenEIClient.fetch_tariffs')
+    def fetch_tariffs(self, openei_tarif_objs, store_as_json=None):
+        """
+        Request the tariff blocks of several tariffs concurrently and store them in each OpenEI_tariff object
+        :param openei_tarif_objs: a list of OpenEI_tariff objects
+        :param store_as_json: [optional] if not None, the filtered blocks are stored in JSON files, see call_api()
+        :return: a list of int, for each tariff: 0 if its blocks were retrieved, 1 otherwise
+        """
+
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(self.fetch_tariffs_async(openei_tarif_objs, store_as_json))
+        finally:
+            loop.close()
+
+    async def fetch_tariffs_async(self, openei_tarif_objs, store_as_json=None):
+        """
+        The coroutine of fetch_tariffs(), to run in an event loop
+        """
+
+        import requests  # deferred: the tariffs are mostly read from the revised JSONs
+
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor, requests.Session() as session:
+            # A connection to the server per request in flight
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            tasks = [self.fetch_tariff(openei_tarif_obj, session, executor, semaphore, store_as_json)
+                     for openei_tarif_obj in openei_tarif_objs]
+            return list(await asyncio.gather(*tasks))
+
+    async def fetch_tariff(self, openei_tarif_obj, session, executor, semaphore, store_as_json=None):
+        """
+        Request all the pages of the blocks of a tariff, keep the ones of interest and store them in the object
+        :param openei_tarif_obj: an OpenEI_tariff object
+        :param session: a requests Session
+        :param executor: the pool of threads running the requests
+        :param semaphore: an asyncio Semaphore bounding the number of requests in flight
+        :param store_as_json: [optional] see call_api()
+        :return: 0 if the blocks were retrieved, 1 otherwise
+        """
+
+        data_filtered = []
+        offset = 0
+        while True:
+            params = dict(openei_tarif_obj.req_param, limit=str(self.page_size), offset=str(offset))
+            try:
+                data_openei = await self.get_page(params, session, executor, semaphore)
+            except Exception as e:
+                logger.info("the blocks of '%s' could not be retrieved: %s", openei_tarif_obj.json_filename,
+                            self.get_error_name(e))
+                return 1
+
+            items = data_openei.get('items', [])
+            data_filtered.extend([data_block for data_block in items if openei_tarif_obj.is_block_of_interest(data_block)])
+
+            if len(items) < self.page_size:
+                break
+            offset += len(items)
+
+        openei_tarif_obj.set_api_data(data_filtered, store_as_json)
+
+        return 0
+
+    async def get_page(self, params, session, executor, semaphore):
+        """
+        Request a page of the API, retrying the transient failures
+        :param params: a dict, the parameters of the request
+        :return: the decoded JSON answer
+        """
+
+        import requests
+
+        loop = asyncio.get_event_loop()
+        for retry in range(self.max_retries + 1):
+            async with semaphore:
+                try:
+                    r = await loop.run_in_executor(executor, lambda: session.get(self.url, params=params, timeout=self.timeout))
+                except requests.RequestException as e:
+                    if retry == self.max_retries:
+                        raise
+                    error = self.get_error_name(e)
+                else:
+                    if r.status_code not in self.RETRY_STATUS or retry == self.max_retries:
+                        r.raise_for_status()
+                        return r.json()
+                    error = 'HTTP {0}'.format(r.status_code)
+
+            # Wait outside of the semaphore, such that the other requests go on
+            delay = self.backoff * 2 ** retry
+            logger.debug("%s, retry in %.2fs", error, delay)
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def get_error_name(error):
+        """
+        Return a short description of a failed request, to log: the messages of 'requests' hold the URL, and thus the
+        API key
+        :param error: an exception
+        :return: a string, e.g. 'HTTP 503' or 'ConnectionError'
+        """
+
+        response = getattr(error, 'response', None)
+        if response is not None:
+            return 'HTTP {0}'.format(response.status_code)
+
+        return type(error).__name__
+
+
+def fetch_tariffs(openei_tarif_objs, store_as_json=None, url=OpenEI_tariff.URL_OPENEI, max_concurrency=8):
+    """
+    Request the tariff blocks of several tariffs concurrently, see OpenEIClient
+    :param openei_tarif_objs: a list of OpenEI_tariff objects
+    :param store_as_json: [optional] see OpenEI_tariff.call_api()
+    :param url: [optional] see OpenEIClient
+    :param max_concurrency: [optional] see OpenEIClient
+    :return: see OpenEIClient.fetch_tariffs()
+    """
+
+    return OpenEIClient(url=url, max_concurrency=max_concurrency).fetch_tariffs(openei_tarif_objs, store_as_json)
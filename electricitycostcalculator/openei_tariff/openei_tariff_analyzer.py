@@ -3,19 +3,44 @@ __author__ = 'Olivier Van Cutsem'
 # Import COST CALCULATOR LIB
 from electricitycostcalculator.cost_calculator.tariff_structure import *
 from electricitycostcalculator.cost_calculator.rate_structure import *
+from electricitycostcalculator.cost_calculator.cost_calculator import CostCalculator
+from electricitycostcalculator.cost_calculator.instrumentation import instrumented
+from electricitycostcalculator.cost_calculator.compiled_tariff import COMPILED_EXTENSION, COMPILED_FORMAT_VERSION, \
+    save_compiled_tariff, load_compiled_tariff
 
+import glob
+import hashlib
 import time
 from datetime import datetime
-import requests
 import json
 import pytz
 import os
-from dateutil.parser import parse
 
 # ----------- FUNCTIONS SPECIFIC TO OpenEI REQUESTS -------------- #
 THIS_PATH = os.path.dirname(os.path.abspath(__file__)) + '/'
 PDP_PATH = os.path.dirname(os.path.abspath(__file__)) + '/'
 
+
+def get_user_cache_path():
+    """
+    Return the folder of the compiled tariffs in the cache of the user, outside of the installed package: the folder in
+    the ECC_CACHE_DIR environment variable, else LOCALAPPDATA on Windows, XDG_CACHE_HOME or ~/.cache elsewhere
+    :return: a string, ending with '/'
+    """
+
+    cache_path = os.environ.get('ECC_CACHE_DIR')
+    if not cache_path:
+        if os.name == 'nt':
+            cache_root = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+        else:
+            cache_root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_path = os.path.join(cache_root, 'electricitycostcalculator', 'compiled')
+
+    return os.path.join(cache_path, '')
+
+
+COMPILED_PATH = get_user_cache_path()
+
 SUFFIX_REVISED = '_revised'  # this is the suffix we added to the json filename after correctly the OpenEI data manually
 
 
@@ -30,7 +55,8 @@ class OpenEI_tariff(object):
     LIMIT = '500'
     ORDER_BY_SORT = 'startdate'
 
-    def __init__(self, utility_id=0, sector='commercial', tariff_rate_of_interest='tou', distrib_level_of_interest='Secondary', phasewing='Single', tou=False, pdp=True, option_mandatory=None, option_exclusion=None):
+    def __init__(self, utility_id=0, sector='commercial', tariff_rate_of_interest='tou', distrib_level_of_interest='Secondary', phasewing='Single', tou=False, pdp=True, option_mandatory=None, option_exclusion=None, holiday_calendar=None,
+                 demand_window=None, demand_window_mode=DemandWindowMode.BLOCK):
 
         self.req_param = {}
 
@@ -57,6 +83,13 @@ class OpenEI_tariff(object):
 
         self.pdp_participate = pdp
 
+        # The calendar of the utility, used to treat the holidays in the TOU schedules (California by default)
+        self.holiday_calendar = holiday_calendar
+
+        # The demand window of the demand charges, in minutes (the 'demandwindow' of the tariff blocks by default)
+        self.demand_window = demand_window
+        self.demand_window_mode = demand_window_mode
+
         # The raw filtered answer from an API call
         self.data_openei = None
         self.pdp_events = []
@@ -65,60 +98,74 @@ class OpenEI_tariff(object):
         self.pdp_events = pdp_events_dict
 
     def call_api(self, store_as_json=None):
+        """
+        Request the tariff blocks from the OpenEI API, in a single blocking request, and keep the ones of interest.
+        See openei_client.py to request many tariffs concurrently.
+        :param store_as_json: [optional] if not None, the filtered blocks are stored in a JSON file, see json_filename
+        :return: /
+        """
+
+        import requests  # deferred: the tariffs are mostly read from the revised JSONs
 
         r = requests.get(self.URL_OPENEI, params=self.req_param)
         data_openei = r.json()
-        data_filtered = []
-
-        for data_block in data_openei['items']:
-            print((data_block['name']))
-            # Check the tariff name, this is stored in the field "name"
-            if self.tariff_rate_of_interest not in data_block['name'] and self.tariff_rate_of_interest + '-' not in data_block['name']:
-                continue
-            print((" - {0}".format(data_block['name'])))
-
-            # Check the wiring option
-            if self.phase_wing is not None:
-                if 'phasewiring' in list(data_block.keys()):
-                    if not(self.phase_wing in data_block['phasewiring']):
-                        continue
-                else:  # check the title if this field is missing
-                    if self.phase_wing not in data_block['name']:
-                        continue
-
-            # Check the grid level option
-            if self.distrib_level_of_interest is not None:
-                if self.distrib_level_of_interest not in data_block['name']:
-                    continue
 
-            print((" -- {0}".format(data_block['name'])))
-            # Check the Time of Use option
-            if (self.tou and 'TOU' not in data_block['name']) or (not self.tou and 'TOU' in data_block['name']):
-                continue
-
-            # Ensure some options on the rate:
-            if self.option_mandatory is not None:
-                continue_block = False
-                for o in self.option_mandatory:
-                    if o not in data_block['name']:
-                        continue_block = True
-                        break
-                if continue_block:
-                    continue
+        self.set_api_data([data_block for data_block in data_openei['items'] if self.is_block_of_interest(data_block)],
+                          store_as_json)
 
-            # Exclude some options on the rate
-            if self.option_exclusion is not None:
-                continue_block = False
-                for o in self.option_exclusion:
-                    if o in data_block['name']:
-                        continue_block = True
-                        break
-                if continue_block:
-                    continue
+    def is_block_of_interest(self, data_block):
+        """
+        Check if a tariff block returned by the OpenEI API matches the options of this tariff: its name, the phase
+        wiring, the grid level, the TOU option and the mandatory and excluded options
+        :param data_block: a dict, an item of the API answer
+        :return: a bool
+        """
 
-            #print(" -------> {0}".format(data_block['name']))
-            # The conditions are fulfilled: add this block
-            data_filtered.append(data_block)
+        # Check the tariff name, this is stored in the field "name"
+        if self.tariff_rate_of_interest not in data_block['name'] and self.tariff_rate_of_interest + '-' not in data_block['name']:
+            return False
+
+        # Check the wiring option
+        if self.phase_wing is not None:
+            if 'phasewiring' in list(data_block.keys()):
+                if not(self.phase_wing in data_block['phasewiring']):
+                    return False
+            else:  # check the title if this field is missing
+                if self.phase_wing not in data_block['name']:
+                    return False
+
+        # Check the grid level option
+        if self.distrib_level_of_interest is not None:
+            if self.distrib_level_of_interest not in data_block['name']:
+                return False
+
+        # Check the Time of Use option
+        if (self.tou and 'TOU' not in data_block['name']) or (not self.tou and 'TOU' in data_block['name']):
+            return False
+
+        # Ensure some options on the rate:
+        if self.option_mandatory is not None:
+            for o in self.option_mandatory:
+                if o not in data_block['name']:
+                    return False
+
+        # Exclude some options on the rate
+        if self.option_exclusion is not None:
+            for o in self.option_exclusion:
+                if o in data_block['name']:
+                    return False
+
+        # The conditions are fulfilled
+        return True
+
+    def set_api_data(self, data_filtered, store_as_json=None):
+        """
+        Store the tariff blocks of interest returned by the OpenEI API, sorted by starting date: their dates are made
+        consecutive and encoded as in the JSON files
+        :param data_filtered: a list of dict, the blocks that passed is_block_of_interest()
+        :param store_as_json: [optional] if not None, the blocks are stored in a JSON file, see json_filename
+        :return: /
+        """
 
         # Make sure we work with integer timestamps
         for rate_data in data_filtered:
@@ -159,6 +206,7 @@ class OpenEI_tariff(object):
             with open(THIS_PATH+filename+'.json', 'w') as outfile:
                 json.dump(data_filtered, outfile, indent=2, sort_keys=True)
 
+    @instrumented('OpenEI_tariff.read_from_json')
     def read_from_json(self, filename=None):
         """
         Read tariff data from a JSON file to build the internal structure. The JSON file
@@ -219,6 +267,118 @@ class OpenEI_tariff(object):
 
 # --- Inject data from OpenEI_tariff object to the Bill Calculator
 
+def cost_calculator_from_openei(openei_tarif_obj, pdp_event_filenames='PDP_events.json', filename=None, compiled_path=COMPILED_PATH):
+    """
+    Return a CostCalculator filled with a revised OpenEI tariff, as read_from_json() and
+    tariff_struct_from_openei_data() would build it. The calculator is stored in a compiled tariff file in
+    'compiled_path' (see compiled_tariff.py), such that the next calls load it directly as long as the tariff JSON and
+    the PDP events are unchanged.
+
+    Remark: when the compiled tariff is used, the OpenEI JSON is not read: openei_tarif_obj.data_openei isn't updated.
+
+    :param openei_tarif_obj: an instance of OpenEI_tariff
+    :param pdp_event_filenames: the name of the PDP events file, in PDP_PATH
+    :param filename: [optional] the path of the revised JSON file, see read_from_json()
+    :param compiled_path: [optional] the folder of the compiled tariffs, in the cache of the user by default (see
+    get_user_cache_path). If None, the calculator is always rebuilt. If the folder can't be written, the calculator is
+    returned without being stored.
+    :return: a CostCalculator object, or None if the tariff JSON couldn't be read
+    """
+
+    if filename is None:
+        filename = THIS_PATH+str(openei_tarif_obj.json_filename)+str(SUFFIX_REVISED)+'.json'
+
+    compiled_filename = None
+    source_key = None
+    if compiled_path is not None:
+        try:
+            source_key = get_openei_source_key(openei_tarif_obj, filename, pdp_event_filenames)
+        except EnvironmentError as e:
+            print(('cant open file' + str(e)))
+            return None
+
+        # The variants of a tariff built from the same JSON (e.g. with and without demand window) have their own files
+        compiled_prefix = compiled_path + os.path.splitext(os.path.basename(filename))[0] + '_' + \
+            get_openei_options_key(openei_tarif_obj)[:8]
+        compiled_filename = compiled_prefix + '_' + source_key[:16] + COMPILED_EXTENSION
+
+        bill_calculator = load_compiled_tariff(compiled_filename, source_key)
+        if bill_calculator is not None:
+            if openei_tarif_obj.pdp_participate:
+                populate_pdp_events_from_json(openei_tarif_obj, pdp_event_filenames=pdp_event_filenames)
+            return bill_calculator
+
+    if openei_tarif_obj.read_from_json(filename) != 0:
+        return None
+
+    bill_calculator = CostCalculator()
+    tariff_struct_from_openei_data(openei_tarif_obj, bill_calculator, pdp_event_filenames=pdp_event_filenames)
+
+    if compiled_filename is not None:
+        try:
+            # The files compiled from previous versions of the sources are outdated
+            for old_filename in glob.glob(glob.escape(compiled_prefix) + '_*' + COMPILED_EXTENSION):
+                if old_filename == compiled_filename:
+                    continue
+                try:
+                    os.remove(old_filename)
+                except FileNotFoundError:  # removed by another process meanwhile
+                    pass
+
+            if not os.path.exists(compiled_path):
+                os.makedirs(compiled_path)
+            save_compiled_tariff(bill_calculator, compiled_filename, source_key)
+        except OSError as e:  # e.g. a read-only folder: the calculator is still usable
+            print(('cant store the compiled tariff ' + str(e)))
+
+    return bill_calculator
+
+
+def get_openei_source_key(openei_tarif_obj, filename, pdp_event_filenames='PDP_events.json'):
+    """
+    Return a hash of the sources of a tariff built by tariff_struct_from_openei_data(): the revised JSON, the PDP
+    events and the options of openei_tarif_obj that are used to build the tariff blocks
+    :param openei_tarif_obj: an instance of OpenEI_tariff
+    :param filename: the path of the revised JSON file
+    :param pdp_event_filenames: the name of the PDP events file, in PDP_PATH
+    :return: a string
+    """
+
+    hash_obj = hashlib.sha1()
+    hash_obj.update(repr((COMPILED_FORMAT_VERSION, get_openei_options_key(openei_tarif_obj))).encode())
+
+    with open(filename, 'rb') as input_file:
+        hash_obj.update(input_file.read())
+
+    if openei_tarif_obj.pdp_participate:
+        pdp_data = b'[]'  # the file is created empty if it doesn't exist
+        if os.path.exists(PDP_PATH+pdp_event_filenames):
+            with open(PDP_PATH+pdp_event_filenames, 'rb') as pdp_file:
+                pdp_data = pdp_file.read()
+        hash_obj.update(pdp_data)
+
+    return hash_obj.hexdigest()
+
+
+def get_openei_options_key(openei_tarif_obj):
+    """
+    Return a hash of the options of openei_tarif_obj that are used to build the tariff blocks, besides the JSON: the
+    utility, the PDP participation, the holiday calendar and the demand window
+    :param openei_tarif_obj: an instance of OpenEI_tariff
+    :return: a string
+    """
+
+    holiday_calendar = openei_tarif_obj.holiday_calendar
+    if holiday_calendar is not None:
+        holiday_calendar = (holiday_calendar.country, holiday_calendar.state, holiday_calendar.holiday_day_type)
+
+    options = (openei_tarif_obj.req_param['eia'], openei_tarif_obj.pdp_participate, holiday_calendar,
+               openei_tarif_obj.demand_window, openei_tarif_obj.demand_window_mode)
+
+    return hashlib.sha1(repr(options).encode()).hexdigest()
+
+
+@instrumented('tariff_struct_from_openei_data')
 def tariff_struct_from_openei_data(openei_tarif_obj, bill_calculator, pdp_event_filenames="PDP_events.json"):
     """
     Analyze the content of an OpenEI request in order to fill a CostCalculator object
@@ -227,6 +387,8 @@ def tariff_struct_from_openei_data(openei_tarif_obj, bill_calculator, pdp_event_
     :return: /
     """
 
+    from dateutil.parser import parse
+
     tariff_struct = {}
 
     # Analyse each block
@@ -242,6 +404,10 @@ def tariff_struct_from_openei_data(openei_tarif_obj, bill_calculator, pdp_event_
 
         tariff_dates = (block_rate['startdate'], block_rate['enddate'])
 
+        demand_window = openei_tarif_obj.demand_window
+        if demand_window is None:
+            demand_window = block_rate.get('demandwindow')
+
         # --- Fix charges
         if 'fixedchargefirstmeter' in list(block_rate.keys()):
             tariff_fix = block_rate['fixedchargefirstmeter']
@@ -254,37 +420,41 @@ def tariff_struct_from_openei_data(openei_tarif_obj, bill_calculator, pdp_event_
             bill_calculator.add_tariff(FixedTariff(tariff_dates, tariff_fix, period_fix_charge), str(TariffType.FIX_CUSTOM_CHARGE.value))
 
         # --- Demand charges: flat
-        tariff_flatdemand_obj = get_flatdemand_obj_from_openei(block_rate)
+        tariff_flatdemand_obj = get_flatdemand_obj_from_openei(block_rate, openei_tarif_obj.holiday_calendar)
 
         if tariff_flatdemand_obj is not None:
-            bill_calculator.add_tariff(TouDemandChargeTariff(tariff_dates, tariff_flatdemand_obj),
+            bill_calculator.add_tariff(TouDemandChargeTariff(tariff_dates, tariff_flatdemand_obj, demand_window=demand_window,
+                                                             demand_window_mode=openei_tarif_obj.demand_window_mode),
                                        str(TariffType.DEMAND_CUSTOM_CHARGE_SEASON.value))
 
         # --- Energy charges
-        tariff_energy_obj = get_energyrate_obj_from_openei(block_rate)
+        tariff_energy_obj = get_energyrate_obj_from_openei(block_rate, openei_tarif_obj.holiday_calendar)
 
         if tariff_energy_obj is not None:
             bill_calculator.add_tariff(TouEnergyChargeTariff(tariff_dates, tariff_energy_obj), str(TariffType.ENERGY_CUSTOM_CHARGE.value))
 
         # --- Demand charges: tou
-        tariff_toudemand_obj = get_demandrate_obj_from_openei(block_rate)
+        tariff_toudemand_obj = get_demandrate_obj_from_openei(block_rate, openei_tarif_obj.holiday_calendar)
 
         if tariff_toudemand_obj is not None:
-            bill_calculator.add_tariff(TouDemandChargeTariff(tariff_dates, tariff_toudemand_obj), str(TariffType.DEMAND_CUSTOM_CHARGE_TOU.value))
+            bill_calculator.add_tariff(TouDemandChargeTariff(tariff_dates, tariff_toudemand_obj, demand_window=demand_window,
+                                                             demand_window_mode=openei_tarif_obj.demand_window_mode),
+                                       str(TariffType.DEMAND_CUSTOM_CHARGE_TOU.value))
 
         if openei_tarif_obj.pdp_participate:
             # --- PDP credits for energy - todo: remove the pdp days
-            tariff_pdp_credit_energy_obj = get_pdp_credit_energyrate_obj_from_openei(block_rate)
+            tariff_pdp_credit_energy_obj = get_pdp_credit_energyrate_obj_from_openei(block_rate, openei_tarif_obj.holiday_calendar)
 
             if tariff_pdp_credit_energy_obj is not None:
                 bill_calculator.add_tariff(TouEnergyChargeTariff(tariff_dates, tariff_pdp_credit_energy_obj),
                                            str(TariffType.PDP_ENERGY_CREDIT.value))
 
             # --- PDP credits for demand
-            tariff_pdp_credit_demand_obj = get_pdp_credit_demandrate_obj_from_openei(block_rate)
+            tariff_pdp_credit_demand_obj = get_pdp_credit_demandrate_obj_from_openei(block_rate, openei_tarif_obj.holiday_calendar)
 
             if tariff_pdp_credit_demand_obj is not None:
-                bill_calculator.add_tariff(TouDemandChargeTariff(tariff_dates, tariff_pdp_credit_demand_obj),
+                bill_calculator.add_tariff(TouDemandChargeTariff(tariff_dates, tariff_pdp_credit_demand_obj, demand_window=demand_window,
+                                                                 demand_window_mode=openei_tarif_obj.demand_window_mode),
                                            str(TariffType.PDP_DEMAND_CREDIT.value))
                 # --- PDP credits for demand
 
@@ -339,9 +509,8 @@ def update_pdp_json(openei_tarif_obj, pdp_dict, pdp_event_filenames='PDP_events.
         return True
     return False
 
-def get_energyrate_obj_from_openei(open_ei_block):
+def get_energyrate_obj_from_openei(open_ei_block, holiday_calendar=None):
 
-    # TODO later: use BlockRate instead of assuming it's a float !
     if 'energyratestructure' not in list(open_ei_block.keys()):
         return None
 
@@ -353,12 +522,12 @@ def get_energyrate_obj_from_openei(open_ei_block):
     rate_struct = read_tou_rates(en_rate_list, weekdays_schedule, weekends_schedule)
 
     if rate_struct != {}:
-        return TouRateSchedule(rate_struct)
+        return TouRateSchedule(rate_struct, holiday_calendar)
     else:
         return None
 
 
-def get_flatdemand_obj_from_openei(open_ei_block):
+def get_flatdemand_obj_from_openei(open_ei_block, holiday_calendar=None):
 
     rate_struct = {}
     if 'flatdemandstructure' in list(open_ei_block.keys()):  # there is a flat demand rate
@@ -368,12 +537,12 @@ def get_flatdemand_obj_from_openei(open_ei_block):
         rate_struct = read_flat_rates(dem_rate_list, dem_time_schedule_month)
 
     if rate_struct != {}:
-        return TouRateSchedule(rate_struct)
+        return TouRateSchedule(rate_struct, holiday_calendar)
     else:
         return None
 
 
-def get_demandrate_obj_from_openei(open_ei_block):
+def get_demandrate_obj_from_openei(open_ei_block, holiday_calendar=None):
 
     if 'demandratestructure' not in list(open_ei_block.keys()):
         return None
@@ -386,7 +555,7 @@ def get_demandrate_obj_from_openei(open_ei_block):
     rate_struct = read_tou_rates(demand_rate_list, weekdays_schedule, weekends_schedule)
 
     if rate_struct != {}:
-        return TouRateSchedule(rate_struct)
+        return TouRateSchedule(rate_struct, holiday_calendar)
     else:
         return None
 
@@ -395,11 +564,13 @@ def read_tou_rates(rate_map, weekdays_schedule, weekends_schedule):
 
     ret = {}
 
+    rates = [read_rate_tiers(tiers) for tiers in rate_map]
+
     for m_i in range(12):
 
         already_added = False
-        daily_weekdays_rate = [rate_map[x][0]['rate'] for x in weekdays_schedule[m_i]]
-        daily_weekends_rate = [rate_map[x][0]['rate'] for x in weekends_schedule[m_i]]
+        daily_weekdays_rate = [rates[x] for x in weekdays_schedule[m_i]]
+        daily_weekends_rate = [rates[x] for x in weekends_schedule[m_i]]
 
         # Check if this schedule is already present
         for m_group_lab, m_group_data in list(ret.items()):
@@ -426,6 +597,23 @@ def read_tou_rates(rate_map, weekdays_schedule, weekends_schedule):
     return ret
 
 
+def read_rate_tiers(tiers):
+    """
+    Read the tiers of an OpenEI rate: a list of dicts {'rate': r, 'max': m, ...} where 'max' is the upper bound of the
+    tier (in the unit of the rate, e.g. kWh per month), absent for the last one
+    :param tiers: the list of tiers of the rate
+    :return: a float if the rate has a single tier, a BlockRate otherwise
+    """
+
+    if len(tiers) == 1:
+        return tiers[0]['rate']
+
+    costs = [t['rate'] for t in tiers[1:]]
+    thresholds = [t['max'] for t in tiers[:-1]]
+
+    return BlockRate(tiers[0]['rate'], (costs, thresholds))
+
+
 def read_flat_rates(rate_map, month_schedule):
     """
 
@@ -443,7 +631,7 @@ def read_flat_rates(rate_map, month_schedule):
                                                       'allweek': {
                                                           TouRateSchedule.DAYSLIST_KEY: list(range(7)),
                                                           TouRateSchedule.RATES_KEY: 24 * [
-                                                              rate_map[rate_idx][0]['rate']]
+                                                              read_rate_tiers(rate_map[rate_idx])]
                                                       }
                                                   }
                                                   }
@@ -480,18 +668,17 @@ def get_pdp_energycharge(openei_tarif_obj, date_start_event):
                                                       }
                                                   }
                                                   }
-        return TouRateSchedule(rate_struct)
+        return TouRateSchedule(rate_struct, openei_tarif_obj.holiday_calendar)
     else:
         return None
 
-def get_pdp_credit_energyrate_obj_from_openei(open_ei_block):
+def get_pdp_credit_energyrate_obj_from_openei(open_ei_block, holiday_calendar=None):
     """
 
     :param block_rate:
     :return:
     """
 
-    # TODO later: use BlockRate instead of assuming it's a float !
     if 'pdp_credit_energyratestructure' not in list(open_ei_block.keys()):
         return None
 
@@ -503,11 +690,11 @@ def get_pdp_credit_energyrate_obj_from_openei(open_ei_block):
     rate_struct = read_tou_rates(en_rate_list, weekdays_schedule, weekends_schedule)
 
     if rate_struct != {}:
-        return TouRateSchedule(rate_struct)
+        return TouRateSchedule(rate_struct, holiday_calendar)
     else:
         return None
 
-def get_pdp_credit_demandrate_obj_from_openei(open_ei_block):
+def get_pdp_credit_demandrate_obj_from_openei(open_ei_block, holiday_calendar=None):
     """
 
     :param block_rate:
@@ -531,6 +718,6 @@ def get_pdp_credit_demandrate_obj_from_openei(open_ei_block):
         rate_struct = read_flat_rates(pdp_demand_credit_list, monthly_schedule)
 
     if rate_struct != {}:
-        return TouRateSchedule(rate_struct)
+        return TouRateSchedule(rate_struct, holiday_calendar)
     else:
         return None
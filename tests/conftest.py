@@ -0,0 +1,47 @@
+__author__ = 'Olivier Van Cutsem'
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from benchmarks.synthetic import load_openei_tariff, generate_load_profiles, generate_tariff
+
+# --------------- Shared fixtures of the tests --------------- #
+
+# The bundled OpenEI tariffs billed by the tests
+OPENEI_TARIFF_NAMES = ['E-19', 'A-10', 'E-20']
+
+# The synthetic tariffs billed by the tests: 12 tariff blocks per year, with and without tiers
+SYNTHETIC_TARIFFS = {'synthetic': dict(tiered=False), 'synthetic-tiered': dict(tiered=True)}
+
+
+@pytest.fixture(scope='session')
+def tariffs():
+    """
+    The CostCalculator of each tariff of the tests, built once: the bundled OpenEI tariffs and the synthetic tariffs
+    """
+
+    ret = {name: load_openei_tariff(name) for name in OPENEI_TARIFF_NAMES}
+    for (name, options) in list(SYNTHETIC_TARIFFS.items()):
+        ret[name] = generate_tariff(2017, nb_years=1, blocks_per_year=12, nb_periods_in_day=96, **options)
+
+    return ret
+
+
+@pytest.fixture(scope='session', params=OPENEI_TARIFF_NAMES + sorted(SYNTHETIC_TARIFFS))
+def tariff_name(request):
+    return request.param
+
+
+@pytest.fixture(scope='session', params=['America/Los_Angeles', None])
+def profiles(request):
+    """
+    Three 15-min load profiles from mid-February to mid-May 2017: a DST change, changes of season and of tariff block
+    within the data, and a few missing values
+    """
+
+    df = generate_load_profiles('2017-02-15', nb_years=1, resolution=15, nb_meters=3, tz=request.param, seed=1)
+    df = df.loc[df.index < df.index[0] + pd.Timedelta(days=90)].copy()
+    df.iloc[100:110, 1] = np.nan
+
+    return df
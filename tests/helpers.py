@@ -0,0 +1,57 @@
+__author__ = 'Olivier Van Cutsem'
+
+import numpy as np
+import pytest
+
+from electricitycostcalculator.cost_calculator.bill import Bill
+
+# --------------- Comparison of bills --------------- #
+
+
+def compute_bill_per_meter(bill_calculator, df, **kwargs):
+    """
+    Compute the bill of each column of 'df' with CostCalculator.compute_bill(), as a single Bill object
+    """
+
+    return Bill.concat([bill_calculator.compute_bill(df, column_data=col, as_bill=True, **kwargs) for col in df.columns])
+
+
+def assert_same_bill(bill, bill_ref, rtol=1e-9):
+    """
+    Assert that two Bill objects hold the same meters, months and labels, with the same metrics and costs, and the same
+    TOU periods for the DEMAND labels
+    """
+
+    assert bill.meters == bill_ref.meters
+    assert bill.months == bill_ref.months
+
+    # The labels may be listed in another order
+    idx_labels = [bill.labels.index(label) for label in bill_ref.labels]
+    assert sorted(bill.labels) == sorted(bill_ref.labels)
+    np.testing.assert_allclose(bill.metrics[:, :, idx_labels], bill_ref.metrics, rtol=rtol, atol=1e-9)
+    np.testing.assert_allclose(bill.costs[:, :, idx_labels], bill_ref.costs, rtol=rtol, atol=1e-9)
+
+    for meter in bill_ref.meters:
+        assert_same_monthly_bill(bill.to_dict(meter, monthly_detailed=True), bill_ref.to_dict(meter, monthly_detailed=True),
+                                 rtol)
+
+
+def assert_same_monthly_bill(monthly_bill, monthly_bill_ref, rtol=1e-9):
+    """
+    Assert that two bills in the format of CostCalculator.compute_bill(monthly_detailed=True) are the same
+    """
+
+    assert sorted(monthly_bill) == sorted(monthly_bill_ref)
+    for month_label, bill_ref in list(monthly_bill_ref.items()):
+        assert sorted(monthly_bill[month_label]) == sorted(bill_ref), month_label
+
+        for label, data_ref in list(bill_ref.items()):
+            data = monthly_bill[month_label][label]
+            if isinstance(data_ref, dict):  # DEMAND: the periods, keyed by price
+                assert sorted(data) == pytest.approx(sorted(data_ref), rel=rtol), (month_label, label)
+                for (p, p_ref) in zip(sorted(data), sorted(data_ref)):
+                    assert data[p]['mask'] == data_ref[p_ref]['mask'], (month_label, label, p)
+                    assert data[p]['max-demand'] == pytest.approx(data_ref[p_ref]['max-demand'], rel=rtol), (month_label, label, p)
+                    assert data[p]['max-demand-date'] == data_ref[p_ref]['max-demand-date'], (month_label, label, p)
+            else:
+                assert data == pytest.approx(data_ref, rel=rtol, abs=1e-9, nan_ok=True), (month_label, label)
@@ -0,0 +1,65 @@
+__author__ = 'Olivier Van Cutsem'
+
+import json
+import os
+
+import pytest
+
+from benchmarks.synthetic import generate_load_profiles
+from .conftest import OPENEI_TARIFF_NAMES
+
+# --------------- Bills of the original implementation --------------- #
+
+# The monthly bills of the bundled OpenEI tariffs computed by the original, non-vectorized implementation, for 2 hourly
+# load profiles: {tariff: {'naive' or 'aware': {meter: {month: {label: [metric, cost]}}}}}, with the metric of
+# compute_bill_batch(). Hourly data is used as the original implementation billed the demand of 15-min data with a
+# power coefficient of 1 instead of 4, see TariffBase.get_power_coeff().
+BASELINE_BILLS_FILENAME = os.path.join(os.path.dirname(__file__), 'baseline_bills.json')
+
+
+@pytest.fixture(scope='module')
+def baseline_bills():
+    with open(BASELINE_BILLS_FILENAME, 'r') as input_file:
+        return json.load(input_file)
+
+
+def get_baseline_profiles(tz_key):
+    """
+    The profiles billed by the original implementation: a whole year of naive dates, and March to October in local
+    time (it couldn't bill the tz-aware months where a tariff block starts)
+    """
+
+    if tz_key == 'naive':
+        return generate_load_profiles('2017-01-01', nb_years=1, resolution=60, nb_meters=2, tz=None, seed=0)
+
+    df = generate_load_profiles('2017-01-01', nb_years=1, resolution=60, nb_meters=2, seed=0)
+    return df['2017-03-01':'2017-10-31']
+
+
+@pytest.mark.parametrize('tz_key', ['naive', 'aware'])
+@pytest.mark.parametrize('name', OPENEI_TARIFF_NAMES)
+def test_monthly_bills_match_baseline(tariffs, baseline_bills, name, tz_key):
+    bill_calculator = tariffs[name]
+    df = get_baseline_profiles(tz_key)
+
+    for meter, bill_ref in list(baseline_bills[name][tz_key].items()):
+        bill = bill_calculator.compute_bill(df, column_data=meter, as_bill=True)
+
+        assert bill.months == sorted(bill_ref)
+        for (t_i, month_label) in enumerate(bill.months):
+            assert sorted(bill.labels) == sorted(bill_ref[month_label])
+            for (l_i, label) in enumerate(bill.labels):
+                (metric, cost) = bill_ref[month_label][label]
+                assert bill.metrics[0, t_i, l_i] == pytest.approx(metric, rel=1e-9, abs=1e-5), (meter, month_label, label)
+                assert bill.costs[0, t_i, l_i] == pytest.approx(cost, rel=1e-9, abs=1e-5), (meter, month_label, label)
+
+
+@pytest.mark.parametrize('name', OPENEI_TARIFF_NAMES)
+def test_yearly_totals_match_baseline(tariffs, baseline_bills, name):
+    df = get_baseline_profiles('naive')
+
+    for meter, bill_ref in list(baseline_bills[name]['naive'].items()):
+        total_ref = sum(cost for bill_month in list(bill_ref.values()) for (metric, cost) in list(bill_month.values()))
+        bill = tariffs[name].compute_bill(df, column_data=meter, as_bill=True)
+
+        assert bill.get_total() == pytest.approx(total_ref, rel=1e-9)
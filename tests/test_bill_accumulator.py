@@ -0,0 +1,112 @@
+__author__ = 'Olivier Van Cutsem'
+
+import pytest
+
+from benchmarks.synthetic import load_openei_tariff
+from electricitycostcalculator.cost_calculator.bill_accumulator import BillAccumulator
+from electricitycostcalculator.cost_calculator.tariff_structure import DemandWindowMode
+from .helpers import assert_same_monthly_bill
+
+# --------------- Incremental billing at the chunk boundaries --------------- #
+
+
+def accumulate(bill_calculator, df, chunk_sizes, meter, check_every=None):
+    """
+    Bill 'df' chunk by chunk with a BillAccumulator, the size of the chunks cycling over 'chunk_sizes'. Every
+    'check_every' chunks, the bill so far is compared to compute_bill() on the data received so far.
+    :return: the BillAccumulator
+    """
+
+    bill_accumulator = BillAccumulator(bill_calculator, column_data=meter)
+
+    (idx_start, k) = (0, 0)
+    while idx_start < len(df):
+        idx_end = idx_start + chunk_sizes[k % len(chunk_sizes)]
+        bill_accumulator.update(df.iloc[idx_start:idx_end])
+        (idx_start, k) = (idx_end, k + 1)
+
+        if check_every is not None and k % check_every == 0:
+            assert_same_monthly_bill(bill_accumulator.get_bill(monthly_detailed=True),
+                                     bill_calculator.compute_bill(df.iloc[:idx_start], column_data=meter, monthly_detailed=True))
+
+    return bill_accumulator
+
+
+@pytest.fixture(scope='module')
+def windowed_tariffs():
+    return {mode: load_openei_tariff('E-19', demand_window=60, demand_window_mode=mode) for mode in DemandWindowMode}
+
+
+@pytest.fixture
+def spiky_profiles(profiles):
+    """
+    The first week of the profiles, with a demand spike in a single interval
+    """
+
+    df = profiles.iloc[:96 * 7].copy()
+    df.iloc[500, 0] = 50 * df.iloc[500, 0]
+
+    return df
+
+
+@pytest.mark.parametrize('chunk_sizes', [[1], [7], [1, 3], [500, 1, 7], [5000]])
+@pytest.mark.parametrize('mode', list(DemandWindowMode))
+def test_demand_window_across_chunks(windowed_tariffs, spiky_profiles, mode, chunk_sizes):
+    bill_calculator = windowed_tariffs[mode]
+
+    bill_accumulator = accumulate(bill_calculator, spiky_profiles, chunk_sizes, 'meter_0', check_every=97)
+
+    for monthly_detailed in [True, False]:
+        bill_ref = bill_calculator.compute_bill(spiky_profiles, column_data='meter_0', monthly_detailed=monthly_detailed)
+        if monthly_detailed:
+            assert_same_monthly_bill(bill_accumulator.get_bill(monthly_detailed=True), bill_ref)
+        else:
+            assert_same_monthly_bill({'all': bill_accumulator.get_bill()}, {'all': bill_ref})
+
+
+def test_demand_window_with_missing_values(windowed_tariffs, profiles):
+    df = profiles.iloc[:96 * 10]
+    bill_calculator = windowed_tariffs[DemandWindowMode.BLOCK]
+
+    bill_accumulator = accumulate(bill_calculator, df, [7], 'meter_1')
+    assert_same_monthly_bill(bill_accumulator.get_bill(monthly_detailed=True),
+                             bill_calculator.compute_bill(df, column_data='meter_1', monthly_detailed=True))
+
+
+@pytest.mark.parametrize('chunk_sizes', [[1, 7], [96], [96 * 7 + 5]])
+def test_tiers_across_chunks(tariffs, profiles, chunk_sizes):
+    bill_calculator = tariffs['synthetic-tiered']
+
+    # The 1-row chunks are billed over a few days, the larger ones over the whole profiles
+    df = profiles.iloc[:96 * 4] if min(chunk_sizes) == 1 else profiles
+
+    bill_accumulator = accumulate(bill_calculator, df, chunk_sizes, 'meter_0', check_every=50)
+    bill_ref = bill_calculator.compute_bill(df, column_data='meter_0', monthly_detailed=True)
+    assert_same_monthly_bill(bill_accumulator.get_bill(monthly_detailed=True), bill_ref)
+
+    # The tier of 2000 kWh is reached within the data
+    bill_month = bill_ref[df.index[0].strftime('%Y-%m')]
+    (energy, cost) = [data for (label, data) in list(bill_month.items()) if 'energy' in label][0]
+    assert energy > 2000.0
+
+
+def test_interval_from_single_rows(tariffs, profiles):
+    bill_calculator = tariffs['E-19']
+    df = profiles.iloc[:96 * 3]
+
+    bill_accumulator = BillAccumulator(bill_calculator, column_data='meter_0')
+    bill_accumulator.update(df.iloc[:1])
+    assert_same_monthly_bill(bill_accumulator.get_bill(monthly_detailed=True),
+                             bill_calculator.compute_bill(df.iloc[:1], column_data='meter_0', monthly_detailed=True))
+
+    for idx in range(1, len(df)):
+        bill_accumulator.update(df.iloc[idx:idx + 1])
+
+    # The duration of the intervals is inferred once, and not from each single-row chunk
+    assert_same_monthly_bill(bill_accumulator.get_bill(monthly_detailed=True),
+                             bill_calculator.compute_bill(df, column_data='meter_0', monthly_detailed=True))
+
+
+def test_empty_accumulator(tariffs):
+    assert BillAccumulator(tariffs['E-19']).get_bill() == {}
+    assert BillAccumulator(tariffs['E-19']).get_bill(monthly_detailed=True) == {}
@@ -0,0 +1,163 @@
+__author__ = 'Olivier Van Cutsem'
+
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+import pytz
+
+from electricitycostcalculator.cost_calculator.bill import Bill
+from electricitycostcalculator.cost_calculator.bill_accumulator import BillAccumulator
+from electricitycostcalculator.cost_calculator.cost_calculator import CostCalculator
+from electricitycostcalculator.cost_calculator.rate_structure import TouRateSchedule
+from electricitycostcalculator.cost_calculator.tariff_structure import TouDemandChargeTariff
+from electricitycostcalculator.cost_calculator.portfolio import compute_bill_portfolio
+from .helpers import compute_bill_per_meter, assert_same_bill, assert_same_monthly_bill
+
+# --------------- Agreement of the billing paths --------------- #
+
+# Each path bills the profiles of the 'profiles' fixture with each tariff of the 'tariff_name' fixture, and is compared
+# to compute_bill() on each meter
+
+
+@pytest.fixture(scope='module')
+def reference_bills():
+    """
+    The bills computed by compute_bill() on each meter, by tariff and profiles, computed once
+    """
+
+    return {}
+
+
+@pytest.fixture
+def bill_ref(tariffs, tariff_name, profiles, reference_bills):
+    key = (tariff_name, str(profiles.index.tz))
+    if key not in reference_bills:
+        reference_bills[key] = compute_bill_per_meter(tariffs[tariff_name], profiles)
+
+    return reference_bills[key]
+
+
+def test_bill_object_matches_dict(tariffs, tariff_name, profiles, bill_ref):
+    bill_calculator = tariffs[tariff_name]
+
+    for meter in profiles.columns:
+        monthly_bill = bill_calculator.compute_bill(profiles, column_data=meter, monthly_detailed=True)
+        assert_same_monthly_bill(bill_ref.to_dict(meter, monthly_detailed=True), monthly_bill)
+        assert_same_bill(Bill.from_dict(monthly_bill, bill_calculator.type_tariffs_map, meter=meter),
+                         compute_bill_per_meter(bill_calculator, profiles[[meter]]))
+
+
+def test_batch(tariffs, tariff_name, profiles, bill_ref):
+    bill_calculator = tariffs[tariff_name]
+
+    bill = bill_calculator.compute_bill_batch(profiles, as_bill=True)
+    assert_same_bill(bill, bill_ref)
+
+    table = bill_calculator.compute_bill_batch(profiles)
+    pd.testing.assert_frame_equal(table, bill.to_frame())
+
+
+def test_batch_numpy(tariffs, tariff_name, profiles, bill_ref):
+    bill = tariffs[tariff_name].compute_bill_batch(profiles.values, date_index=profiles.index,
+                                                   columns=list(profiles.columns), as_bill=True)
+    assert_same_bill(bill, bill_ref)
+
+
+def test_low_memory(tariffs, tariff_name, profiles, bill_ref):
+    bill_calculator = tariffs[tariff_name]
+
+    assert_same_bill(compute_bill_per_meter(bill_calculator, profiles, low_memory=True), bill_ref)
+    assert_same_bill(bill_calculator.compute_bill_batch(profiles, as_bill=True, low_memory=True), bill_ref)
+
+
+def test_low_memory_float32(tariffs, tariff_name, profiles, bill_ref):
+    bill = tariffs[tariff_name].compute_bill_batch(profiles.astype(np.float32), as_bill=True, low_memory=True)
+
+    np.testing.assert_allclose(bill.costs[:, :, [bill.labels.index(label) for label in bill_ref.labels]], bill_ref.costs,
+                               rtol=1e-5, atol=1e-3)
+
+
+@pytest.mark.parametrize('chunk_size', [96 * 7, 1000])
+def test_accumulator(tariffs, tariff_name, profiles, bill_ref, chunk_size):
+    bill_calculator = tariffs[tariff_name]
+
+    for meter in profiles.columns:
+        bill_accumulator = BillAccumulator(bill_calculator, column_data=meter)
+        for idx_start in range(0, len(profiles), chunk_size):
+            bill_accumulator.update(profiles.iloc[idx_start:idx_start + chunk_size])
+
+        assert_same_monthly_bill(bill_accumulator.get_bill(monthly_detailed=True),
+                                 bill_ref.to_dict(meter, monthly_detailed=True))
+
+
+def test_scenarios(tariffs, tariff_name, profiles, bill_ref):
+    bill = tariffs[tariff_name].compute_bill_scenarios(profiles.values.T, profiles.index, names=list(profiles.columns),
+                                                       as_bill=True)
+    assert_same_bill(bill, bill_ref)
+
+
+def test_scenarios_evaluator_is_reused(tariffs, tariff_name, profiles, bill_ref):
+    evaluator = tariffs[tariff_name].get_scenario_evaluator(profiles.index)
+
+    for meter in profiles.columns:
+        bill = evaluator.evaluate(profiles[[meter]].values.T, [meter], as_bill=True)
+        assert_same_bill(bill, compute_bill_per_meter(tariffs[tariff_name], profiles[[meter]]))
+
+
+def test_portfolio(tariffs, profiles):
+    bill_calculator = tariffs['E-19']
+    bill_ref = compute_bill_per_meter(bill_calculator, profiles)
+
+    bill = compute_bill_portfolio(bill_calculator, profiles, max_workers=2, meters_per_task=1, as_bill=True)
+    assert_same_bill(bill, bill_ref)
+
+    table = compute_bill_portfolio(bill_calculator, profiles, max_workers=2, meters_per_task=2)
+    pd.testing.assert_frame_equal(table, bill_calculator.compute_bill_batch(profiles))
+
+
+# --------------- Periods of the same price --------------- #
+
+
+def get_same_price_tariff():
+    """
+    A demand tariff of 2 blocks splitting March 2017, whose TOU periods have the same price but different masks: the
+    afternoon in the first block, the morning in the second one
+    """
+
+    tz = pytz.timezone('America/Los_Angeles')
+    bill_calculator = CostCalculator()
+
+    hours = np.arange(24)
+    for (dates, is_period) in [((datetime(2017, 1, 1), datetime(2017, 3, 15, 23, 59, 59)), (hours >= 12) & (hours < 18)),
+                               ((datetime(2017, 3, 16), datetime(2017, 12, 31, 23, 59, 59)), (hours >= 8) & (hours < 12))]:
+        rates = {'all': {TouRateSchedule.MONTHLIST_KEY: list(range(1, 13)),
+                         TouRateSchedule.DAILY_RATE_KEY: {
+                             'all': {TouRateSchedule.DAYSLIST_KEY: list(range(7)),
+                                     TouRateSchedule.RATES_KEY: np.where(is_period, 10.0, 0.0).tolist()}}}}
+        bill_calculator.add_tariff(TouDemandChargeTariff((tz.localize(dates[0]), tz.localize(dates[1])), TouRateSchedule(rates)),
+                                   'customer_demand_charge_tou')
+
+    return bill_calculator
+
+
+def test_same_price_periods_across_blocks(profiles):
+    bill_calculator = get_same_price_tariff()
+    bill_ref = compute_bill_per_meter(bill_calculator, profiles)
+
+    # A single period per price is billed, as in the bill of compute_bill()
+    for meter in profiles.columns:
+        demand_bill = bill_ref.to_dict(meter, monthly_detailed=True)['2017-03']['customer_demand_charge_tou']
+        assert sorted(demand_bill) == [0.0, 10.0]
+
+    assert_same_bill(bill_calculator.compute_bill_batch(profiles, as_bill=True), bill_ref)
+    assert_same_bill(bill_calculator.compute_bill_batch(profiles, as_bill=True, low_memory=True), bill_ref)
+    assert_same_bill(bill_calculator.compute_bill_scenarios(profiles.values.T, profiles.index, names=list(profiles.columns),
+                                                            as_bill=True), bill_ref)
+
+    bill_accumulator = BillAccumulator(bill_calculator, column_data='meter_0')
+    for idx_start in range(0, len(profiles), 1000):
+        bill_accumulator.update(profiles.iloc[idx_start:idx_start + 1000])
+    assert_same_monthly_bill(bill_accumulator.get_bill(monthly_detailed=True),
+                             bill_ref.to_dict('meter_0', monthly_detailed=True))